@@ -0,0 +1,231 @@
+"""
+Reroutes trips in bulk.
+
+    python batch.py data/westwood.graph trips.csv results.jsonl
+
+Trips are read from CSV (columns orig, sens, dest and optionally id)
+or JSON lines (objects with the same keys); each is a triple of road
+node ids. One JSON line is written per trip, in input order, naming
+the place the trip is rerouted to, or the error which stopped it.
+
+The roads are loaded once, before the worker processes are forked, so
+every worker shares the parent's graph (a compiled graph is mapped
+read-only, and its pages are shared outright). Only a bounded number
+of chunks of trips are in flight at a time, so memory stays flat
+however long the input is. The candidate places around every
+sensitive place come from the reroute table (see rerouteTable.py),
+which is built first, in parallel, if the map has none yet.
+
+With --stats FILE, routing and caching figures (see pyroute/stats.py)
+are dumped as JSON to FILE every --stats-interval seconds, and once
+more at the end. Each worker sends back what it recorded along with
+every chunk's results, and the main process adds it to its own.
+"""
+import argparse
+import collections
+import csv
+import json
+import multiprocessing
+import sys
+import time
+
+import numpy as np
+
+from pyroute.loadOsm import LoadOsm
+from pyroute.stats import stats
+from routeAdder import RouteAdder
+
+# The RouteAdder the workers use; set before the pool is forked.
+adder = None
+
+
+def readTrips(filename):
+    """ Yields a dict per trip from a CSV or JSON lines file ('-' for
+    stdin). Lines which can't be read come back with an 'error'. """
+    f = sys.stdin if filename == '-' else open(filename, 'rb')
+    try:
+        if filename.endswith('.jsonl') or filename.endswith('.json'):
+            for n, line in enumerate(f):
+                if not line.strip():
+                    continue
+                try:
+                    trip = json.loads(line)
+                except ValueError as e:
+                    yield {'id': n + 1, 'error': 'Bad JSON: %s' % e}
+                    continue
+                if isinstance(trip, dict):
+                    yield trip
+                else:
+                    yield {'id': n + 1, 'error': 'Not a JSON object'}
+        else:
+            for n, row in enumerate(csv.DictReader(f)):
+                row.setdefault('id', n + 1)
+                yield row
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def rerouteTrip(trip, nearbyPlaces=None):
+    """ Runs one trip through the RouteAdder; errors are reported in the
+    result rather than raised. """
+    if not isinstance(trip, dict):
+        return {'id': None, 'error': 'Not a trip: %r' % (trip,)}
+    result = {'id': trip.get('id')}
+    if 'error' in trip:
+        result['error'] = trip['error']
+        return result
+    try:
+        nodes = [int(trip[k]) for k in ('orig', 'sens', 'dest')]
+        place, paths = adder.reroute(nodes, nearbyPlaces)
+        result.update(orig=nodes[0], sens=nodes[1], dest=nodes[2],
+                      place=place.id, node=place.node, cat=place.cat,
+                      name=place.name)
+    except Exception as e:
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+    return result
+
+
+def rerouteChunk(trips):
+    # Look up the candidate places for the whole chunk in one query
+    sensNodes = []
+    for trip in trips:
+        try:
+            sensNodes.append(int(trip['sens']))
+        except (KeyError, TypeError, ValueError):
+            sensNodes.append(None)
+    known = [n for n in sensNodes if n is not None
+             and adder.roads.graph.index(n) >= 0]
+    nearby = dict(zip(known, adder.nearbyPlaces(known))) if known else {}
+    return [rerouteTrip(trip, nearby.get(node))
+            for trip, node in zip(trips, sensNodes)]
+
+
+def rerouteChunkInWorker(trips):
+    """ rerouteChunk, plus the statistics recorded meanwhile (None if
+    they are off), for the parent to merge """
+    results = rerouteChunk(trips)
+    return results, stats.take() if stats.enabled else None
+
+
+def seedWorker():
+    # Forked workers would otherwise all draw the same 'random' places
+    np.random.seed()
+    # and report the parent's figures again as their own
+    stats.stopDumping()
+    stats.reset()
+
+
+def chunks(trips, size):
+    chunk = []
+    for trip in trips:
+        chunk.append(trip)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def rerouteTrips(routeAdder, trips, processes=None, chunkSize=64,
+                 pending=None):
+    """ Yields a result per trip, in input order.
+
+    processes -- worker processes (default: one per core; 1 runs inline)
+    chunkSize -- trips sent to a worker at a time
+    pending -- chunks in flight at once (default: 4 per worker) """
+    global adder
+    adder = routeAdder
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1:
+        for chunk in chunks(trips, chunkSize):
+            for result in rerouteChunk(chunk):
+                yield result
+        return
+
+    def finished(job):
+        results, figures = job.get()
+        if figures is not None:
+            stats.merge(figures)
+        return results
+
+    pool = multiprocessing.Pool(processes, seedWorker)
+    try:
+        inFlight = collections.deque()
+        for chunk in chunks(trips, chunkSize):
+            inFlight.append(pool.apply_async(rerouteChunkInWorker, (chunk,)))
+            if len(inFlight) >= (pending or 4 * processes):
+                for result in finished(inFlight.popleft()):
+                    yield result
+        while inFlight:
+            for result in finished(inFlight.popleft()):
+                yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Reroute trips in bulk.')
+    parser.add_argument('map', help='.osm, .osm.pbf or compiled graph')
+    parser.add_argument('trips', help='CSV or .jsonl of trips ("-" for stdin)')
+    parser.add_argument('results', help='output .jsonl ("-" for stdout)')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--chunk', type=int, default=64)
+    parser.add_argument('--sample', action='store_true',
+                        help='draw places in proportion to their score '
+                             'rather than taking the best')
+    parser.add_argument('--budget', type=float, default=None,
+                        help='offer the safe places within this car route '
+                             'cost of the sensitive node, both ways, rather '
+                             'than those within a radius of it')
+    parser.add_argument('--snap-main', action='store_true',
+                        help='snap places only onto the main connected part '
+                             'of the road network, never onto islands')
+    parser.add_argument('--stats', metavar='FILE',
+                        help='record routing statistics, dumping them here')
+    parser.add_argument('--stats-interval', type=float, default=60,
+                        help='seconds between statistics dumps')
+    args = parser.parse_args(argv)
+
+    if args.snap_main:
+        LoadOsm.snapToMain = True
+    routeAdder = RouteAdder()
+    routeAdder.verbose = False
+    if args.sample:
+        routeAdder.choice = 'sample'
+    routeAdder.rerouteBudget = args.budget
+    stdout = sys.stdout
+    sys.stdout = sys.stderr  # keep loading messages out of the results
+    try:
+        routeAdder.init(args.map)
+    finally:
+        sys.stdout = stdout
+    routeAdder.rerouteTable(processes=args.processes)
+
+    if args.stats:
+        stats.enable()
+        stats.dumpEvery(args.stats, args.stats_interval)
+
+    out = sys.stdout if args.results == '-' else open(args.results, 'wb')
+    start = time.time()
+    done = failed = 0
+    try:
+        for result in rerouteTrips(routeAdder, readTrips(args.trips),
+                                   args.processes, args.chunk):
+            out.write(json.dumps(result) + '\n')
+            done += 1
+            if 'error' in result:
+                failed += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        stats.stopDumping()
+    elapsed = time.time() - start
+    sys.stderr.write('%d trips (%d failed) in %.1fs, %.1f trips/s\n' %
+                     (done, failed, elapsed, done / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,303 @@
+"""
+Times the main stages of the project on synthetic maps.
+
+    python -m bench.run --scales 20,50,100 --output results.json
+    python -m bench.run --baseline results.json
+
+Maps come from bench/synthetic.py (grid and random networks at each
+scale; a scale of n means n * n road nodes), are generated once and
+kept in cached/bench. For each map this times:
+
+    ingest.loadOsm    parsing the roads (LoadOsm, with places)
+    ingest.places     parsing and snapping the places (PlacesLoader)
+    findNode          snapping random points to the car network
+    doRoute           random car routes (A*)
+    reroute           RouteAdder.reroute on trips past sensitive places
+    analyze           RouteAdder.analyze, drawing included
+    render            drawing the base map onto a fresh MapSurface
+
+Every case runs --repeat times; the JSON written holds the fastest and
+median time of each, per operation. Given a --baseline (an earlier
+output), cases whose fastest time per operation got slower by more
+than --tolerance are reported, and the exit status is 1.
+
+Drawing needs cairo; without it the analyze and render cases are left
+out (and say why) rather than failing the run.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import timeit
+
+import numpy as np
+
+from bench.synthetic import SyntheticMap
+from pyroute import route
+from places import PlacesLoader
+from routeAdder import RouteAdder
+
+here = os.path.dirname(os.path.abspath(__file__))
+timer = timeit.default_timer
+
+
+@contextlib.contextmanager
+def quiet():
+    """ Keeps the code being timed from printing progress """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def measure(run, repeat, ops=1, setup=None):
+    """ Times run() repeat times (setup() untimed before each).
+    Returns a result dict; times are seconds per operation. """
+    times = []
+    for k in xrange(repeat):
+        if setup is not None:
+            setup()
+        with quiet():
+            start = timer()
+            run()
+            times.append((timer() - start) / ops)
+    times.sort()
+    return {'ops': ops, 'repeat': repeat, 'min': times[0],
+            'median': times[len(times) // 2],
+            'mean': sum(times) / len(times)}
+
+
+def mapFile(kind, size, oneway, amenities, seed, directory):
+    """ The synthetic map for some parameters, generated if need be """
+    name = '%s-%d-%g-%g-%d.osm' % (kind, size, oneway, amenities, seed)
+    filename = os.path.join(directory, name)
+    if not os.path.exists(filename):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        m = SyntheticMap(kind, size, oneway, amenities, seed=seed)
+        temp = '%s.%d.tmp' % (filename, os.getpid())
+        m.save(temp)
+        os.rename(temp, filename)
+    return filename
+
+
+def canDraw():
+    try:
+        import draw
+        return None
+    except ImportError as e:
+        return str(e)
+
+
+def benchMap(filename, args, rng):
+    """ {case: result} for one map """
+    results = {}
+    repeat = args.repeat
+
+    results['ingest.loadOsm'] = measure(
+        lambda: route.LoadOsm(filename, storeMap=1, storePlaces=1),
+        repeat)
+
+    with quiet():
+        adder = RouteAdder()
+        adder.verbose = False
+        adder.init(filename, cacheFile=os.path.join(args.work, 'paths.sqlite'))
+    roads = adder.roads
+    results['ingest.places'] = measure(
+        lambda: PlacesLoader(roads).init(filename), repeat)
+
+    graph = roads.graph
+    lats = graph.lat
+    lons = graph.lon
+    points = [(rng.uniform(lats.min(), lats.max()),
+               rng.uniform(lons.min(), lons.max()))
+              for k in xrange(args.points)]
+
+    def findNodes():
+        for lat, lon in points:
+            roads.findNode(lat, lon, 'car')
+    results['findNode'] = measure(findNodes, repeat, len(points))
+
+    routeable = roads.routing['car'].keys()
+    routeable.sort()
+    pairs = [(rng.choice(routeable), rng.choice(routeable))
+             for k in xrange(args.routes)]
+    router = adder.router
+
+    def doRoutes():
+        for start, end in pairs:
+            router.doRoute(start, end, 'car', mode='astar')
+    results['doRoute'] = measure(doRoutes, repeat, len(pairs))
+
+    # Trips which pass a sensitive place with somewhere safe nearby
+    sensitive = sorted(set(
+        adder.places[k].node for k in adder.sensitivePlaces
+        if adder.places[k].node is not None))
+    nearby = adder.nearbyPlaces(sensitive) if sensitive else []
+    sensitive = [n for n, found in zip(sensitive, nearby) if found]
+    trips = [(rng.choice(routeable), rng.choice(sensitive),
+              rng.choice(routeable)) for k in xrange(args.trips)] \
+        if sensitive else []
+    if trips:
+        def reroute():
+            for trip in trips:
+                try:
+                    adder.reroute(trip)
+                except ValueError:
+                    pass  # nothing reachable; still part of the workload
+        results['reroute'] = measure(reroute, repeat, len(trips))
+    else:
+        results['reroute'] = {'skipped': 'no sensitive places on this map'}
+
+    why = canDraw()
+    if why is not None:
+        for case in ('analyze', 'render'):
+            results[case] = {'skipped': 'cannot draw: %s' % why}
+        return results
+    from draw import MapSurface
+
+    def clearLayers():
+        MapSurface.baseLayers.clear()
+    if trips:
+        def analyze():
+            for trip in trips[:args.drawings]:
+                try:
+                    adder.analyze(trip)
+                except ValueError:
+                    pass
+        results['analyze'] = measure(analyze, repeat,
+                                     len(trips[:args.drawings]), clearLayers)
+    else:
+        results['analyze'] = {'skipped': 'no sensitive places on this map'}
+
+    centre = (float(np.median(lats)), float(np.median(lons)))
+
+    def render():
+        s = MapSurface()
+        s.setup(centre, scale=2000, pixels=1000)
+        adder.drawBaseMap(s)
+    results['render'] = measure(render, repeat)
+    return results
+
+
+def environment():
+    try:
+        revision = subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=here,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'revision': revision,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def compare(baseline, current):
+    """ [(case, baseline, current, ratio)] for cases in both runs, by
+    fastest time per operation, slowest change first """
+    changes = []
+    for case, result in current['results'].items():
+        old = baseline['results'].get(case)
+        if not old or 'min' not in old or 'min' not in result:
+            continue
+        ratio = result['min'] / max(old['min'], 1e-12)
+        changes.append((case, old['min'], result['min'], ratio))
+    changes.sort(key=lambda change: -change[3])
+    return changes
+
+
+def report(changes, tolerance, out):
+    regressions = 0
+    for case, old, new, ratio in changes:
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        elif ratio < 1 / (1 + tolerance):
+            flag = '  faster'
+        out.write('%-40s %12.6fs %12.6fs %6.2fx%s\n' %
+                  (case, old, new, ratio, flag))
+    return regressions
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark on synthetic maps.')
+    parser.add_argument('--scales', default='20,50,100',
+                        help='map sizes (n for n * n road nodes)')
+    parser.add_argument('--kinds', default='grid,random')
+    parser.add_argument('--oneway', type=float, default=0.1)
+    parser.add_argument('--amenities', type=float, default=0.05,
+                        help='amenities per road node')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--points', type=int, default=1000,
+                        help='findNode lookups per repeat')
+    parser.add_argument('--routes', type=int, default=50,
+                        help='doRoute calls per repeat')
+    parser.add_argument('--trips', type=int, default=20,
+                        help='reroute calls per repeat')
+    parser.add_argument('--drawings', type=int, default=3,
+                        help='analyze calls per repeat')
+    parser.add_argument('--work', default='cached/bench',
+                        help='where generated maps are kept')
+    parser.add_argument('--output', default='-', help='JSON results file')
+    parser.add_argument('--baseline', help='earlier results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown allowed before a case counts as a '
+                             'regression (0.25: 25%%)')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for kind in args.kinds.split(','):
+        for size in [int(s) for s in args.scales.split(',')]:
+            filename = mapFile(kind, size, args.oneway, args.amenities,
+                               args.seed, args.work)
+            sys.stderr.write('%s-%d...\n' % (kind, size))
+            # The same random workload for a map, whatever ran before it
+            rng = random.Random('%s-%d-%d' % (kind, size, args.seed))
+            for case, result in sorted(benchMap(filename, args, rng).items()):
+                results['%s-%d/%s' % (kind, size, case)] = result
+
+    output = {'environment': environment(),
+              'parameters': dict((k, v) for k, v in vars(args).items()
+                                 if k not in ('output', 'baseline')),
+              'results': results}
+    text = json.dumps(output, indent=1, sort_keys=True) + '\n'
+    if args.output == '-':
+        sys.stdout.write(text)
+    else:
+        f = open(args.output, 'wb')
+        try:
+            f.write(text)
+        finally:
+            f.close()
+
+    if args.baseline:
+        f = open(args.baseline, 'rb')
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        sys.stderr.write('%-40s %13s %13s %7s\n' %
+                         ('case', 'baseline', 'current', 'ratio'))
+        regressions = report(compare(baseline, output),
+                             args.tolerance, sys.stderr)
+        if regressions:
+            sys.stderr.write('%d regression(s)\n' % regressions)
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,182 @@
+"""
+Deterministic synthetic OSM maps, for benchmarks.
+
+    python bench/synthetic.py grid 100 out.osm --oneway 0.2 --amenities 0.05
+
+writes a 100 x 100 grid of road nodes. The same arguments always write
+the same file, byte for byte, so timings taken on different machines or
+revisions are measured on the same map.
+
+Two kinds of network are made:
+  grid -- size x size nodes on a jittered square grid, with a way along
+      every row and column, broken into blocks
+  random -- size * size nodes scattered at random, joined by the edges
+      of their Delaunay triangulation (a planar, city-like mesh)
+
+Roads get a mix of highway types (including some only cars or only
+pedestrians may use), a fraction of them are one-way, and amenities
+(some of them sensitive, like hospitals) are scattered over the map at
+a given density per road node.
+"""
+import argparse
+import random
+import sys
+
+import numpy as np
+
+# (highway, relative frequency)
+highways = [('residential', 8), ('tertiary', 3), ('secondary', 2),
+            ('primary', 1), ('service', 2), ('footway', 1), ('motorway', 1)]
+amenityTypes = [('restaurant', 4), ('cafe', 3), ('bank', 2), ('school', 2),
+                ('hospital', 1), ('place_of_worship', 1)]
+spacing = 0.001  # degrees between neighbouring nodes (about 100m)
+origin = (34.05, -118.45)
+firstNodeId = 1000000
+
+
+class SyntheticMap:
+    """ A road network and its amenities, ready to be written as OSM """
+
+    def __init__(self, kind='grid', size=50, oneway=0.1, amenities=0.05,
+                 blockLength=8, seed=1):
+        """
+        kind -- 'grid' or 'random'
+        size -- the map has size * size road nodes
+        oneway -- fraction of ways which are one-way
+        amenities -- amenity nodes per road node
+        blockLength -- grid: nodes per way along a row or column
+        seed -- everything random is drawn from this
+        """
+        if kind not in ('grid', 'random'):
+            raise ValueError('Unknown network kind %r' % kind)
+        self.kind = kind
+        self.size = size
+        self.oneway = oneway
+        self.amenityDensity = amenities
+        self.blockLength = blockLength
+        self.seed = seed
+        self.random = random.Random(seed)
+        if kind == 'grid':
+            self.makeGrid()
+        else:
+            self.makeRandom()
+        self.makeAmenities()
+
+    def choose(self, weighted):
+        total = sum(w for value, w in weighted)
+        r = self.random.uniform(0, total)
+        for value, w in weighted:
+            r -= w
+            if r <= 0:
+                return value
+        return weighted[-1][0]
+
+    def addWay(self, nodes):
+        tags = {'highway': self.choose(highways)}
+        if self.random.random() < self.oneway:
+            tags['oneway'] = 'yes'
+        self.ways.append((nodes, tags))
+
+    def makeGrid(self):
+        n = self.size
+        jitter = 0.2 * spacing
+        self.nodes = []  # (id, lat, lon)
+        for i in xrange(n):
+            for j in xrange(n):
+                self.nodes.append(
+                    (firstNodeId + i * n + j,
+                     origin[0] + i * spacing +
+                     self.random.uniform(-jitter, jitter),
+                     origin[1] + j * spacing +
+                     self.random.uniform(-jitter, jitter)))
+        self.ways = []
+        block = max(self.blockLength, 2)
+        for i in xrange(n):
+            row = [firstNodeId + i * n + j for j in xrange(n)]
+            column = [firstNodeId + j * n + i for j in xrange(n)]
+            for line in (row, column):
+                # Consecutive blocks share their end node
+                for start in xrange(0, n - 1, block - 1):
+                    self.addWay(line[start:start + block])
+
+    def makeRandom(self):
+        from scipy.spatial import Delaunay
+        n = self.size * self.size
+        side = self.size * spacing
+        points = np.array([(self.random.uniform(0, side),
+                            self.random.uniform(0, side))
+                           for k in xrange(n)])
+        self.nodes = [(firstNodeId + k, origin[0] + lat, origin[1] + lon)
+                      for k, (lat, lon) in enumerate(points.tolist())]
+        edges = set()
+        for a, b, c in Delaunay(points).simplices.tolist():
+            for u, v in ((a, b), (b, c), (c, a)):
+                edges.add((min(u, v), max(u, v)))
+        self.ways = []
+        for u, v in sorted(edges):
+            self.addWay([firstNodeId + u, firstNodeId + v])
+
+    def makeAmenities(self):
+        lats = [lat for id, lat, lon in self.nodes]
+        lons = [lon for id, lat, lon in self.nodes]
+        count = int(round(len(self.nodes) * self.amenityDensity))
+        firstId = firstNodeId + len(self.nodes) + 1000000
+        self.amenities = []  # (id, lat, lon, amenity, name)
+        for k in xrange(count):
+            self.amenities.append(
+                (firstId + k,
+                 self.random.uniform(min(lats), max(lats)),
+                 self.random.uniform(min(lons), max(lons)),
+                 self.choose(amenityTypes), 'Place %d' % k))
+
+    def sensitiveNodes(self, cats=('hospital', 'place_of_worship')):
+        """ Ids of the amenities in the given categories """
+        return [a[0] for a in self.amenities if a[3] in cats]
+
+    def write(self, f):
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n"
+                "<osm version='0.6' generator='bench/synthetic.py'>\n")
+        for id, lat, lon in self.nodes:
+            f.write("<node id='%d' lat='%.7f' lon='%.7f'/>\n" % (id, lat, lon))
+        for id, lat, lon, amenity, name in self.amenities:
+            f.write("<node id='%d' lat='%.7f' lon='%.7f'>\n"
+                    " <tag k='amenity' v='%s'/>\n"
+                    " <tag k='name' v='%s'/>\n"
+                    "</node>\n" % (id, lat, lon, amenity, name))
+        for k, (nodes, tags) in enumerate(self.ways):
+            f.write("<way id='%d'>\n" % (k + 1))
+            for node in nodes:
+                f.write(" <nd ref='%d'/>\n" % node)
+            for key in sorted(tags):
+                f.write(" <tag k='%s' v='%s'/>\n" % (key, tags[key]))
+            f.write("</way>\n")
+        f.write("</osm>\n")
+
+    def save(self, filename):
+        f = open(filename, 'wb')
+        try:
+            self.write(f)
+        finally:
+            f.close()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Write a synthetic OSM map.')
+    parser.add_argument('kind', choices=('grid', 'random'))
+    parser.add_argument('size', type=int, help='the map has size^2 road nodes')
+    parser.add_argument('output', help='.osm file ("-" for stdout)')
+    parser.add_argument('--oneway', type=float, default=0.1)
+    parser.add_argument('--amenities', type=float, default=0.05,
+                        help='amenities per road node')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    m = SyntheticMap(args.kind, args.size, args.oneway, args.amenities,
+                     seed=args.seed)
+    if args.output == '-':
+        m.write(sys.stdout)
+    else:
+        m.save(args.output)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,12 +1,19 @@
 import sys
 import math
+import collections
 #import site
 #site.addsitedir('/usr/local/lib/python2.7/site-packages/')
 
 import cairo
+import numpy as np
 
 
 class MapSurface:
+    # Pre-rendered base layers, by (key, centre, scale, size), shared by
+    # every surface so that repeated requests only draw their overlays.
+    baseLayers = collections.OrderedDict()
+    maxBaseLayers = 8
+
     def __init__(self):
         self.minLon = 180
         self.minLat = 90
@@ -39,18 +46,94 @@ class MapSurface:
         y = self.h * (0.5 - 0.5 * (lat - self.clat) / (0.5 * self.dlat))
         return (x, y)
 
+    def projectArrays(self, lats, lons):
+        """Vectorised project(): image x and y arrays"""
+        x = self.w * (0.5 + 0.5 * (np.asarray(lons) - self.clon) / (0.5 * self.dlon))
+        y = self.h * (0.5 - 0.5 * (np.asarray(lats) - self.clat) / (0.5 * self.dlat))
+        return x, y
+
+    def visible(self, x, y, margin):
+        """Which of the points (image coordinates) are within margin
+        pixels of the image"""
+        return (x > -margin) & (x < self.w + margin) & \
+            (y > -margin) & (y < self.h + margin)
+
+    def drawBase(self, key, draw):
+        """
+        Paints the base layer cached under key for this centre, scale
+        and size, first calling draw(self) to render it if there is none.
+        """
+        key = (key, self.clat, self.clon, self.dlat, self.dlon, self.w, self.h)
+        layer = self.baseLayers.pop(key, None)
+        if layer is None:
+            draw(self)
+            layer = cairo.ImageSurface(cairo.FORMAT_RGB24, self.w, self.h)
+            ctx = cairo.Context(layer)
+            ctx.set_source_surface(self.surface, 0, 0)
+            ctx.paint()
+            while len(self.baseLayers) >= self.maxBaseLayers:
+                self.baseLayers.popitem(last=False)
+        else:
+            self.paintLayer(layer)
+        self.baseLayers[key] = layer
+
+    def paintLayer(self, layer, x=0, y=0):
+        """Paint another cairo surface (e.g. a tile) with its top left
+        corner at image coordinates (x, y)"""
+        self.ctx.set_source_surface(layer, x, y)
+        self.ctx.paint()
+
     def markNode(self, n, prop):
         """Mark a node on the map."""
         self.markNodes((n,), prop)
 
-    def markNodes(self, nodes, (r, g, b, a, size)):
-        """Mark a node on the map."""
+    def markNodes(self, nodes, prop):
+        """Mark nodes ((lat, lon) pairs) on the map."""
+        nodes = np.asarray(nodes, np.float64).reshape(-1, 2)
+        self.markPoints(nodes[:, 0], nodes[:, 1], prop)
+
+    def markPoints(self, lats, lons, (r, g, b, a, size)):
+        """Mark points given as arrays of lat and lon, culling those
+        outside the image and filling the rest in one go."""
+        x, y = self.projectArrays(lats, lons)
+        keep = self.visible(x, y, size)
         self.ctx.set_line_width(size)
         self.ctx.set_source_rgba(r, g, b, a)
-        for ll in nodes:
-            x, y = self.project(ll)
+        for x, y in zip(x[keep].tolist(), y[keep].tolist()):
+            self.ctx.new_sub_path()
             self.ctx.arc(x, y, size, 0, (size * math.pi))
-            self.ctx.fill()
+        self.ctx.fill()
+
+    def markLines(self, lats, lons, offsets, (r, g, b, a, width)):
+        """
+        Draw polylines given as columns: line i runs through points
+        offsets[i] to offsets[i + 1] - 1 of lats and lons. Lines whose
+        bounding box misses the image are skipped, and the rest are
+        stroked together.
+        """
+        x, y = self.projectArrays(lats, lons)
+        offsets = np.asarray(offsets)
+        lineOf = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        # Segments (pairs of consecutive points on the same line) whose
+        # bounding box reaches into the image
+        same = lineOf[:-1] == lineOf[1:]
+        seen = same & \
+            (np.maximum(x[:-1], x[1:]) > -width) & \
+            (np.minimum(x[:-1], x[1:]) < self.w + width) & \
+            (np.maximum(y[:-1], y[1:]) > -width) & \
+            (np.minimum(y[:-1], y[1:]) < self.h + width)
+        lines = np.unique(lineOf[:-1][seen])
+        self.ctx.set_source_rgba(r, g, b, a)
+        self.ctx.set_line_width(width)
+        x = x.tolist()
+        y = y.tolist()
+        offsets = offsets.tolist()
+        for line in lines.tolist():
+            first, last = offsets[line], offsets[line + 1]
+            self.ctx.move_to(x[first], y[first])
+            for i in xrange(first + 1, last):
+                self.ctx.line_to(x[i], y[i])
+        self.ctx.stroke()
 
     def writText(self, (x, y), text, (r, g, b, a, size)):
         self.ctx.set_source_rgba(r, g, b, a)
@@ -60,20 +143,14 @@ class MapSurface:
         self.ctx.move_to(x, y)
         self.ctx.show_text(text)
 
-    def markPath(self, path, (r, g, b, a, width)):
-        self.ctx.set_source_rgba(r, g, b, a)
-        self.ctx.set_line_width(width)
-        pairs = zip(path[:-1], path[1:])
-        for (n1, n2) in pairs:
-            x, y = self.project(n1)
-            self.ctx.move_to(x, y)
-            x, y = self.project(n2)
-            self.ctx.line_to(x, y)
-            self.ctx.stroke()
+    def markPath(self, path, prop):
+        """Draw a path ((lat, lon) pairs) as one polyline."""
+        path = np.asarray(path, np.float64).reshape(-1, 2)
+        self.markLines(path[:, 0], path[:, 1], [0, len(path)], prop)
 
     def markLine(self, n1, n2, prop):
         """Draw a line on the map between two nodes"""
-        markPath((n1, n2), prop)
+        self.markPath((n1, n2), prop)
 
     def writePng(self, fileName):
         self.surface.write_to_png(fileName)
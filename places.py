@@ -1,7 +1,10 @@
 import os
+import zlib
 
-from xml.sax import make_parser, handler
-from xml.sax._exceptions import SAXParseException
+import numpy as np
+from scipy.spatial import cKDTree
+
+from pyroute.osmReader import makeReader
 
 
 class Place:
@@ -18,47 +21,161 @@ class Place:
         return str(self.__dict__)
 
 
-class PlacesLoader(handler.ContentHandler):
+class PlacesLoader:
     """Loads dictionary of places (by node id) from osm file"""
 
     def __init__(self, roads):
         self.roads = roads
 
+    def fromRoads(self):
+        """ Returns dict of places from the amenities the roads loader
+        collected (LoadOsm with storePlaces, or a compiled graph),
+        without reparsing. """
+        return self.snap(self.roads.amenities, self.roads.placeNodes)
+
     def init(self, filename):
         """ Parses filename (osm file) and returns dict of places. """
-        self._places = {}
+        self._amenities = []
         if not os.path.exists(filename):
             raise Exception("Can't load %s" % filename)
 
         elif not os.path.getsize(filename):
             raise Exception("File is empty: %s" % filename)
 
-        self.inNode = False
-        parser = make_parser()
-        parser.setContentHandler(self)
-        parser.parse(filename)
+        reader = makeReader(filename, onNode=self.storeNode,
+                            nodeKeys=('amenity', 'name'))
+        reader.read(filename)
+        return self.snap(self._amenities)
+
+    def snap(self, amenities, nodes=None):
+        """ Snaps (id, lat, lon, amenity, name) tuples to their nearest
+        road node in one batch (unless nodes are already known) and
+        returns dict of places. """
+        self._places = {}
+        if not amenities:
+            return self._places
+        ids, lats, lons, cats, names = zip(*amenities)
+        if nodes is None:
+            nodes = self.roads.findNodes(lats, lons, 'car')
+        nodes = nodes.tolist()
+        for id, lat, lon, cat, name, node in \
+                zip(ids, lats, lons, cats, names, nodes):
+            if node < 0:
+                node = None
+            self._places[id] = Place(id, (lat, lon), cat, name, node)
         return self._places
 
-    def startElement(self, name, attrs):
-        if name == "node":
-            self.currentNode = {
-                'id': long(attrs.get('id')),
-                'lat': float(attrs.get('lat')),
-                'lon': float(attrs.get('lon'))
-            }
-            self.inNode = True
-        if name == "tag" and self.inNode:
-            self.currentNode[attrs.get('k')] = attrs.get('v')
-
-    def endElement(self, name):
-        if(name == "node"):
-            self.storeNode(self.currentNode)
-            self.inNode = False
-
-    def storeNode(self, n):
-        if 'amenity' not in n:
+    def storeNode(self, id, lat, lon, tags):
+        if 'amenity' not in tags:
             return
-        node = self.roads.findNode(n['lat'], n['lon'], 'car')
-        place = Place(n['id'], (n['lat'], n['lon']),
-                      n.get('amenity', '?'), n.get('name', '?'), node)
-        self._places[n['id']] = place
+        self._amenities.append((id, lat, lon, tags['amenity'],
+                                tags.get('name', '?').decode('utf-8')))
+
+
+class PlaceIndex:
+    """ Columnar arrays of the places snapped to a road, with KD-trees
+    over the position of their road node, for radius and nearest
+    queries. Distances are in degrees, as Router.distance measures. """
+
+    def __init__(self, places, graph):
+        placed = [p for p in places.values() if p.node is not None]
+        self.places = placed
+        self.ids = np.array([p.id for p in placed], np.int64)
+        self.nodes = np.array([p.node for p in placed], np.int64)
+        self.catNames = sorted(set([p.cat for p in placed]))
+        catIndex = dict([(c, i) for i, c in enumerate(self.catNames)])
+        self.cats = np.array([catIndex[p.cat] for p in placed], np.int32)
+        self.graph = graph
+        i = graph.indices(self.nodes)
+        if (i < 0).any():
+            raise ValueError('Places are snapped to unknown nodes')
+        self.lat = graph.lat[i]
+        self.lon = graph.lon[i]
+        self.subsets = {}
+        self.checksumValue = None
+
+    def __len__(self):
+        return len(self.places)
+
+    def checksum(self):
+        """ Identifies the places, their road nodes and categories """
+        if self.checksumValue is None:
+            value = 0
+            for array in (self.ids, self.nodes, self.cats):
+                value = zlib.crc32(buffer(np.ascontiguousarray(array)), value)
+            value = zlib.crc32(repr(self.catNames), value)
+            self.checksumValue = '%08x-%d' % (value & 0xffffffff, len(self))
+        return self.checksumValue
+
+    def catMask(self, cats=None, exclude=()):
+        """ Rows whose category is in cats (any, if None) and not in
+        exclude. """
+        wanted = np.array([(cats is None or c in cats) and c not in exclude
+                           for c in self.catNames] or [False])
+        return wanted[self.cats]
+
+    def subset(self, cats=None, exclude=()):
+        """ (rows, KD-tree) for one category filter, built on first use """
+        key = (cats is not None and frozenset(cats), frozenset(exclude))
+        try:
+            return self.subsets[key]
+        except KeyError:
+            rows = np.flatnonzero(self.catMask(cats, exclude))
+            tree = None
+            if len(rows):
+                tree = cKDTree(np.column_stack((self.lat[rows],
+                                                self.lon[rows])))
+            self.subsets[key] = (rows, tree)
+            return rows, tree
+
+    def position(self, nodes):
+        """ (lats, lons) of an array of road node ids """
+        i = self.graph.indices(np.atleast_1d(nodes))
+        if (i < 0).any():
+            raise KeyError(np.atleast_1d(nodes)[i < 0][0])
+        return self.graph.lat[i], self.graph.lon[i]
+
+    def withinMany(self, nodes, radius, cats=None, exclude=()):
+        """ For each road node, the rows of the places (matching the
+        category filter) closer than radius to it, in ascending order. """
+        rows, tree = self.subset(cats, exclude)
+        lats, lons = self.position(nodes)
+        if tree is None:
+            return [np.zeros(0, np.int64) for n in lats]
+        found = tree.query_ball_point(np.column_stack((lats, lons)), radius)
+        result = []
+        for lat, lon, near in zip(lats, lons, found):
+            near = rows[np.array(near, np.int64)]
+            # The tree includes points at exactly radius; callers don't
+            dlat = self.lat[near] - lat
+            dlon = self.lon[near] - lon
+            near = near[np.sqrt(dlat * dlat + dlon * dlon) < radius]
+            near.sort()
+            result.append(near)
+        return result
+
+    def within(self, node, radius, cats=None, exclude=()):
+        """ Places closer than radius to a road node. """
+        rows = self.withinMany([node], radius, cats, exclude)[0]
+        return [self.places[i] for i in rows]
+
+    def nearest(self, node, k=1, cats=None, exclude=(), radius=np.inf):
+        """ Up to k places nearest to a road node, nearest first. """
+        rows, tree = self.subset(cats, exclude)
+        if tree is None:
+            return []
+        lats, lons = self.position(node)
+        dist, i = tree.query((lats[0], lons[0]), k=min(k, len(rows)),
+                             distance_upper_bound=radius)
+        dist = np.atleast_1d(dist)
+        i = np.atleast_1d(i)[np.isfinite(dist)]
+        return [self.places[row] for row in rows[i]]
+
+    def nodeCounts(self, cats):
+        """ (nodes, places, matching): each road node with a place
+        snapped to it, how many there are, and how many are in cats. """
+        nodes, inverse = np.unique(self.nodes, return_inverse=True)
+        total = np.bincount(inverse, minlength=len(nodes))
+        matching = np.bincount(inverse, self.catMask(cats),
+                               minlength=len(nodes)).astype(np.int64)
+        return nodes, total, matching
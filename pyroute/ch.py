@@ -0,0 +1,319 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Contraction hierarchies: offline preprocessing and queries
+#
+#------------------------------------------------------
+# Usage:
+#   ch.py map.graph [transport ...]
+#     builds a hierarchy per transport and writes map.graph.ch
+#
+#   hierarchy = buildHierarchy(graph, 'car')
+#   cost, route = hierarchy.query(startIndex, endIndex)
+#
+# Nodes are contracted one at a time, least important first,
+# adding shortcut links wherever a shortest path ran through
+# the contracted node. A query is then a bidirectional Dijkstra
+# that only ever climbs to more important nodes, so it settles
+# a few hundred nodes instead of a whole city. Shortcuts
+# remember the node they skip, so routes unpack to the same
+# node lists the plain search returns.
+#------------------------------------------------------
+import sys
+import os
+import math
+import heapq
+import time
+import numpy as np
+from compiled import writeSections, readSections
+from stats import stats
+
+class Hierarchy:
+  """A contraction hierarchy for one form of transport.
+
+  Upward links (to a more important node) are stored as CSR arrays
+  per node; 'down' holds, for each node, the links which arrive at it
+  from a more important node, for the backward half of a query."""
+  def __init__(self, rank, up, down):
+    self.rank = rank
+    self.upOffsets, self.upTargets, self.upCosts, self.upMiddle = up
+    self.downOffsets, self.downSources, self.downCosts, self.downMiddle = down
+
+  def arrays(self):
+    return({'rank': self.rank,
+      'upOffsets': self.upOffsets, 'upTargets': self.upTargets,
+      'upCosts': self.upCosts, 'upMiddle': self.upMiddle,
+      'downOffsets': self.downOffsets, 'downSources': self.downSources,
+      'downCosts': self.downCosts, 'downMiddle': self.downMiddle})
+
+  def query(self, start, end):
+    """Shortest route between two dense node indices.
+    Returns (cost, [indices]), or (None, []) if there is no route."""
+    if start == end:
+      return((0.0, [start]))
+    started = stats.enabled and time.time()
+    heappush = heapq.heappush
+    heappop = heapq.heappop
+    up = (self.upOffsets.item, self.upTargets, self.upCosts, self.upMiddle)
+    down = (self.downOffsets.item, self.downSources, self.downCosts, self.downMiddle)
+    # Each direction climbs its own links, and looks down the other's
+    # to stall nodes reached more cheaply through a more important node
+    sides = ((up, down), (down, up))
+    best = ({start: 0.0}, {end: 0.0})
+    parent = ({start: None}, {end: None})
+    settled = (set(), set())
+    queues = ([(0.0, start)], [(0.0, end)])
+    shortest = float('inf')
+    meet = -1
+    stale = 0
+    while 1:
+      # Stop each direction once it can't improve on the best meeting
+      active = [side for side in (0, 1)
+                if queues[side] and queues[side][0][0] < shortest]
+      if not active:
+        break
+      if len(active) == 2:
+        side = int(queues[1][0][0] < queues[0][0][0])
+      else:
+        side = active[0]
+      distance, x = heappop(queues[side])
+      if x in settled[side]:
+        stale = stale + 1
+        continue
+      settled[side].add(x)
+      other = best[1 - side]
+      if x in other and distance + other[x] < shortest:
+        shortest = distance + other[x]
+        meet = x
+      mine = best[side]
+      (offset, neighbours, costs, middles), stall = sides[side]
+      first = stall[0](x)
+      last = stall[0](x + 1)
+      if first != last:
+        stalled = False
+        for y, cost in zip(stall[1][first:last].tolist(), stall[2][first:last].tolist()):
+          if y in mine and mine[y] + cost < distance:
+            stalled = True
+            break
+        if stalled:
+          continue
+      first = offset(x)
+      last = offset(x + 1)
+      if first == last:
+        continue
+      for y, cost, middle in zip(neighbours[first:last].tolist(),
+                                 costs[first:last].tolist(),
+                                 middles[first:last].tolist()):
+        newDistance = distance + cost
+        if newDistance < mine.get(y, newDistance + 1):
+          mine[y] = newDistance
+          parent[side][y] = (x, middle)
+          heappush(queues[side], (newDistance, y))
+    if started:
+      count = len(settled[0]) + len(settled[1])
+      stats.search('ch', time.time() - started,
+                   'success' if meet >= 0 else 'no_route', count,
+                   count + stale, count + stale + len(queues[0]) + len(queues[1]))
+    if meet < 0:
+      return((None, []))
+
+    # Chain of (possibly shortcut) links: start..meet, then meet..end
+    links = []
+    x = meet
+    while parent[0][x] is not None:
+      fr, middle = parent[0][x]
+      links.append((fr, x, middle))
+      x = fr
+    links.reverse()
+    x = meet
+    while parent[1][x] is not None:
+      to, middle = parent[1][x]
+      links.append((x, to, middle))
+      x = to
+    route = [start]
+    for link in links:
+      route.extend(self.unpack(*link))
+    return((shortest, route))
+
+  def unpack(self, fr, to, middle):
+    """Original nodes after fr along a (possibly shortcut) link"""
+    route = []
+    stack = [(fr, to, middle)]
+    while stack:
+      fr, to, middle = stack.pop()
+      if middle < 0:
+        route.append(to)
+      else:
+        # Expand the first half first: push the second half below it
+        stack.append((middle, to, self.middle(middle, to)))
+        stack.append((fr, middle, self.middle(fr, middle)))
+    return(route)
+
+  def middle(self, fr, to):
+    """The node a link fr->to skips (-1 for an original link)"""
+    if self.rank.item(to) > self.rank.item(fr):
+      first, last = self.upOffsets.item(fr), self.upOffsets.item(fr + 1)
+      nodes, middles = self.upTargets, self.upMiddle
+      wanted = to
+    else:
+      first, last = self.downOffsets.item(to), self.downOffsets.item(to + 1)
+      nodes, middles = self.downSources, self.downMiddle
+      wanted = fr
+    for i in xrange(first, last):
+      if nodes.item(i) == wanted:
+        return(middles.item(i))
+    raise KeyError((fr, to))
+
+def linkCosts(graph, routeType):
+  """(sources, targets, costs) of every link, costs as the Router sees
+  them (infinity for links which can't be used)"""
+  return(graph.sources(), graph.targets, graph.costs(routeType))
+
+class Contractor:
+  """Builds a Hierarchy by contracting nodes in order of importance"""
+  witnessLimit = 60   # nodes settled per witness search
+
+  def __init__(self, n, sources, targets, costs):
+    self.n = n
+    self.out = [{} for i in xrange(n)]  # node -> {to: (cost, middle)}
+    self.inc = [{} for i in xrange(n)]  # node -> {from: (cost, middle)}
+    for fr, to, cost in zip(sources.tolist(), targets.tolist(), costs.tolist()):
+      if fr != to and cost != float('inf'):
+        self.addLink(fr, to, cost, -1)
+    self.contracted = [False] * n
+    self.deleted = [0] * n  # contracted neighbours, spreads contraction out
+
+  def addLink(self, fr, to, cost, middle):
+    if cost < self.out[fr].get(to, (cost + 1,))[0]:
+      self.out[fr][to] = (cost, middle)
+      self.inc[to][fr] = (cost, middle)
+
+  def witness(self, source, skip, limit, wanted):
+    """Costs from source avoiding skip, up to limit (bounded search)"""
+    best = {source: 0.0}
+    settled = set()
+    queue = [(0.0, source)]
+    remaining = len(wanted)
+    while queue and len(settled) < self.witnessLimit:
+      distance, x = heapq.heappop(queue)
+      if x in settled:
+        continue
+      if distance > limit:
+        break
+      settled.add(x)
+      if x in wanted:
+        remaining = remaining - 1
+        if not remaining:
+          break
+      for y, (cost, middle) in self.out[x].iteritems():
+        if y == skip:
+          continue
+        newDistance = distance + cost
+        if newDistance <= limit and newDistance < best.get(y, newDistance + 1):
+          best[y] = newDistance
+          heapq.heappush(queue, (newDistance, y))
+    return(best)
+
+  def shortcuts(self, v):
+    """Shortcuts needed if v were contracted now: [(fr, to, cost)]"""
+    needed = []
+    outgoing = self.out[v].items()
+    for u, (costIn, middle) in self.inc[v].iteritems():
+      via = dict([(w, costIn + costOut) for w, (costOut, m) in outgoing if w != u])
+      if not via:
+        continue
+      found = self.witness(u, v, max(via.values()), via)
+      for w, cost in via.iteritems():
+        if found.get(w, cost + 1) > cost:
+          needed.append((u, w, cost))
+    return(needed)
+
+  def priority(self, v):
+    added = len(self.shortcuts(v))
+    removed = len(self.inc[v]) + len(self.out[v])
+    return(added - removed + self.deleted[v])
+
+  def contract(self):
+    rank = np.zeros(self.n, np.int32)
+    up = [None] * self.n
+    down = [None] * self.n
+    queue = [(self.priority(v), v) for v in xrange(self.n)]
+    heapq.heapify(queue)
+    order = 0
+    while queue:
+      priority, v = heapq.heappop(queue)
+      # Lazy update: priorities go stale as neighbours are contracted
+      current = self.priority(v)
+      if queue and current > queue[0][0]:
+        heapq.heappush(queue, (current, v))
+        continue
+      for fr, to, cost in self.shortcuts(v):
+        self.addLink(fr, to, cost, v)
+      # Everything still attached to v leads to a more important node
+      up[v] = self.out[v]
+      down[v] = self.inc[v]
+      for w in up[v]:
+        del self.inc[w][v]
+        self.deleted[w] = self.deleted[w] + 1
+      for u in down[v]:
+        del self.out[u][v]
+        self.deleted[u] = self.deleted[u] + 1
+      self.out[v] = self.inc[v] = None
+      self.contracted[v] = True
+      rank[v] = order
+      order = order + 1
+    return(Hierarchy(rank, packLinks(up), packLinks(down)))
+
+def packLinks(links):
+  """[{node: (cost, middle)}] per node -> CSR (offsets, nodes, costs, middles)"""
+  offsets = np.zeros(len(links) + 1, np.int64)
+  np.cumsum([len(l) for l in links], out=offsets[1:])
+  nodes = []
+  costs = []
+  middles = []
+  for l in links:
+    for node, (cost, middle) in sorted(l.items()):
+      nodes.append(node)
+      costs.append(cost)
+      middles.append(middle)
+  return((offsets, np.array(nodes, np.int32), np.array(costs, np.float64),
+          np.array(middles, np.int32)))
+
+def buildHierarchy(graph, routeType):
+  """Contract the graph's links for one form of transport"""
+  sources, targets, costs = linkCosts(graph, routeType)
+  return(Contractor(len(graph.ids), sources, targets, costs).contract())
+
+def saveHierarchies(filename, graph, hierarchies):
+  """Write {routeType: Hierarchy} for a graph to a compiled file"""
+  sections = {}
+  for routeType, hierarchy in hierarchies.items():
+    for name, array in hierarchy.arrays().items():
+      sections['%s/%s' % (routeType, name)] = array
+  writeSections(filename, sections,
+    {'routeTypes': sorted(hierarchies.keys()), 'graph': graph.fingerprint()})
+
+def loadHierarchies(filename, graph):
+  """Read hierarchies written by saveHierarchies, if they were built
+  from this graph; returns {} otherwise"""
+  sections, meta = readSections(filename)
+  if meta.get('graph') != graph.fingerprint():
+    print "Ignoring %s: it was built from a different graph" % filename
+    return({})
+  hierarchies = {}
+  for routeType in meta['routeTypes']:
+    get = lambda name: sections['%s/%s' % (routeType, name)]
+    hierarchies[routeType] = Hierarchy(get('rank'),
+      (get('upOffsets'), get('upTargets'), get('upCosts'), get('upMiddle')),
+      (get('downOffsets'), get('downSources'), get('downCosts'), get('downMiddle')))
+  return(hierarchies)
+
+if __name__ == "__main__":
+  from loadOsm import LoadOsm
+  data = LoadOsm(sys.argv[1])
+  routeTypes = sys.argv[2:] or [t for t in data.routeTypes if data.graph.numLinks(t)]
+  hierarchies = {}
+  for routeType in routeTypes:
+    print "Contracting %s..." % routeType
+    hierarchies[routeType] = buildHierarchy(data.graph, routeType)
+  saveHierarchies(sys.argv[1] + '.ch', data.graph, hierarchies)
+  print "Done"
@@ -0,0 +1,358 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Degree-2 chains of nodes collapsed into single links
+#
+#------------------------------------------------------
+# Usage:
+#   chains.py map.graph
+#     collapses the graph's chains and writes map.graph.chains
+#
+#   data.chains = buildChains(data.graph)
+#   result, route = Router(data).doRoute(node1, node2, 'car')
+#
+# Most nodes of a way only give it its shape: they join two links
+# and nothing else, yet a search settles every one of them. Here
+# each chain of such nodes becomes one link between the junctions
+# (or dead ends) at its ends, in each direction it can be
+# travelled, whose length is the chain's length along the road.
+# The searches run over that smaller graph (same node numbering,
+# so A* keeps its heuristic), and routes are expanded back to the
+# full list of nodes from the chains, which are kept in order.
+#
+# A node is only folded into a chain if the links either side of
+# it are alike: same access, way type and weights each way. The
+# collapsed link then weighs what each of its links did and costs
+# what they cost together, for every form of transport (one-way
+# chains only get a link the way they go). Chains which would
+# duplicate another link between the same two nodes are split.
+#
+# Routes may start or end inside a chain: the search is given
+# extra links between such a node and its chain's ends, costed by
+# how far along the chain it is.
+#------------------------------------------------------
+import sys
+import numpy as np
+from graph import RoutingGraph, graphSections, graphFromSections
+from compiled import writeSections, readSections
+
+class Chains:
+  """A graph with its chains collapsed, and the chains' nodes.
+
+  graph -- the collapsed RoutingGraph, over the same nodes as the
+    full one; nodes inside a chain have no links in it
+  head, tail -- int32[c], the nodes at each end of each chain
+  offsets, nodes -- CSR: chain k's inner nodes, from head to tail
+  along -- float64, each inner node's distance along its chain
+  length -- float64[c], the length of each chain
+  place -- int32[n], each node's entry in nodes, or -1 if it's kept
+  linkChain -- int32[m], the chain each link of graph stands for,
+    or -1 for links between kept nodes"""
+  def __init__(self, graph, head, tail, offsets, nodes, along, length,
+               place, linkChain):
+    self.graph = graph
+    self.head = head
+    self.tail = tail
+    self.offsets = offsets
+    self.nodes = nodes
+    self.along = along
+    self.length = length
+    self.place = place
+    self.linkChain = linkChain
+
+  def arrays(self):
+    return({'head': self.head, 'tail': self.tail, 'offsets': self.offsets,
+            'nodes': self.nodes, 'along': self.along, 'length': self.length,
+            'place': self.place, 'linkChain': self.linkChain})
+
+  def chainOf(self, x):
+    """The chain a node is inside, or -1"""
+    place = self.place.item(x)
+    if place < 0:
+      return(-1)
+    return(int(np.searchsorted(self.offsets, place, 'right')) - 1)
+
+  def position(self, chain, x):
+    """Where x is on a chain: -1 at its head, the number of inner
+    nodes at its tail"""
+    if x == self.head.item(chain):
+      return(-1)
+    if x == self.tail.item(chain):
+      return(self.offsets.item(chain + 1) - self.offsets.item(chain))
+    return(self.place.item(x) - self.offsets.item(chain))
+
+  def linkRow(self, fr, to):
+    """Row of the collapsed link from fr to to, or -1"""
+    graph = self.graph
+    first = graph.offsets.item(fr)
+    last = graph.offsets.item(fr + 1)
+    i = first + int(np.searchsorted(graph.targets[first:last], to))
+    if i < last and graph.targets.item(i) == to:
+      return(i)
+    return(-1)
+
+  def between(self, x, y):
+    """The nodes a step of a collapsed route from x to y passed"""
+    chain = self.chainOf(x)
+    if chain < 0:
+      chain = self.chainOf(y)
+    if chain < 0:
+      chain = self.linkChain.item(self.linkRow(x, y))
+      if chain < 0:
+        return([])
+    first = self.offsets.item(chain)
+    a = self.position(chain, x)
+    b = self.position(chain, y)
+    if a < b:
+      return(self.nodes[first + a + 1:first + b].tolist())
+    return(self.nodes[first + b + 1:first + a][::-1].tolist())
+
+  def expand(self, route):
+    """The full list of nodes of a route found on the collapsed graph"""
+    if not route:
+      return(route)
+    full = [route[0]]
+    for x, y in zip(route[:-1], route[1:]):
+      full.extend(self.between(x, y))
+      full.append(y)
+    return(full)
+
+  def extraLinks(self, start, end, routeType):
+    """Links for a search from start to end, where either is inside a
+    chain: ({fr: [(to, cost)]}, {to: [(fr, cost)]}), as they're
+    followed forwards and backwards"""
+    links = []
+    ends = [(x, self.chainOf(x)) for x in (start, end)]
+    for (x, chain), leaving in zip(ends, (True, False)):
+      if chain < 0:
+        continue
+      along = self.along.item(self.place.item(x))
+      head = self.head.item(chain)
+      tail = self.tail.item(chain)
+      toTail = self.length.item(chain) - along
+      forward = self.weight(head, tail, routeType)
+      backward = self.weight(tail, head, routeType)
+      if leaving:
+        if forward:
+          links.append((x, tail, toTail / forward))
+        if backward:
+          links.append((x, head, along / backward))
+      else:
+        if forward:
+          links.append((head, x, along / forward))
+        if backward:
+          links.append((tail, x, toTail / backward))
+    if ends[0][1] >= 0 and ends[0][1] == ends[1][1]:
+      # Both inside the same chain
+      chain = ends[0][1]
+      distance = self.along.item(self.place.item(end)) - \
+                 self.along.item(self.place.item(start))
+      if distance > 0:
+        weight = self.weight(self.head.item(chain), self.tail.item(chain), routeType)
+      else:
+        weight = self.weight(self.tail.item(chain), self.head.item(chain), routeType)
+      if weight:
+        links.append((start, end, abs(distance) / weight))
+    forward = {}
+    backward = {}
+    for fr, to, cost in links:
+      forward.setdefault(fr, []).append((to, cost))
+      backward.setdefault(to, []).append((fr, cost))
+    return((forward, backward))
+
+  def weight(self, fr, to, routeType):
+    """Weight of the collapsed link from fr to to for a form of
+    transport, or 0 if it can't be used"""
+    i = self.linkRow(fr, to)
+    if i < 0 or self.graph.costs(routeType).item(i) == float('inf'):
+      return(0)
+    return(float(self.graph.weights[routeType].item(i)))
+
+def findChains(inner, first, second, starts):
+  """Walk the chains: [(head, [inner nodes], tail)]. Chains start at
+  the (kept node, inner neighbour) pairs in starts; inner nodes left
+  over are on rings, and one node of each ring is kept instead (so
+  inner is updated)."""
+  chains = []
+  seen = set()
+  def walk(head, x):
+    nodes = []
+    previous = head
+    while inner[x]:
+      nodes.append(x)
+      seen.add(x)
+      following = first[x]
+      if following == previous:
+        following = second[x]
+      previous, x = x, following
+    chains.append((head, nodes, x))
+  for head, x in starts:
+    if not x in seen:
+      walk(head, x)
+  for x in xrange(len(inner)):
+    if inner[x] and not x in seen:
+      inner[x] = False
+      walk(x, first[x])
+  return(chains)
+
+def buildChains(graph):
+  """Collapse a RoutingGraph's chains; returns a Chains"""
+  n = len(graph.ids)
+  sources = graph.sources().astype(np.int64)
+  targets = graph.targets.astype(np.int64)
+  keys = sources * n + targets  # sorted, as links are
+  lengths = graph.lengths()
+  # Links with equal access, way type and weights get equal codes
+  table = np.column_stack([graph.access] +
+    [graph.linkTypeOf(t) for t in graph.transports] +
+    [graph.weights[t] for t in graph.transports]).astype(np.float64)
+  if len(keys):
+    code = np.unique(table, axis=0, return_inverse=True)[1]
+  else:
+    code = np.zeros(0, np.int64)
+  def rows(fr, to):
+    wanted = np.asarray(fr, np.int64) * n + to
+    i = np.searchsorted(keys, wanted)
+    i[i >= len(keys)] = 0
+    if not len(keys):
+      return(i - 1)
+    return(np.where(keys[i] == wanted, i, -1))
+  def codes(fr, to):
+    i = rows(fr, to)
+    return(np.where(i >= 0, code[np.maximum(i, 0)], -1))
+
+  # Each node's neighbours, whichever way the links go
+  loop = sources == targets
+  low = np.minimum(sources, targets)[~loop]
+  high = np.maximum(sources, targets)[~loop]
+  pairs = np.unique(low * n + high)
+  ends = np.r_[pairs // n, pairs % n]
+  others = np.r_[pairs % n, pairs // n]
+  order = np.argsort(ends, kind='mergesort')
+  ends, others = ends[order], others[order]
+  degree = np.bincount(ends, minlength=n)
+  firstNeighbour = np.searchsorted(ends, np.arange(n))
+  candidate = degree == 2
+  candidate[sources[loop]] = False
+  v = np.flatnonzero(candidate)
+  p = others[firstNeighbour[v]]
+  q = others[firstNeighbour[v] + 1]
+  alike = (codes(p, v) == codes(v, q)) & (codes(q, v) == codes(v, p))
+  inner = np.zeros(n, bool)
+  inner[v[alike]] = True
+  first = np.zeros(n, np.int64) - 1
+  second = np.zeros(n, np.int64) - 1
+  first[v] = p
+  second[v] = q
+  first = first.tolist()
+  second = second.tolist()
+
+  while True:
+    innerList = inner.tolist()
+    leaves = ~inner[ends] & inner[others]
+    chains = findChains(innerList, first, second,
+                        zip(ends[leaves].tolist(), others[leaves].tolist()))
+    inner = np.array(innerList, bool)
+    # Links between kept nodes stay as they are
+    plain = np.flatnonzero(~inner[sources] & ~inner[targets])
+    head = np.array([c[0] for c in chains], np.int64)
+    tail = np.array([c[2] for c in chains], np.int64)
+    firstInner = np.array([c[1][0] for c in chains], np.int64)
+    lastInner = np.array([c[1][-1] for c in chains], np.int64)
+    forwardRow = rows(head, firstInner)
+    backwardRow = rows(tail, lastInner)
+    linkKeys = np.r_[keys[plain], (head * n + tail)[forwardRow >= 0],
+                     (tail * n + head)[backwardRow >= 0]]
+    unique, counts = np.unique(linkKeys, return_counts=True)
+    clash = unique[counts > 1]
+    split = (head == tail) | np.in1d(head * n + tail, clash) | \
+            np.in1d(tail * n + head, clash)
+    if not split.any():
+      break
+    # Keep the middle node of those chains, splitting them in two
+    for k in np.flatnonzero(split).tolist():
+      nodes = chains[k][1]
+      inner[nodes[len(nodes) // 2]] = False
+
+  # The chains' nodes and lengths
+  chainOffsets = np.zeros(len(chains) + 1, np.int64)
+  np.cumsum([len(c[1]) for c in chains], out=chainOffsets[1:])
+  chainNodes = np.array([x for c in chains for x in c[1]], np.int64)
+  full = np.array([x for c in chains for x in [c[0]] + c[1] + [c[2]]], np.int64)
+  fullOffsets = chainOffsets + 2 * np.arange(len(chains) + 1)
+  dlat = np.diff(graph.lat[full])
+  dlon = np.diff(graph.lon[full])
+  steps = np.sqrt(dlat * dlat + dlon * dlon)
+  steps[fullOffsets[1:-1] - 1] = 0  # from one chain to the next
+  distance = np.r_[0.0, np.cumsum(steps)]
+  chainStart = distance[fullOffsets[:-1]]
+  length = distance[fullOffsets[1:] - 1] - chainStart
+  innerPosition = np.flatnonzero(np.in1d(np.arange(len(full)),
+    np.r_[fullOffsets[:-1], fullOffsets[1:] - 1], invert=True))
+  chainOfInner = np.repeat(np.arange(len(chains)), np.diff(chainOffsets))
+  along = distance[innerPosition] - chainStart[chainOfInner]
+  place = np.zeros(n, np.int32) - 1
+  place[chainNodes] = np.arange(len(chainNodes))
+
+  # The collapsed links: plain ones, then each chain's either way
+  forward = np.flatnonzero(forwardRow >= 0)
+  backward = np.flatnonzero(backwardRow >= 0)
+  linkRows = np.r_[plain, forwardRow[forward], backwardRow[backward]]
+  fr = np.r_[sources[plain], head[forward], tail[backward]]
+  to = np.r_[targets[plain], tail[forward], head[backward]]
+  linkLength = np.r_[lengths[plain], length[forward], length[backward]]
+  linkChain = np.r_[np.zeros(len(plain), np.int64) - 1, forward, backward]
+  order = np.lexsort((to, fr))
+  linkRows, fr, to = linkRows[order], fr[order], to[order]
+  collapsed = RoutingGraph(graph.ids, graph.lat, graph.lon)
+  collapsed.linkTypes = graph.linkTypes
+  collapsed.transports = list(graph.transports)
+  collapsed.offsets = np.zeros(n + 1, np.int64)
+  np.cumsum(np.bincount(fr, minlength=n), out=collapsed.offsets[1:])
+  collapsed.targets = to.astype(np.int32)
+  collapsed.access = graph.access[linkRows]
+  collapsed.linkType = graph.linkType[linkRows]
+  for routeType in graph.transports:
+    collapsed.weights[routeType] = graph.weights[routeType][linkRows]
+    if routeType in graph.linkTypeOverrides:
+      linkType = graph.linkTypeOf(routeType)[linkRows]
+      rows = np.flatnonzero(linkType != collapsed.linkType)
+      collapsed.linkTypeOverrides[routeType] = (rows, linkType[rows])
+  collapsed.setLengths(linkLength[order])
+  return(Chains(collapsed, head.astype(np.int32), tail.astype(np.int32),
+    chainOffsets, chainNodes.astype(np.int32), along, length, place,
+    linkChain[order].astype(np.int32)))
+
+def saveChains(filename, graph, chains):
+  """Write the Chains built from a graph to a compiled file"""
+  sections, meta = graphSections(chains.graph)
+  for name in ('ids', 'lat', 'lon'):
+    del sections[name]  # the full graph's
+  for name, array in chains.arrays().items():
+    sections['chain/' + name] = array
+  meta['graph'] = graph.fingerprint()
+  writeSections(filename, sections, meta)
+
+def loadChains(filename, graph):
+  """Read Chains written by saveChains, if they were built from this
+  graph; returns None otherwise"""
+  sections, meta = readSections(filename)
+  if meta.get('graph') != graph.fingerprint():
+    print "Ignoring %s: it was built from a different graph" % filename
+    return(None)
+  sections = dict(sections, ids=graph.ids, lat=graph.lat, lon=graph.lon)
+  get = lambda name: sections['chain/' + name]
+  return(Chains(graphFromSections(sections, meta), get('head'), get('tail'),
+    get('offsets'), get('nodes'), get('along'), get('length'), get('place'),
+    get('linkChain')))
+
+if __name__ == "__main__":
+  from loadOsm import LoadOsm
+  data = LoadOsm(sys.argv[1])
+  print "Collapsing chains..."
+  chains = buildChains(data.graph)
+  graph = data.graph
+  print "%d links between %d nodes, down from %d between %d" % (
+    len(chains.graph.targets), len(np.unique(chains.graph.sources())),
+    len(graph.targets), len(np.unique(graph.sources())))
+  saveChains(sys.argv[1] + '.chains', data.graph, chains)
+  print "Done"
@@ -0,0 +1,146 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Compiled (binary) graph files
+#
+#------------------------------------------------------
+# Usage:
+#   writeSections('data/map.graph', {'ids': ids, ...}, meta)
+#   sections, meta = readSections('data/map.graph')
+#
+# Layout (all little-endian, whatever the platform):
+#   header   magic, version, byte-order mark, section count,
+#            CRC32 of the section table, CRC32 of the payload
+#   table    one entry per section: name, numpy dtype, offset, count
+#   payload  the raw arrays, each aligned to 64 bytes
+#
+# Reading maps the file and returns zero-copy numpy views onto
+# it, so opening a graph costs milliseconds and processes that
+# open the same file share its pages.
+#------------------------------------------------------
+import json
+import mmap
+import struct
+import zlib
+import numpy as np
+
+MAGIC = 'PYRGRAPH'
+VERSION = 1
+BYTE_ORDER = 0x01020304
+HEADER = struct.Struct('<8sIIIII')   # magic, version, order, sections, tableCrc, dataCrc
+ENTRY = struct.Struct('<32s8sQQ')    # name, dtype, offset, count
+ALIGN = 64
+
+class CompiledGraphError(Exception):
+  pass
+
+def isCompiled(filename):
+  """Does filename look like a compiled graph?"""
+  try:
+    f = open(filename, 'rb')
+  except IOError:
+    return(False)
+  try:
+    return(f.read(len(MAGIC)) == MAGIC)
+  finally:
+    f.close()
+
+def crc(data, value=0):
+  return(zlib.crc32(data, value) & 0xffffffff)
+
+def aligned(n):
+  return((n + ALIGN - 1) // ALIGN * ALIGN)
+
+def packStrings(strings):
+  """Encode a list of strings as (int64 offsets, uint8 UTF-8 data)"""
+  encoded = []
+  for s in strings:
+    if isinstance(s, unicode):
+      s = s.encode('utf-8')
+    encoded.append(s)
+  offsets = np.zeros(len(encoded) + 1, np.int64)
+  np.cumsum([len(s) for s in encoded], out=offsets[1:])
+  return(offsets, np.frombuffer(''.join(encoded), np.uint8))
+
+def unpackStrings(offsets, data):
+  """Decode packStrings() output back into a list of unicode strings"""
+  data = data.tostring()
+  offsets = offsets.tolist()
+  return([data[offsets[i]:offsets[i + 1]].decode('utf-8')
+          for i in xrange(len(offsets) - 1)])
+
+def writeSections(filename, sections, meta=None):
+  """Write named numpy arrays (plus a JSON-able meta dict) to filename"""
+  sections = dict(sections)
+  sections['meta'] = np.frombuffer(json.dumps(meta or {}), np.uint8)
+  names = sorted(sections.keys())
+  arrays = []
+  for name in names:
+    if len(name) > 32:
+      raise CompiledGraphError("Section name too long: %s" % name)
+    array = np.asarray(sections[name])
+    array = np.ascontiguousarray(array.astype(array.dtype.newbyteorder('<'), copy=False))
+    arrays.append(array)
+
+  table = ''
+  offset = aligned(HEADER.size + ENTRY.size * len(names))
+  for name, array in zip(names, arrays):
+    table = table + ENTRY.pack(name, array.dtype.str, offset, len(array))
+    offset = aligned(offset + array.nbytes)
+
+  f = open(filename, 'wb')
+  try:
+    f.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDER, len(names), 0, 0))
+    f.write(table)
+    dataCrc = 0
+    position = HEADER.size + len(table)
+    for array in arrays:
+      padding = '\0' * (aligned(position) - position)
+      f.write(padding)
+      dataCrc = crc(padding, dataCrc)
+      f.write(buffer(array))
+      dataCrc = crc(buffer(array), dataCrc)
+      position = aligned(position) + array.nbytes
+    f.seek(0)
+    f.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDER, len(names),
+                        crc(table), dataCrc))
+  finally:
+    f.close()
+
+def readSections(filename, verify=False):
+  """Map a compiled file; returns ({name: array view}, meta).
+  verify -- also check the payload checksum (reads the whole file)"""
+  f = open(filename, 'rb')
+  try:
+    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+  finally:
+    f.close()
+  if len(mapped) < HEADER.size:
+    raise CompiledGraphError("%s is too short to be a compiled graph" % filename)
+  magic, version, order, count, tableCrc, dataCrc = HEADER.unpack(mapped[:HEADER.size])
+  if magic != MAGIC:
+    raise CompiledGraphError("%s is not a compiled graph" % filename)
+  if order != BYTE_ORDER:
+    raise CompiledGraphError("%s has an unknown byte order" % filename)
+  if version != VERSION:
+    raise CompiledGraphError("%s is version %d, expected %d" % (filename, version, VERSION))
+  table = mapped[HEADER.size:HEADER.size + ENTRY.size * count]
+  if crc(table) != tableCrc:
+    raise CompiledGraphError("%s has a corrupt section table" % filename)
+  if verify:
+    start = HEADER.size + len(table)
+    if crc(buffer(mapped, start)) != dataCrc:
+      raise CompiledGraphError("%s fails its checksum" % filename)
+
+  sections = {}
+  for i in range(count):
+    name, dtype, offset, length = ENTRY.unpack_from(table, i * ENTRY.size)
+    name = name.rstrip('\0')
+    dtype = np.dtype(dtype.rstrip('\0'))
+    if offset + length * dtype.itemsize > len(mapped):
+      raise CompiledGraphError("%s is truncated" % filename)
+    if length:
+      sections[name] = np.frombuffer(mapped, dtype, length, offset)
+    else:
+      sections[name] = np.zeros(0, dtype)
+  meta = json.loads(sections.pop('meta').tostring())
+  return(sections, meta)
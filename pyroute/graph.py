@@ -0,0 +1,674 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Compact, array-backed routing graph
+#
+#------------------------------------------------------
+# Usage:
+#   graph = buildGraph(nodeIds, lats, lons, links)
+#   i = graph.index(osmId)
+#   for j, w in graph.links(i, 'car'): ...
+#   cost, parent, stale, queued = graph.dijkstra(i, 'car', budget=0.01)
+#
+# Nodes are renumbered to dense int32 indices in OSM id order.
+# All forms of transport share one CSR table of physical links:
+# those leaving node i are targets[offsets[i]:offsets[i+1]]. Each
+# link has an access bitmask, with a bit per form of transport
+# (in the order of transports) that may use it, and each form of
+# transport has a weight column over all the links (0 where it
+# has no access). Every link also records the type of way it came
+# from (linkType), so weights can be recomputed for a new routing
+# profile; where two ways join the same pair of nodes for different
+# forms of transport, those whose way type differs from the link's
+# keep their own (linkTypeOverrides). Its cost for each form of transport (length /
+# weight, infinite where the access bit is clear) is kept in an
+# array built once per form of transport, as are its strongly
+# connected components, which rule out routes between nodes that
+# can't reach each other without searching. dijkstra() searches
+# the graph itself, so Router and anything holding an older graph
+# (PathCache and the reroute table, after a change) share it.
+#------------------------------------------------------
+import heapq
+import zlib
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, breadth_first_order
+
+class Column:
+  """Append-only buffer packing values into numpy chunks of one dtype"""
+  def __init__(self, dtype, chunk=65536):
+    self.dtype = dtype
+    self.chunk = chunk
+    self.chunks = []
+    self.pending = []
+    self.length = 0
+
+  def append(self, value):
+    self.pending.append(value)
+    self.length = self.length + 1
+    if len(self.pending) >= self.chunk:
+      self.flush()
+
+  def extend(self, values):
+    for value in values:
+      self.append(value)
+
+  def appendArray(self, values):
+    """Append a whole array of values at once"""
+    self.flush()
+    values = np.asarray(values, self.dtype)
+    if len(values):
+      self.chunks.append(values)
+      self.length = self.length + len(values)
+
+  def flush(self):
+    if self.pending:
+      self.chunks.append(np.array(self.pending, self.dtype))
+      self.pending = []
+
+  def array(self):
+    """Return everything appended so far as one numpy array"""
+    self.flush()
+    if not self.chunks:
+      return(np.zeros(0, self.dtype))
+    if len(self.chunks) > 1:
+      self.chunks = [np.concatenate(self.chunks)]
+    return(self.chunks[0])
+
+  def __len__(self):
+    return(self.length)
+
+class RoutingGraph:
+  """Routing graph stored as flat numpy arrays"""
+  def __init__(self, ids, lat, lon):
+    self.ids = ids      # int64 OSM ids, sorted; position = dense index
+    self.lat = lat      # float64
+    self.lon = lon      # float64
+    self.offsets = np.zeros(len(ids) + 1, np.int64)
+    self.targets = np.zeros(0, np.int32)
+    self.access = np.zeros(0, np.uint16)   # bit per entry of transports
+    self.linkType = np.zeros(0, np.uint16)  # index into linkTypes
+    self.transports = [] # routeType of each access bit
+    self.weights = {}   # routeType -> float32[m], 0 where there's no access
+    self.linkTypes = [] # names of the way types links came from
+    self.linkTypeOverrides = {} # routeType -> (rows, linkType) where it differs
+    self.linkLength = None # float64[m] if links aren't straight lines
+    self.routeableCache = {}
+    self.maskCache = {}
+    self.reverseCache = {}
+    self.lengthCache = None
+    self.costCache = {}
+    self.componentCache = {}
+    self.fingerprintValue = None
+
+  def __len__(self):
+    return(len(self.ids))
+
+  def index(self, id):
+    """Dense index of an OSM node id, or -1 if it isn't in the graph"""
+    i = int(np.searchsorted(self.ids, id))
+    if i < len(self.ids) and self.ids[i] == id:
+      return(i)
+    return(-1)
+
+  def indices(self, ids):
+    """Vectorised index(): dense indices of an array of OSM ids (-1 if unknown)"""
+    ids = np.asarray(ids, np.int64)
+    if not len(self.ids):
+      return(np.zeros(len(ids), np.int32) - 1)
+    i = np.searchsorted(self.ids, ids)
+    i[i >= len(self.ids)] = 0
+    i[self.ids[i] != ids] = -1
+    return(i.astype(np.int32))
+
+  def setLinks(self, links):
+    """Build the shared link table from every form of transport's links.
+
+    links -- {routeType: (fr, to, weight, linkType)}, fr and to being
+      dense indices and linkType indices into linkTypes
+    A form of transport's repeated links keep their first weight; a
+    link shared by several keeps the way type the first of them (by
+    name) gave it, and the others their own where it differs."""
+    routeTypes = sorted(links.keys())
+    if len(routeTypes) > 16:
+      raise ValueError("At most 16 forms of transport, not %d" % len(routeTypes))
+    columns = [[], [], [], [], []]
+    for bit, routeType in enumerate(routeTypes):
+      fr, to, weight, linkType = links[routeType]
+      for column, values, dtype in zip(columns, (fr, to, weight, linkType),
+                                       (np.int64, np.int64, np.float32, np.uint16)):
+        column.append(np.asarray(values, dtype))
+      columns[4].append(np.zeros(len(columns[0][-1]), np.int64) + bit)
+    fr, to, weight, linkType, bits = [
+      np.concatenate(column) if column else np.zeros(0, np.int64)
+      for column in columns]
+    # lexsort is stable, so the first of any duplicate links comes first
+    order = np.lexsort((bits, to, fr))
+    fr, to, weight, linkType, bits = fr[order], to[order], weight[order], \
+                                     linkType[order], bits[order]
+    if len(fr):
+      keep = np.ones(len(fr), bool)
+      keep[1:] = (fr[1:] != fr[:-1]) | (to[1:] != to[:-1]) | (bits[1:] != bits[:-1])
+      fr, to, weight, linkType, bits = fr[keep], to[keep], weight[keep], \
+                                       linkType[keep], bits[keep]
+    # One row per pair of nodes, with a bit for each form of transport
+    pair = np.ones(len(fr), bool)
+    pair[1:] = (fr[1:] != fr[:-1]) | (to[1:] != to[:-1])
+    row = np.cumsum(pair) - 1
+    m = int(np.count_nonzero(pair))
+    self.access = np.bincount(row, np.left_shift(1, bits),
+                              minlength=m).astype(np.uint16)
+    self.targets = to[pair].astype(np.int32)
+    self.linkType = linkType[pair]
+    self.offsets = np.zeros(len(self.ids) + 1, np.int64)
+    np.cumsum(np.bincount(fr[pair], minlength=len(self.ids)), out=self.offsets[1:])
+    self.linkLength = None
+    self.transports = routeTypes
+    self.weights = {}
+    self.linkTypeOverrides = {}
+    for bit, routeType in enumerate(routeTypes):
+      weights = np.zeros(m, np.float32)
+      mine = bits == bit
+      weights[row[mine]] = weight[mine]
+      self.weights[routeType] = weights
+      differs = linkType[mine] != self.linkType[row[mine]]
+      if differs.any():
+        self.linkTypeOverrides[routeType] = (row[mine][differs],
+                                             linkType[mine][differs])
+    self.changed()
+
+  def changed(self):
+    """Forget everything derived from the links"""
+    self.routeableCache = {}
+    self.maskCache = {}
+    self.reverseCache = {}
+    self.lengthCache = None
+    self.costCache = {}
+    self.componentCache = {}
+    self.fingerprintValue = None
+
+  def addTransport(self, routeType, weight, usable=None, linkType=None):
+    """Add (or replace) a form of transport over the existing links.
+    weight -- float32[m], one per link
+    usable -- bool[m], the links it may use (default: weight > 0)
+    linkType -- uint16[m], the way type of each link for it (default:
+      the shared linkType), e.g. linkTypeOf() the transport it's based on"""
+    weight = np.asarray(weight, np.float32)
+    if len(weight) != len(self.targets):
+      raise ValueError("Expected %d %s weights, got %d" % (
+        len(self.targets), routeType, len(weight)))
+    if usable is None:
+      usable = weight > 0
+    if not routeType in self.transports:
+      if len(self.transports) >= 16:
+        raise ValueError("No room for another form of transport")
+      self.transports.append(routeType)
+    bit = np.uint16(1 << self.transports.index(routeType))
+    self.access = np.where(usable, self.access | bit, self.access & ~bit).astype(np.uint16)
+    self.weights[routeType] = np.where(usable, weight, 0).astype(np.float32)
+    self.linkTypeOverrides.pop(routeType, None)
+    if linkType is not None:
+      differs = np.flatnonzero(usable & (linkType != self.linkType))
+      if len(differs):
+        self.linkTypeOverrides[routeType] = (differs, np.asarray(linkType)[differs])
+    self.routeableCache.pop(routeType, None)
+    self.maskCache.pop(routeType, None)
+    self.costCache.pop(routeType, None)
+    self.componentCache.pop(routeType, None)
+    self.reverseCache.pop(routeType, None)
+    self.fingerprintValue = None
+
+  def setWeights(self, routeType, weight):
+    """Replace the weights of a form of transport's links (same links,
+    same order), e.g. with profileWeights() for a new profile"""
+    weight = np.asarray(weight, np.float32)
+    if len(weight) != len(self.targets):
+      raise ValueError("Expected %d %s weights, got %d" % (
+        len(self.targets), routeType, len(weight)))
+    self.weights[routeType] = np.where(self.mask(routeType), weight, 0).astype(np.float32)
+    self.costCache.pop(routeType, None)
+    self.componentCache.pop(routeType, None)
+    self.reverseCache.pop(routeType, None)
+    self.fingerprintValue = None
+
+  def mask(self, routeType):
+    """Which links a form of transport may use, from the access bits"""
+    try:
+      return(self.maskCache[routeType])
+    except KeyError:
+      bit = 1 << self.transports.index(routeType)
+      mask = (self.access & bit) != 0
+      self.maskCache[routeType] = mask
+      return(mask)
+
+  def linkTypeOf(self, routeType):
+    """The way type (index into linkTypes) of each link, as a form of
+    transport's own ways gave it"""
+    if not routeType in self.linkTypeOverrides:
+      return(self.linkType)
+    rows, linkType = self.linkTypeOverrides[routeType]
+    mine = self.linkType.copy()
+    mine[rows] = linkType
+    return(mine)
+
+  def profileWeights(self, routeType, weightings):
+    """Weight of each link under a profile, given as {wayType: weight}
+    (way types it doesn't mention weigh 0), or 0 where routeType has
+    no access"""
+    table = np.array([weightings.get(t, 0) for t in self.linkTypes] or [0],
+                     np.float32)
+    return(np.where(self.mask(routeType), table[self.linkTypeOf(routeType)],
+                    0).astype(np.float32))
+
+  def sources(self):
+    """Dense index of the node each link leaves"""
+    return(np.repeat(np.arange(len(self.ids), dtype=np.int32), np.diff(self.offsets)))
+
+  def setLengths(self, lengths):
+    """Give the links lengths other than the straight line between
+    their ends (e.g. links standing for a whole chain of others)"""
+    lengths = np.asarray(lengths, np.float64)
+    if len(lengths) != len(self.targets):
+      raise ValueError("Expected %d lengths, got %d" % (
+        len(self.targets), len(lengths)))
+    self.changed()
+    self.linkLength = lengths
+
+  def lengths(self):
+    """Length of every link (in degrees, as elsewhere): a straight
+    line unless setLengths said otherwise"""
+    if self.linkLength is not None:
+      return(self.linkLength)
+    if self.lengthCache is None:
+      sources = self.sources()
+      dlat = self.lat[self.targets] - self.lat[sources]
+      dlon = self.lon[self.targets] - self.lon[sources]
+      self.lengthCache = np.sqrt(dlat * dlat + dlon * dlon)
+    return(self.lengthCache)
+
+  def costs(self, routeType):
+    """Cost of every link: length / weight, or infinity where the
+    weight is zero or the access bit is clear (the link can't be used).
+    Searches walk the shared links and pass over the infinite ones."""
+    try:
+      return(self.costCache[routeType])
+    except KeyError:
+      weights = self.weights[routeType].astype(np.float64)
+      usable = (weights > 0) & self.mask(routeType)
+      costs = np.empty(len(weights))
+      costs[usable] = self.lengths()[usable] / weights[usable]
+      costs[~usable] = np.inf
+      self.costCache[routeType] = costs
+      return(costs)
+
+  def costScale(self, routeType):
+    """Smallest cost per unit of length of any usable link, so that
+    scale * straight-line distance never overestimates a route's cost"""
+    weights = self.weights[routeType]
+    if not len(weights) or weights.max() <= 0:
+      return(0)
+    return(1.0 / float(weights.max()))
+
+  def links(self, i, routeType):
+    """List of (index, weight) pairs for routeType's links leaving node i"""
+    s = self.offsets.item(i)
+    e = self.offsets.item(i + 1)
+    mine = self.mask(routeType)[s:e]
+    return(zip(self.targets[s:e][mine].tolist(),
+               self.weights[routeType][s:e][mine].tolist()))
+
+  def degree(self, i, routeType):
+    return(int(np.count_nonzero(
+      self.mask(routeType)[self.offsets.item(i):self.offsets.item(i + 1)])))
+
+  def routeable(self, routeType):
+    """Dense indices of nodes which have a route leading from them"""
+    try:
+      return(self.routeableCache[routeType])
+    except KeyError:
+      nodes = np.unique(self.sources()[self.mask(routeType)]).astype(np.int32)
+      self.routeableCache[routeType] = nodes
+      return(nodes)
+
+  def reverse(self, routeType):
+    """CSR adjacency of the reversed links, as (offsets, sources, costs):
+    the links arriving at node i come from sources[offsets[i]:offsets[i+1]]"""
+    try:
+      return(self.reverseCache[routeType])
+    except KeyError:
+      order = self.reverseCache.get(None)
+      if order is None:
+        # The same for every form of transport; only the costs differ
+        order = np.argsort(self.targets, kind='mergesort')
+        reverseOffsets = np.zeros(len(self.ids) + 1, np.int64)
+        np.cumsum(np.bincount(self.targets, minlength=len(self.ids)),
+                  out=reverseOffsets[1:])
+        order = self.reverseCache[None] = (order, reverseOffsets,
+                                           self.sources()[order])
+      order, reverseOffsets, sources = order
+      reverse = (reverseOffsets, sources, self.costs(routeType)[order])
+      self.reverseCache[routeType] = reverse
+      return(reverse)
+
+  def dijkstra(self, source, routeType, targets=(), reverse=False, budget=None):
+    """Dijkstra from a dense node index, following links backwards if
+    reverse is set. Stops as soon as every index in targets is settled
+    (or explores everything reachable if targets is empty), and never
+    settles nodes costing more than budget to reach. source may also
+    be {index: cost} to start from several nodes at once, each at a
+    cost of its own: then a node's cost is that of the cheapest route
+    from any of them. Returns (cost, parent, stale, queued): dicts of
+    the settled nodes' costs and the node before each on its route (-1
+    for a source), and how many queue entries were found settled
+    already or left over."""
+    if reverse:
+      offsets, neighbours, costs = self.reverse(routeType)
+    else:
+      offsets = self.offsets
+      neighbours = self.targets
+      costs = self.costs(routeType)
+    offset = offsets.item
+    heappush = heapq.heappush
+    heappop = heapq.heappop
+
+    if not isinstance(source, dict):
+      source = {source: 0.0}
+    remaining = set(targets)
+    best = dict(source)
+    parent = dict.fromkeys(source, -1)
+    settled = {}
+    queue = sorted([(cost, x) for x, cost in source.items()])
+    stale = 0
+    while queue:
+      distance, x = heappop(queue)
+      if x in settled:
+        stale = stale + 1
+        continue
+      if budget is not None and distance > budget:
+        break
+      settled[x] = distance
+      if remaining:
+        remaining.discard(x)
+        if not remaining:
+          break
+      first = offset(x)
+      last = offset(x + 1)
+      if first == last:
+        continue
+      for i, cost in zip(neighbours[first:last].tolist(), costs[first:last].tolist()):
+        if i in settled:
+          continue
+        newDistance = distance + cost
+        if newDistance < best.get(i, newDistance + 1):
+          best[i] = newDistance
+          parent[i] = x
+          heappush(queue, (newDistance, i))
+    return(settled, dict([(x, parent[x]) for x in settled]), stale, len(queue))
+
+  def components(self, routeType):
+    """The Components of routeType's usable links (found on first use)"""
+    try:
+      return(self.componentCache[routeType])
+    except KeyError:
+      usable = np.isfinite(self.costs(routeType))
+      sources = self.sources()[usable]
+      targets = self.targets[usable]
+      n = len(self.ids)
+      matrix = csr_matrix((np.ones(len(sources), np.int8), (sources, targets)),
+                          shape=(n, n))
+      count, strong = connected_components(matrix, True, 'strong')
+      weak = connected_components(matrix, True, 'weak')[1]
+      # Number them by size, so that the main component is 0
+      bySize = np.argsort(-np.bincount(strong, minlength=count), kind='mergesort')
+      number = np.zeros(count, np.int32)
+      number[bySize] = np.arange(count)
+      strong = number[strong]
+      crossing = strong[sources] != strong[targets]
+      fr = strong[sources[crossing]]
+      to = strong[targets[crossing]]
+      leaves = np.zeros(count, bool)
+      leaves[fr] = True
+      enters = np.zeros(count, bool)
+      enters[to] = True
+      # Which components the main one leads to, and which lead to it
+      between = csr_matrix((np.ones(len(fr), np.int8), (fr, to)),
+                           shape=(count, count))
+      fromMain = np.zeros(count, bool)
+      toMain = np.zeros(count, bool)
+      if count:
+        fromMain[breadth_first_order(between, 0, True, False)] = True
+        toMain[breadth_first_order(between.T.tocsr(), 0, True, False)] = True
+      components = Components(strong, weak.astype(np.int32), leaves, enters,
+                              fromMain, toMain)
+      self.componentCache[routeType] = components
+      return(components)
+
+  def fingerprint(self):
+    """Checksum of the nodes and links, identifying this exact graph
+    (e.g. to check that derived data was built from it)"""
+    if self.fingerprintValue is None:
+      value = 0
+      arrays = [self.ids, self.lat, self.lon, self.offsets, self.targets]
+      for routeType in sorted(self.weights.keys()):
+        arrays.extend((self.mask(routeType), self.weights[routeType]))
+      if self.linkLength is not None:
+        arrays.append(self.linkLength)
+      for array in arrays:
+        value = zlib.crc32(buffer(np.ascontiguousarray(array)), value)
+      self.fingerprintValue = "%08x-%d" % (value & 0xffffffff, len(self.ids))
+    return(self.fingerprintValue)
+
+  def numLinks(self, routeType):
+    return(int(np.count_nonzero(self.mask(routeType))))
+
+class Components:
+  """Strongly connected components of a form of transport's links:
+  within one, every node can reach every other.
+
+  strong -- int32[n], each node's component, numbered by size from
+    the largest (0, the main component) down
+  weak -- int32[n], each node's weakly connected component (linked
+    to each other whichever way the links go)
+  leaves, enters -- bool[c], whether any link leaves or enters each
+    strong component
+  fromMain, toMain -- bool[c], whether each can be reached from the
+    main component, and whether it leads to it"""
+  def __init__(self, strong, weak, leaves, enters, fromMain, toMain):
+    self.strong = strong
+    self.weak = weak
+    self.leaves = leaves
+    self.enters = enters
+    self.fromMain = fromMain
+    self.toMain = toMain
+
+  def main(self):
+    """Whether each node is in the main component"""
+    return(self.strong == 0)
+
+  def unreachable(self, start, end):
+    """True if no route leads from start to end (dense indices): they
+    aren't linked at all, start's component has no way out or end's
+    no way in, or one is in the main component and the other's can't
+    be reached from it (or doesn't lead to it). Otherwise a route may
+    still not exist, between components only a search can tell apart."""
+    a = self.strong.item(start)
+    b = self.strong.item(end)
+    if a == b:
+      return(False)
+    return(self.weak.item(start) != self.weak.item(end) or
+           not self.leaves.item(a) or not self.enters.item(b) or
+           (a == 0 and not self.fromMain.item(b)) or
+           (b == 0 and not self.toMain.item(a)))
+
+  def arrays(self):
+    return({'strong': self.strong, 'weak': self.weak,
+            'leaves': self.leaves, 'enters': self.enters,
+            'fromMain': self.fromMain, 'toMain': self.toMain})
+
+def buildGraph(nodeIds, lats, lons, links, linkTypes=()):
+  """Build a RoutingGraph from parsed data.
+
+  nodeIds, lats, lons -- parallel arrays, one entry per node
+  links -- {routeType: (fr, to, weight, linkType)} arrays of OSM ids,
+    weights and indices into linkTypes (the way type names)
+  Links to or from nodes that were never defined are dropped."""
+  nodeIds = np.asarray(nodeIds, np.int64)
+  ids, first = np.unique(nodeIds, return_index=True)
+  graph = RoutingGraph(ids,
+    np.asarray(lats, np.float64)[first],
+    np.asarray(lons, np.float64)[first])
+  graph.linkTypes = list(linkTypes)
+  graph.undefined = 0
+  known = {}
+  for routeType, (fr, to, weight, linkType) in links.items():
+    fr = graph.indices(fr)
+    to = graph.indices(to)
+    ok = (fr >= 0) & (to >= 0)
+    graph.undefined = graph.undefined + int(len(ok) - np.count_nonzero(ok))
+    known[routeType] = (fr[ok], to[ok], np.asarray(weight, np.float32)[ok],
+                        np.asarray(linkType, np.uint16)[ok])
+  graph.setLinks(known)
+  return(graph)
+
+def graphSections(graph):
+  """Arrays and metadata describing a graph, for compiled.writeSections"""
+  targets = graph.targets
+  if len(targets) and (targets.min() < 0 or targets.max() >= len(graph.ids)):
+    raise ValueError("Links refer to unknown nodes")
+  sections = {'ids': graph.ids, 'lat': graph.lat, 'lon': graph.lon,
+              'offsets': graph.offsets, 'targets': targets,
+              'access': graph.access, 'linkType': graph.linkType}
+  for routeType in graph.transports:
+    sections['weights/' + str(routeType)] = graph.weights[routeType]
+  for routeType, (rows, linkType) in graph.linkTypeOverrides.items():
+    sections['typeRows/' + str(routeType)] = rows
+    sections['types/' + str(routeType)] = linkType
+  if graph.linkLength is not None:
+    sections['linkLength'] = graph.linkLength
+  return(sections, {'routeTypes': list(graph.transports),
+                    'linkTypes': graph.linkTypes})
+
+def graphFromSections(sections, meta):
+  """Rebuild a RoutingGraph around arrays read by compiled.readSections"""
+  graph = RoutingGraph(sections['ids'], sections['lat'], sections['lon'])
+  graph.undefined = 0
+  graph.linkTypes = meta.get('linkTypes', [])
+  if 'access' in sections:
+    graph.offsets = sections['offsets']
+    graph.targets = sections['targets']
+    graph.access = sections['access']
+    graph.linkType = sections['linkType']
+    graph.transports = list(meta['routeTypes'])
+    for routeType in graph.transports:
+      graph.weights[routeType] = sections['weights/' + routeType]
+      if 'typeRows/' + routeType in sections:
+        graph.linkTypeOverrides[routeType] = (sections['typeRows/' + routeType],
+                                              sections['types/' + routeType])
+    graph.linkLength = sections.get('linkLength')
+    return(graph)
+  # Graphs compiled with a separate table per form of transport
+  links = {}
+  for routeType in meta['routeTypes']:
+    offsets = sections['offsets/' + routeType]
+    targets = sections['targets/' + routeType]
+    # Graphs compiled before link types were kept can't change profile
+    linkType = sections.get('linkType/' + routeType,
+                            np.zeros(len(targets), np.uint8))
+    links[routeType] = (np.repeat(np.arange(len(graph.ids)), np.diff(offsets)),
+      targets, sections['weights/' + routeType], linkType)
+  graph.setLinks(links)
+  return(graph)
+
+class NodesView:
+  """Read-only dict-like view of a graph's nodes: OSM id -> (lat, lon)"""
+  def __init__(self, graph):
+    self.graph = graph
+
+  def __getitem__(self, id):
+    i = self.graph.index(id)
+    if i < 0:
+      raise KeyError(id)
+    return((self.graph.lat.item(i), self.graph.lon.item(i)))
+
+  def __contains__(self, id):
+    return(self.graph.index(id) >= 0)
+
+  def __len__(self):
+    return(len(self.graph.ids))
+
+  def __iter__(self):
+    return(iter(self.keys()))
+
+  def get(self, id, default=None):
+    try:
+      return(self[id])
+    except KeyError:
+      return(default)
+
+  def keys(self):
+    return(self.graph.ids.tolist())
+
+  def values(self):
+    return(zip(self.graph.lat.tolist(), self.graph.lon.tolist()))
+
+  def items(self):
+    return(zip(self.keys(), self.values()))
+
+class LinksView:
+  """Read-only dict-like view of one form of transport: fr -> {to: weight}"""
+  def __init__(self, graph, routeType):
+    self.graph = graph
+    self.routeType = routeType
+
+  def __getitem__(self, fr):
+    i = self.graph.index(fr)
+    if i < 0 or not self.graph.degree(i, self.routeType):
+      raise KeyError(fr)
+    ids = self.graph.ids
+    return(dict([(ids.item(j), w) for j, w in self.graph.links(i, self.routeType)]))
+
+  def __contains__(self, fr):
+    i = self.graph.index(fr)
+    return(i >= 0 and self.graph.degree(i, self.routeType) > 0)
+
+  def __len__(self):
+    return(len(self.graph.routeable(self.routeType)))
+
+  def __iter__(self):
+    return(iter(self.keys()))
+
+  def get(self, fr, default=None):
+    try:
+      return(self[fr])
+    except KeyError:
+      return(default)
+
+  def keys(self):
+    return(self.graph.ids[self.graph.routeable(self.routeType)].tolist())
+
+  def items(self):
+    return([(fr, self[fr]) for fr in self.keys()])
+
+class RoutingView:
+  """Read-only dict-like view: routeType -> LinksView"""
+  def __init__(self, graph):
+    self.graph = graph
+
+  def __getitem__(self, routeType):
+    if not routeType in self.graph.weights:
+      raise KeyError(routeType)
+    return(LinksView(self.graph, routeType))
+
+  def __contains__(self, routeType):
+    return(routeType in self.graph.weights)
+
+  def __len__(self):
+    return(len(self.graph.weights))
+
+  def __iter__(self):
+    return(iter(self.keys()))
+
+  def keys(self):
+    return(self.graph.weights.keys())
+
+  def items(self):
+    return([(routeType, self[routeType]) for routeType in self.keys()])
@@ -5,8 +5,9 @@
 #------------------------------------------------------
 # Usage: 
 #   data = LoadOsm(filename)
-# or:
-#   loadOsm.py filename.osm
+#   data.applyChange('edits.osc')   # keep it current (see osmChange.py)
+# or, to compile a map for fast loading:
+#   loadOsm.py filename.osm filename.graph
 #------------------------------------------------------
 # Copyright 2007, Oliver White
 #
@@ -29,41 +30,263 @@
 #------------------------------------------------------
 import sys
 import os
-from xml.sax import make_parser, handler
-import xml
-from util_binary import *
-from struct import *
+import zlib
+from xml.parsers import expat
+import numpy as np
+from graph import *
+from spatial import NodeIndex
+from osmReader import makeReader
+from compiled import *
+from ch import loadHierarchies
+from chains import loadChains
+from osmChange import *
 
 execfile(os.path.join(os.path.dirname(__file__), "weights.py"))
 
-class LoadOsm(handler.ContentHandler):
+class LoadOsm:
   """Parse an OSM file looking for routing information, and do routing with it"""
-  def __init__(self, filename, storeMap = 0):
-    """Initialise an OSM-file parser"""
-    self.routing = {}
+  maxSnapDist = 1000 ** 0.5  # degrees; findNode's historic limit
+  snapToMain = False  # findNode only onto each transport's main component
+  wayKeys = ('highway','railway','oneway')
+  placeKeys = ('amenity','name')
+  processes = None  # PBF decoding pool size (None: one per CPU)
+  def __init__(self, filename, storeMap = 0, storePlaces = 0):
+    """Initialise an OSM-file parser
+
+    storePlaces -- also collect amenity nodes into self.amenities, so
+      places can be built without parsing the file a second time"""
     self.routeTypes = ('cycle','car','train','foot','horse')
-    self.routeableNodes = {}
-    for routeType in self.routeTypes:
-      self.routing[routeType] = {}
-      self.routeableNodes[routeType] = {}
-    self.nodes = {}
     self.ways = []
+    self.amenities = []  # (id, lat, lon, amenity, name)
+    self.placeNodes = None  # snapped node of each amenity, if known
     self.storeMap = storeMap
+    self.storePlaces = storePlaces
+    self.referenced = None  # while reading ways: ids of the nodes they use
+    self.wanted = None  # sorted ids of the nodes worth keeping (None = all)
+    self.linkTypes = {}  # way type -> code stored with each link
+    self.profiles = {}  # routeType -> (weightings, base) registered at runtime
+    self.wayTable = None  # the ways the graph came from, for applyChange
+    self.startBuffers()
+    self.compile()
     
     if(filename == None):
       return
     self.loadOsm(filename)
     
+  def startBuffers(self):
+    """Columns which collect nodes and links while parsing"""
+    self.nodeIds = Column(np.int64)
+    self.nodeLat = Column(np.float64)
+    self.nodeLon = Column(np.float64)
+    self.links = {}
+    for routeType in self.routeTypes:
+      self.links[routeType] = (Column(np.int64), Column(np.int64),
+                               Column(np.float32), Column(np.uint16))
+    self.wayIds = Column(np.int64)
+    self.wayNodes = Column(np.int64)
+    self.wayLengths = Column(np.int64)
+    self.wayTags = Column(np.int32)
+    self.wayTagSets = {}  # (highway, railway, oneway) -> code
+
+  def compile(self):
+    """Turn the parsed nodes and links into the array-backed graph"""
+    links = {}
+    for routeType, columns in self.links.items():
+      links[routeType] = [column.array() for column in columns]
+    linkTypes = sorted(self.linkTypes, key=self.linkTypes.get)
+    self.graph = buildGraph(self.nodeIds.array(), self.nodeLat.array(),
+                            self.nodeLon.array(), links, linkTypes)
+    if self.graph.undefined:
+      print "Ignoring %d links to undefined nodes" % self.graph.undefined
+    wayOffsets = np.zeros(len(self.wayLengths) + 1, np.int64)
+    np.cumsum(self.wayLengths.array(), out=wayOffsets[1:])
+    self.wayTable = WayTable(self.wayIds.array(), wayOffsets,
+      self.wayNodes.array(), self.wayTags.array(),
+      sorted(self.wayTagSets, key=self.wayTagSets.get))
+    self.startBuffers()
+    self.useGraph(self.graph)
+
+  def useGraph(self, graph):
+    """Point the dict-like compatibility views at a graph"""
+    self.graph = graph
+    self.nodes = NodesView(graph)
+    self.routing = RoutingView(graph)
+    self.nodeIndexes = {}
+    self.hierarchies = {}  # routeType -> ch.Hierarchy
+    self.chains = None  # chains.Chains, the graph with chains collapsed
+
+  def registerProfile(self, routeType, weightings, base=None):
+    """Add or replace a form of transport at runtime, without reparsing.
+
+    weightings -- {wayType: weight}, e.g. getProfile('car') from weights.py
+    base -- for a new routeType, the existing one whose links it may
+      use (those its weightings give a weight above 0 are kept)"""
+    graph = self.graph
+    if not graph.linkTypes:
+      raise ValueError("This graph doesn't record link types; rebuild it")
+    if base is None:
+      if not routeType in graph.weights:
+        raise ValueError("New profile %s needs a base routeType" % routeType)
+      graph.setWeights(routeType, graph.profileWeights(routeType, weightings))
+    else:
+      # Weights are 0 wherever base has no access, so the new access
+      # bits are a subset of base's
+      graph.addTransport(routeType, graph.profileWeights(base, weightings),
+                         linkType=graph.linkTypeOf(base))
+    # Anything derived from the old weights no longer applies
+    self.hierarchies.pop(routeType, None)
+    self.nodeIndexes.pop((routeType, False), None)
+    self.nodeIndexes.pop((routeType, True), None)
+    self.chains = None  # chains are only collapsed where weights agree
+    self.profiles[routeType] = (weightings, base)
+
+  def applyChange(self, filename):
+    """Apply an OSM change file (.osc) to the loaded graph, ways and
+    places, without reparsing the map. Returns a GraphChange saying
+    what changed, for invalidating caches (see PathCache.update).
+
+    Ways may only use nodes the graph already has or the change
+    defines: the positions of other nodes weren't kept. Contraction
+    hierarchies and collapsed chains are dropped, as they no longer
+    match the graph;
+    spatial indexes are rebuilt on next use."""
+    if self.wayTable is None:
+      raise ValueError("No way records were kept for this graph; recompile it")
+    change = readChange(filename, self.placeKeys, self.wayKeys)
+    old = self.graph
+
+    # The nodes touched: every node of the changed ways, before and
+    # after, and every changed node
+    changedWays = np.array(sorted(change.ways.keys()), np.int64)
+    rows = self.wayTable.rows(changedWays)
+    oldOffsets, oldNodes = takeRows(self.wayTable.offsets, self.wayTable.nodes,
+                                    rows[rows >= 0])
+    newNodes = [n for way in change.ways.values() if way for n in way[0]]
+    touched = np.unique(np.r_[oldNodes, np.array(newNodes, np.int64),
+                              np.array(change.nodes.keys(), np.int64)])
+    self.wayTable = self.wayTable.replace(change.ways)
+
+    # Node positions: drop deleted and moved nodes, then add back those
+    # which are (or now may be) on a way
+    changedNodes = np.array(sorted(change.nodes.keys()), np.int64)
+    keep = ~np.in1d(old.ids, changedNodes)
+    placed = [(id, change.nodes[id][0], change.nodes[id][1])
+              for id in changedNodes.tolist() if change.nodes[id] is not None]
+    if placed:
+      ids, lats, lons = [np.array(column) for column in zip(*placed)]
+      onWay = np.in1d(ids, old.ids) | np.in1d(ids, self.wayTable.nodes)
+      ids, lats, lons = ids[onWay], lats[onWay], lons[onWay]
+    else:
+      ids = lats = lons = np.zeros(0)
+    nodeIds = np.r_[old.ids[keep], ids.astype(np.int64)]
+    nodeLat = np.r_[old.lat[keep], lats]
+    nodeLon = np.r_[old.lon[keep], lons]
+
+    # Links: keep those leaving untouched nodes, and make the rest
+    # again from every way through a touched node
+    for code, wayType in enumerate(old.linkTypes):
+      self.linkTypes.setdefault(wayType, code)
+    self.startBuffers()
+    for row in self.wayTable.containing(touched).tolist():
+      id, waynodes, tags = self.wayTable.way(row)
+      self.addWayLinks(waynodes, tags)
+    links = {}
+    for routeType, columns in self.links.items():
+      fr, to, weight, linkType = [column.array() for column in columns]
+      fresh = np.in1d(fr, touched)
+      if routeType in old.weights:
+        sources = old.sources()
+        kept = ~np.in1d(old.ids, touched)[sources] & old.mask(routeType)
+        fr = np.r_[old.ids[sources[kept]], fr[fresh]]
+        to = np.r_[old.ids[old.targets[kept]], to[fresh]]
+        weight = np.r_[self.baseWeights(routeType, old)[kept], weight[fresh]]
+        linkType = np.r_[old.linkTypeOf(routeType)[kept], linkType[fresh]]
+      links[routeType] = (fr, to, weight, linkType)
+    self.startBuffers()
+    linkTypes = sorted(self.linkTypes, key=self.linkTypes.get)
+    graph = buildGraph(nodeIds, nodeLat, nodeLon, links, linkTypes)
+    self.useGraph(graph)
+    for routeType, (weightings, base) in sorted(self.profiles.items(),
+                                                key=lambda p: p[1][1] is not None):
+      self.registerProfile(routeType, weightings, base)
+
+    places = self.changePlaces(change.nodes)
+    if self.storeMap:
+      self.changeMapWays(change.ways)
+    worse, better = compareGraphs(old, graph, touched)
+    return(GraphChange(old.fingerprint(), graph.fingerprint(), touched,
+                       worse, better, places, graph.undefined))
+
+  def baseWeights(self, routeType, graph):
+    """Weights a graph's links had before any registered profile"""
+    if not routeType in self.profiles:
+      return(graph.weights[routeType])
+    table = np.array([getWeight(routeType, t) for t in graph.linkTypes] or [0],
+                     np.float32)
+    return(np.where(graph.mask(routeType), table[graph.linkTypeOf(routeType)], 0))
+
+  def changePlaces(self, nodes):
+    """Apply changed nodes to the amenities; returns the ids of those
+    added, moved or removed"""
+    if not (self.storePlaces or self.amenities):
+      return([])
+    changed = []
+    amenities = []
+    for amenity in self.amenities:
+      if amenity[0] in nodes:
+        changed.append(amenity[0])
+      else:
+        amenities.append(amenity)
+    for id in sorted(nodes.keys()):
+      node = nodes[id]
+      if node is not None and 'amenity' in node[2]:
+        lat, lon, tags = node
+        amenities.append((id, lat, lon, tags['amenity'],
+          tags.get('name', '?').decode('utf-8')))
+        changed.append(id)
+    self.amenities = amenities
+    self.placeNodes = None  # snap again: the roads may have moved too
+    return(sorted(set(changed)))
+
+  def changeMapWays(self, ways):
+    """Apply changed ways to the map ways (those drawn)"""
+    self.ways = [way for way in self.ways if not way.get('id') in ways]
+    for id in sorted(ways.keys()):
+      if ways[id] is not None:
+        refs, tags = ways[id]
+        wayType = self.WayType(tags)
+        if wayType:
+          self.ways.append({'id': id, 't': wayType, 'n': refs})
+    
   def loadOsm(self, filename):
     if(not os.path.exists(filename)):
       print "No such data file %s" % filename
       return
+    if isCompiled(filename):
+      self.loadbin(filename)
+      return
     try:
-      parser = make_parser()
-      parser.setContentHandler(self)
-      parser.parse(filename)
-    except xml.sax._exceptions.SAXParseException:
+      # First pass: ways, which say which nodes the graph will need
+      if self.storePlaces:
+        nodeKeys = self.placeKeys
+      else:
+        nodeKeys = ()
+      reader = makeReader(filename, wayKeys=self.wayKeys, nodeKeys=nodeKeys,
+                          processes=self.processes)
+      self.referenced = Column(np.int64)
+      reader.onWay = self.storeWay
+      reader.read(filename)
+      self.wanted = np.unique(self.referenced.array())
+      self.referenced = None
+      # Second pass: positions of just those nodes, plus any amenities
+      reader.onWay = None
+      reader.onNodeArrays = self.storeNodes
+      reader.onNode = self.storePlace
+      reader.read(filename)
+    except (expat.ExpatError, IOError, ValueError, zlib.error):
       print "Error loading %s" % filename
+    self.compile()
+    self.wanted = None
     
   def report(self):
     """Display some info about the loaded data"""
@@ -76,136 +299,177 @@ class LoadOsm(handler.ContentHandler):
     return(report)
     
   def savebin(self,filename):
-    self.newIDs = {}
-    
-    f = open(filename,"wb")
-    f.write(pack('L',len(self.nodes.keys())))
-    count = 0
-    for id, n in self.nodes.items():
-      self.newIDs[id] = count
-      f.write(encodeLL(n[0],n[1]))
-      count = count + 1
-      
-    f.write(pack('B', len(self.routing.keys())))
-    errors = 0
-    for routeType, data in self.routing.items():
-      f.write(pack('B', len(routeType)))
-      f.write(routeType)
-      
-      f.write(pack('L', len(data.keys())))
-      for fr, destinations in data.items():
-        try:
-          f.write(pack('L', self.newIDs[fr]))
-        except KeyError:
-          f.write(pack('L', 0))
-          errors = errors + 1
-          continue
-
-        f.write(pack('B', len(destinations.keys())))
-        for to, weight in destinations.items():
-          try:
-            f.write(pack('Lf', self.newIDs[to], weight))
-          except KeyError:
-            f.write(pack('Lf', 0, 0))
-            errors = errors + 1
+    """Write the graph, places and map ways to a compiled graph file"""
+    sections, meta = graphSections(self.graph)
+
+    ids, lats, lons, cats, names = zip(*self.amenities) or ((),) * 5
+    if self.placeNodes is not None:
+      nodes = self.placeNodes
+    else:
+      nodes = self.findNodes(lats, lons, 'car')
+    if len(nodes) and (self.graph.indices(nodes[nodes >= 0]) < 0).any():
+      raise CompiledGraphError("Places are snapped to unknown nodes")
+    meta['placesOnMain'] = bool(self.snapToMain)
+    meta['placeCats'] = sorted(set(cats))
+    catIndex = dict([(cat, i) for i, cat in enumerate(meta['placeCats'])])
+    sections['place/ids'] = np.array(ids, np.int64)
+    sections['place/lat'] = np.array(lats, np.float64)
+    sections['place/lon'] = np.array(lons, np.float64)
+    sections['place/node'] = np.asarray(nodes, np.int64)
+    sections['place/cat'] = np.array([catIndex[cat] for cat in cats], np.int32)
+    sections['place/nameOffsets'], sections['place/names'] = packStrings(names)
+
+    meta['wayTypes'] = sorted(set([way['t'] for way in self.ways]))
+    typeIndex = dict([(t, i) for i, t in enumerate(meta['wayTypes'])])
+    wayOffsets = np.zeros(len(self.ways) + 1, np.int64)
+    np.cumsum([len(way['n']) for way in self.ways], out=wayOffsets[1:])
+    sections['way/type'] = np.array([typeIndex[way['t']] for way in self.ways], np.int32)
+    sections['way/ids'] = np.array([way.get('id', 0) for way in self.ways], np.int64)
+    sections['way/offsets'] = wayOffsets
+    sections['way/nodes'] = np.array([n for way in self.ways for n in way['n']], np.int64)
+
+    for routeType in self.graph.transports:
+      for name, array in self.graph.components(routeType).arrays().items():
+        sections['component/%s/%s' % (routeType, name)] = array
+
+    if self.wayTable is not None:
+      wayTableSections, wayTableMeta = self.wayTable.sections()
+      sections.update(wayTableSections)
+      meta.update(wayTableMeta)
+
+    writeSections(filename, sections, meta)
     
-    print "%d key errors" % errors
-    f.close()
+  def loadbin(self,filename,verify=False):
+    """Load a file written by savebin. The graph arrays are views onto
+    the memory-mapped file rather than copies. Contraction hierarchies
+    and collapsed chains saved alongside it (filename.ch, see ch.py, and
+    filename.chains, see chains.py) are loaded too.
+
+    verify -- check the payload checksum too (reads every page)"""
+    sections, meta = readSections(filename, verify)
+    self.useGraph(graphFromSections(sections, meta))
+    for routeType in self.graph.transports:
+      name = 'component/%s/' % routeType
+      if name + 'strong' in sections:
+        self.graph.componentCache[routeType] = Components(*[
+          sections[name + array] for array in
+          ('strong', 'weak', 'leaves', 'enters', 'fromMain', 'toMain')])
+    if os.path.exists(filename + '.ch'):
+      self.hierarchies = loadHierarchies(filename + '.ch', self.graph)
+    if os.path.exists(filename + '.chains'):
+      self.chains = loadChains(filename + '.chains', self.graph)
+
+    cats = [meta['placeCats'][i] for i in sections['place/cat'].tolist()]
+    names = unpackStrings(sections['place/nameOffsets'], sections['place/names'])
+    self.amenities = zip(sections['place/ids'].tolist(),
+      sections['place/lat'].tolist(), sections['place/lon'].tolist(),
+      cats, names)
+    self.placeNodes = sections['place/node']
+    if meta.get('placesOnMain', False) != self.snapToMain:
+      self.placeNodes = None  # snapped the other way; snap again
+
+    offsets = sections['way/offsets'].tolist()
+    nodes = sections['way/nodes']
+    self.ways = [{'t': meta['wayTypes'][t], 'n': nodes[offsets[i]:offsets[i + 1]].tolist()}
+                 for i, t in enumerate(sections['way/type'].tolist())]
+    if 'way/ids' in sections:
+      for way, id in zip(self.ways, sections['way/ids'].tolist()):
+        way['id'] = id
+    self.wayTable = wayTableFromSections(sections, meta)
+
+  def storeNodes(self, ids, lats, lons):
+    """Handle a batch of nodes: keep the ones a stored way uses"""
+    if self.wanted is not None:
+      keep = np.zeros(len(ids), bool)
+      if len(self.wanted):
+        i = np.searchsorted(self.wanted, ids)
+        i[i >= len(self.wanted)] = 0
+        keep = self.wanted[i] == ids
+      ids, lats, lons = ids[keep], lats[keep], lons[keep]
+    self.nodeIds.appendArray(ids)
+    self.nodeLat.appendArray(lats)
+    self.nodeLon.appendArray(lons)
+
+  def storePlace(self, id, lat, lon, tags):
+    """Handle a tagged node: remember it if it's an amenity"""
+    if self.storePlaces and 'amenity' in tags:
+      self.amenities.append((id, lat, lon, tags['amenity'],
+        tags.get('name', '?').decode('utf-8')))
+
+  def storeWay(self, id, waynodes, tags):
+    """Handle a way: turn its segments into routeable links"""
+    routeable = self.addWayLinks(waynodes, tags)
+    highway = tags.get('highway', '')
+    railway = tags.get('railway', '')
+    if highway or railway:
+      # Keep a record of the way, so that changes to it can be applied
+      values = (highway, railway, tags.get('oneway', ''))
+      self.wayIds.append(id)
+      self.wayNodes.extend(waynodes)
+      self.wayLengths.append(len(waynodes))
+      self.wayTags.append(self.wayTagSets.setdefault(values, len(self.wayTagSets)))
     
-  def loadbin(self,filename):
-    f = open(filename,"rb")
-    n = unpack('L', f.read(4))[0]
-    print "%u nodes" % n
-    id = 0
-    for i in range(n):
-      lat,lon = decodeLL(f.read(8))
-      #print "%u: %f, %f" % (id,lat,lon)
-      id = id + 1
+    # Store map information
+    if(self.storeMap):
+      wayType = self.WayType(tags)
+      if(wayType):
+        routeable = True
+        self.ways.append({ \
+          'id':id,
+          't':wayType,
+          'n':waynodes})
+
+    if routeable and self.referenced is not None:
+      self.referenced.extend(waynodes)
+
+  def addWayLinks(self, waynodes, tags):
+    """Add the links a way makes; returns whether there were any"""
+    highway = self.equivalent(tags.get('highway', ''))
+    railway = self.equivalent(tags.get('railway', ''))
+    oneway = tags.get('oneway', '')
+    reversible = not oneway in('yes','true','1')
     
-    numTypes = unpack('B', f.read(1))[0]
-    print "%u types:" % numTypes
-    for typ in range(numTypes):
-      lenName = unpack('B', f.read(1))[0]
-      name = f.read(lenName)
-      numLinks = 0
-      
-      numHubs = unpack('L', f.read(4))[0]
-      for hub in range(numHubs):
-        fr = unpack('L', f.read(4))[0]
-        numDest = unpack('B', f.read(1))[0]
-        for dest in range(numDest):
-          to,weight = unpack('Lf', f.read(8))
-          numLinks = numLinks + 1
-      print "  \"%s\" (%u segments)" % (name, numLinks)
-
-    f.close()
-
-  def startElement(self, name, attrs):
-    """Handle XML elements"""
-    if name in('node','way','relation'):
-      self.tags = {}
-      self.waynodes = []
-      if name == 'node':
-        """Nodes need to be stored"""
-        id = int(attrs.get('id'))
-        lat = float(attrs.get('lat'))
-        lon = float(attrs.get('lon'))
-        self.nodes[id] = (lat,lon)
-    elif name == 'nd':
-      """Nodes within a way -- add them to a list"""
-      self.waynodes.append(int(attrs.get('ref')))
-    elif name == 'tag':
-      """Tags - store them in a hash"""
-      k,v = (attrs.get('k'), attrs.get('v'))
-      if not k in ('created_by'):
-        self.tags[k] = v
-  
-  def endElement(self, name):
-    """Handle ways in the OSM data"""
-    if name == 'way':
-      highway = self.equivalent(self.tags.get('highway', ''))
-      railway = self.equivalent(self.tags.get('railway', ''))
-      oneway = self.tags.get('oneway', '')
-      reversible = not oneway in('yes','true','1')
+    wayType = highway or railway
+
+    # Calculate what vehicles can use this route
+    access = {}
+    access['cycle'] = highway in ('primary','secondary','tertiary','unclassified','minor','cycleway','residential', 'track','service')
+    access['car'] = highway in ('motorway','trunk','primary','secondary','tertiary','unclassified','minor','residential', 'service')
+    access['train'] = railway in('rail','light_rail','subway')
+    access['foot'] = access['cycle'] or highway in('footway','steps')
+    access['horse'] = highway in ('track','unclassified','bridleway')
     
-      # Calculate what vehicles can use this route
-      access = {}
-      access['cycle'] = highway in ('primary','secondary','tertiary','unclassified','minor','cycleway','residential', 'track','service')
-      access['car'] = highway in ('motorway','trunk','primary','secondary','tertiary','unclassified','minor','residential', 'service')
-      access['train'] = railway in('rail','light_rail','subway')
-      access['foot'] = access['cycle'] or highway in('footway','steps')
-      access['horse'] = highway in ('track','unclassified','bridleway')
-      
-      # Store routing information
-      last = -1
-      for i in self.waynodes:
-        if last != -1:
-          #print "%d -> %d & v.v." % (last, i)
-          for routeType in self.routeTypes:
-            if(access[routeType]):
-              weight = getWeight(routeType, highway)
-              self.addLink(last, i, routeType, weight)
-              if reversible or routeType == 'foot':
-                self.addLink(i, last, routeType, weight)
-        last = i
-      
-      # Store map information
-      if(self.storeMap):
-        wayType = self.WayType(self.tags)
-        if(wayType):
-          self.ways.append({ \
-            't':wayType,
-            'n':self.waynodes})
+    # Store routing information. Only way types something may use get
+    # a code, so codes aren't spent on rivers and the like
+    if not True in access.values():
+      return(False)
+    routeable = False
+    linkType = self.linkTypes.get(wayType)
+    if linkType is None:
+      if len(self.linkTypes) > 0xffff:
+        raise ValueError("More than 65536 routeable way types")
+      linkType = self.linkTypes[wayType] = len(self.linkTypes)
+    last = -1
+    for i in waynodes:
+      if last != -1:
+        #print "%d -> %d & v.v." % (last, i)
+        for routeType in self.routeTypes:
+          if(access[routeType]):
+            routeable = True
+            weight = getWeight(routeType, wayType)
+            self.addLink(last, i, routeType, weight, linkType)
+            if reversible or routeType == 'foot':
+              self.addLink(i, last, routeType, weight, linkType)
+      last = i
+    return(routeable)
   
-  def addLink(self,fr,to, routeType, weight=1):
-    """Add a routeable edge to the scenario"""
-    self.routeablefrom(fr,routeType)
-    try:
-      if to in self.routing[routeType][fr].keys():
-        return
-      self.routing[routeType][fr][to] = weight
-    except KeyError:
-      self.routing[routeType][fr] = {to: weight}
+  def addLink(self,fr,to, routeType, weight=1, linkType=0):
+    """Add a routeable edge to the scenario (repeats are dropped by compile)"""
+    frs, tos, weights, linkTypes = self.links[routeType]
+    frs.append(fr)
+    tos.append(to)
+    weights.append(weight)
+    linkTypes.append(linkType)
 
   def WayType(self, tags):
     # Look for a variety of tags (priority order - first one found is used)
@@ -241,35 +505,47 @@ class LoadOsm(handler.ContentHandler):
     except KeyError:
       return(tag)
     
-  def routeablefrom(self,fr,routeType):
-    self.routeableNodes[routeType][fr] = 1
+  def nodeIndex(self,routeType,main=False):
+    """Spatial index of the nodes which have a route leading from them,
+    or only those in the main component (built on first use, once per
+    form of transport)"""
+    try:
+      return(self.nodeIndexes[(routeType, main)])
+    except KeyError:
+      nodes = self.graph.routeable(routeType)
+      if main:
+        nodes = nodes[self.graph.components(routeType).main()[nodes]]
+      index = NodeIndex(self.graph.lat, self.graph.lon, nodes)
+      self.nodeIndexes[(routeType, main)] = index
+      return(index)
 
-  def findNode(self,lat,lon,routeType):
+  def findNode(self,lat,lon,routeType,main=None):
     """Find the nearest node to a point.
-    Filters for nodes which have a route leading from them"""
-    maxDist = 1000
-    nodeFound = None
-    for id in self.routeableNodes[routeType].keys():
-      if id not in self.nodes:
-        print "Ignoring undefined node %s" % id
-        continue
-      n = self.nodes[id]
-      dlat = n[0] - lat
-      dlon = n[1] - lon
-      dist = dlat * dlat + dlon * dlon
-      if(dist < maxDist):
-        maxDist = dist
-        nodeFound = id
-    return(nodeFound)
+    Filters for nodes which have a route leading from them, and if main
+    is set (by default, snapToMain) for those in the main strongly
+    connected component, rather than some small island"""
+    if main is None:
+      main = self.snapToMain
+    i = self.nodeIndex(routeType, main).nearest(lat, lon, self.maxSnapDist)[0]
+    if i < 0:
+      return(None)
+    return(self.graph.ids.item(i))
+
+  def findNodes(self,lats,lons,routeType,main=None):
+    """Vectorised findNode: OSM ids of the nearest routeable node to
+    each point, as an int64 array with -1 where nothing was found"""
+    if main is None:
+      main = self.snapToMain
+    found = self.nodeIndex(routeType, main).nearest(lats, lons, self.maxSnapDist)
+    ids = np.zeros(len(found), np.int64) - 1
+    ids[found >= 0] = self.graph.ids[found[found >= 0]]
+    return(ids)
     
 # Parse the supplied OSM file
 if __name__ == "__main__":
-  #print "Loading data..."
-  #data = LoadOsm(sys.argv[1], True)
-  #print data.report()
-  #print "Saving binary..."
-  #data.savebin("data/routing.bin")
-  print "Loading binary..."
-  data2 = LoadOsm(None, False)
-  data2.loadbin("data/routing.bin")
+  data = LoadOsm(sys.argv[1], storePlaces=1)
+  print data.report()
+  if len(sys.argv) > 2:
+    print "Saving compiled graph..."
+    data.savebin(sys.argv[2])
   print "Done"
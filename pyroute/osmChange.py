@@ -0,0 +1,230 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Incremental updates from OSM change files
+#
+#------------------------------------------------------
+# Usage:
+#   data = LoadOsm('data/map.osm', storePlaces=1)
+#   change = data.applyChange('data/edits.osc')
+#   pathCache.update(change)
+#
+# An .osc file lists the nodes and ways that were created,
+# modified or deleted. Only the final state of each element
+# matters, so creations and modifications are read alike.
+#
+# Applying one needs the ways the graph was built from, which
+# LoadOsm keeps as a WayTable (and savebin stores). The links of
+# untouched nodes are kept as they are; those leaving any node
+# the change touches are made again from the ways through it, and
+# the graph is rebuilt around them. A GraphChange then says which
+# links went away or got dearer, and which appeared or got
+# cheaper, so that caches can drop only what may now be wrong.
+#------------------------------------------------------
+import numpy as np
+from osmReader import OsmReader
+
+class ChangeReader(OsmReader):
+  """Reads an osmChange file into {id: state} dicts, where the state
+  is None for deleted elements:
+    nodes -- {id: (lat, lon, tags)}
+    ways -- {id: (refs, tags)}"""
+  actions = ('create', 'modify', 'delete')
+
+  def __init__(self, nodeKeys=None, wayKeys=None):
+    OsmReader.__init__(self, onNode=self.storeNode, onWay=self.storeWay,
+                       nodeKeys=nodeKeys, wayKeys=wayKeys)
+    self.action = None
+    self.nodes = {}
+    self.ways = {}
+
+  def startElement(self, name, attrs):
+    if name in self.actions:
+      self.action = name
+      return
+    if name == 'node' and not 'lat' in attrs:
+      # Deletions may leave the position out
+      attrs = dict(attrs, lat='nan', lon='nan')
+    OsmReader.startElement(self, name, attrs)
+
+  def storeNode(self, id, lat, lon, tags):
+    if self.action == 'delete':
+      self.nodes[id] = None
+    else:
+      self.nodes[id] = (lat, lon, tags)
+
+  def storeWay(self, id, refs, tags):
+    if self.action == 'delete':
+      self.ways[id] = None
+    else:
+      self.ways[id] = (refs, tags)
+
+def readChange(filename, nodeKeys=None, wayKeys=None):
+  """Parse an .osc (or .osc.gz) file; returns a ChangeReader"""
+  reader = ChangeReader(nodeKeys, wayKeys)
+  reader.read(filename)
+  return(reader)
+
+def takeRows(offsets, values, rows):
+  """Rows of a ragged array (CSR offsets + values): (offsets, values)"""
+  rows = np.asarray(rows, np.int64)
+  lengths = np.diff(offsets)[rows]
+  newOffsets = np.zeros(len(rows) + 1, np.int64)
+  np.cumsum(lengths, out=newOffsets[1:])
+  shift = np.repeat(offsets[:-1][rows] - newOffsets[:-1], lengths)
+  return((newOffsets, values[np.arange(newOffsets[-1]) + shift]))
+
+class WayTable:
+  """The ways a graph was built from: their ids, node ids and the tags
+  storeWay reads, as columns sorted by way id"""
+  keys = ('highway', 'railway', 'oneway')
+
+  def __init__(self, ids, offsets, nodes, tags, tagSets):
+    """tags -- index into tagSets of each way's (highway, railway,
+    oneway) values ('' where missing)"""
+    ids = np.asarray(ids, np.int64)
+    order = np.argsort(ids, kind='mergesort')
+    self.ids = ids[order]
+    self.offsets, self.nodes = takeRows(np.asarray(offsets, np.int64),
+                                        np.asarray(nodes, np.int64), order)
+    self.tags = np.asarray(tags, np.int32)[order]
+    self.tagSets = [tuple(t) for t in tagSets]
+
+  def __len__(self):
+    return(len(self.ids))
+
+  def way(self, row):
+    """(id, [node ids], {tag: value}) of one row"""
+    values = self.tagSets[self.tags.item(row)]
+    tags = dict([(k, v) for k, v in zip(self.keys, values) if v])
+    nodes = self.nodes[self.offsets.item(row):self.offsets.item(row + 1)]
+    return((self.ids.item(row), nodes.tolist(), tags))
+
+  def rows(self, ids):
+    """Row of each way id, -1 where there is no such way"""
+    ids = np.asarray(ids, np.int64)
+    if not len(self.ids):
+      return(np.zeros(len(ids), np.int64) - 1)
+    i = np.searchsorted(self.ids, ids)
+    i[i >= len(self.ids)] = 0
+    i[self.ids[i] != ids] = -1
+    return(i)
+
+  def containing(self, nodes):
+    """Rows of the ways which use any of the node ids"""
+    rowOf = np.repeat(np.arange(len(self.ids)), np.diff(self.offsets))
+    return(np.unique(rowOf[np.in1d(self.nodes, nodes)]))
+
+  def replace(self, ways):
+    """A new table with {id: (refs, tags), or None to delete} applied"""
+    ids = np.array(sorted(ways.keys()), np.int64)
+    keep = np.ones(len(self.ids), bool)
+    found = self.rows(ids)
+    keep[found[found >= 0]] = False
+    offsets, nodes = takeRows(self.offsets, self.nodes, np.flatnonzero(keep))
+    tagSets = list(self.tagSets)
+    code = dict([(t, i) for i, t in enumerate(tagSets)])
+    newIds = []
+    newNodes = []
+    newLengths = []
+    newTags = []
+    for id in ids.tolist():
+      if ways[id] is None:
+        continue
+      refs, tags = ways[id]
+      values = tuple([tags.get(k, '') for k in self.keys])
+      if not (values[0] or values[1]):
+        continue  # no longer a highway or railway
+      if not values in code:
+        code[values] = len(tagSets)
+        tagSets.append(values)
+      newIds.append(id)
+      newNodes.extend(refs)
+      newLengths.append(len(refs))
+      newTags.append(code[values])
+    newOffsets = offsets[-1] + np.cumsum([0] + newLengths)
+    return(WayTable(np.r_[self.ids[keep], np.array(newIds, np.int64)],
+                    np.r_[offsets, newOffsets[1:]],
+                    np.r_[nodes, np.array(newNodes, np.int64)],
+                    np.r_[self.tags[keep], np.array(newTags, np.int32)],
+                    tagSets))
+
+  def sections(self):
+    """Arrays and metadata for compiled.writeSections"""
+    return({'osmWay/ids': self.ids, 'osmWay/offsets': self.offsets,
+            'osmWay/nodes': self.nodes, 'osmWay/tags': self.tags},
+           {'wayTagSets': self.tagSets})
+
+def wayTableFromSections(sections, meta):
+  """The WayTable saved alongside a compiled graph, or None for graphs
+  compiled without one"""
+  if not 'osmWay/ids' in sections:
+    return(None)
+  return(WayTable(sections['osmWay/ids'], sections['osmWay/offsets'],
+                  sections['osmWay/nodes'], sections['osmWay/tags'],
+                  meta.get('wayTagSets', [])))
+
+def touchingLinks(graph, routeType, nodes):
+  """{(fr, to): cost} of the usable links starting or ending at any of
+  the nodes (OSM ids)"""
+  targets = graph.targets
+  costs = graph.costs(routeType)
+  touched = np.zeros(len(graph.ids), bool)
+  i = graph.indices(nodes)
+  touched[i[i >= 0]] = True
+  sources = graph.sources()
+  keep = (touched[sources] | touched[targets]) & np.isfinite(costs)
+  return(dict(zip(zip(graph.ids[sources[keep]].tolist(),
+                      graph.ids[targets[keep]].tolist()),
+                  costs[keep].tolist())))
+
+class GraphChange:
+  """What applying a change file did to a graph.
+
+  before, after -- fingerprints of the graph before and after
+  nodes -- OSM ids of the nodes the change touched (sorted)
+  worse -- {routeType: OSM ids of both ends of every link which went
+    away or got dearer}: routes through them may no longer be best
+  better -- {routeType: (fr, to, cost)} arrays of the links which
+    appeared or got cheaper: any route could now have a shortcut
+  places -- ids of the amenities added, moved or removed
+  undefined -- links dropped because a node's position isn't known"""
+  def __init__(self, before, after, nodes, worse, better, places, undefined):
+    self.before = before
+    self.after = after
+    self.nodes = nodes
+    self.worse = worse
+    self.better = better
+    self.places = places
+    self.undefined = undefined
+
+  def report(self):
+    report = "Change touched %d nodes and %d places\n" % (
+      len(self.nodes), len(self.places))
+    for routeType in sorted(self.worse):
+      report = report + " %s: %d nodes on worse links, %d better links\n" % (
+        routeType, len(self.worse[routeType]), len(self.better[routeType][0]))
+    return(report)
+
+def compareGraphs(old, new, nodes):
+  """(worse, better) for GraphChange, looking only at the links
+  around the nodes the change touched"""
+  worse = {}
+  better = {}
+  for routeType in new.weights.keys():
+    if routeType in old.weights:
+      before = touchingLinks(old, routeType, nodes)
+    else:
+      before = {}
+    after = touchingLinks(new, routeType, nodes)
+    ends = set()
+    for link, cost in before.items():
+      if after.get(link, float('inf')) > cost:
+        ends.update(link)
+    improved = [(fr, to, cost) for (fr, to), cost in after.items()
+                if cost < before.get((fr, to), float('inf'))]
+    improved.sort()
+    worse[routeType] = np.array(sorted(ends), np.int64)
+    fr, to, cost = zip(*improved) or ((), (), ())
+    better[routeType] = (np.array(fr, np.int64), np.array(to, np.int64),
+                         np.array(cost, np.float64))
+  return(worse, better)
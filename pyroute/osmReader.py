@@ -0,0 +1,123 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Streaming reader for OSM XML files
+#
+#------------------------------------------------------
+# Usage:
+#   reader = OsmReader(onNode=storeNode, nodeKeys=('amenity',))
+#   reader.read('data/map.osm.gz')
+#
+# Elements are passed to the callbacks as they close and are not
+# kept afterwards. Plain .osm, .osm.gz and .osm.bz2 are accepted;
+# makeReader() picks PbfReader instead for .osm.pbf files.
+#------------------------------------------------------
+import bz2
+import gzip
+from xml.parsers import expat
+import numpy as np
+
+def makeReader(filename, **options):
+  """An OsmReader or PbfReader, whichever suits the file"""
+  if filename.endswith('.pbf'):
+    from pbf import PbfReader
+    return(PbfReader(**options))
+  options.pop('processes', None)
+  return(OsmReader(**options))
+
+def openOsm(filename):
+  """Open an OSM file for reading, decompressing .gz and .bz2 on the fly"""
+  if filename.endswith('.gz'):
+    return(gzip.open(filename, 'rb'))
+  if filename.endswith('.bz2'):
+    return(bz2.BZ2File(filename, 'rb'))
+  return(open(filename, 'rb'))
+
+class OsmReader:
+  """Calls onNode(id, lat, lon, tags) and onWay(id, refs, tags) while
+  expat streams through a file.
+
+  Either callback may be None, in which case that kind of element is
+  skipped as cheaply as possible. Only tags whose key is listed in
+  nodeKeys / wayKeys are collected (None collects every tag). Strings
+  come back as UTF-8 byte strings; way tags are interned, since the
+  same few keys and values repeat throughout a file.
+
+  onNodeArrays(ids, lats, lons) -- if set, receives every node in
+    numpy batches, and onNode is then only called for nodes carrying
+    one of nodeKeys"""
+  batchSize = 65536
+
+  def __init__(self, onNode=None, onWay=None, nodeKeys=(), wayKeys=(),
+               onNodeArrays=None):
+    self.onNode = onNode
+    self.onWay = onWay
+    self.onNodeArrays = onNodeArrays
+    self.nodeKeys = nodeKeys
+    self.wayKeys = wayKeys
+    self.element = None
+    self.batch = []
+
+  def read(self, filename):
+    f = openOsm(filename)
+    try:
+      parser = expat.ParserCreate()
+      parser.returns_unicode = False
+      parser.buffer_text = True
+      parser.StartElementHandler = self.startElement
+      parser.EndElementHandler = self.endElement
+      parser.ParseFile(f)
+      self.flushNodes()
+    finally:
+      f.close()
+
+  def flushNodes(self):
+    if self.batch:
+      ids, lats, lons = zip(*self.batch)
+      self.batch = []
+      self.onNodeArrays(np.array(ids, np.int64), np.array(lats), np.array(lons))
+
+  def startElement(self, name, attrs):
+    if name == 'nd':
+      if self.element == 'way':
+        self.refs.append(int(attrs['ref']))
+    elif name == 'tag':
+      if self.element == 'way':
+        k = attrs['k']
+        if self.wayKeys is None or k in self.wayKeys:
+          self.tags[intern(k)] = intern(attrs['v'])
+      elif self.element == 'node':
+        k = attrs['k']
+        if self.nodeKeys is None or k in self.nodeKeys:
+          self.tags[k] = attrs['v']
+    elif name == 'node':
+      if self.onNode or self.onNodeArrays:
+        self.element = 'node'
+        self.id = int(attrs['id'])
+        self.lat = float(attrs['lat'])
+        self.lon = float(attrs['lon'])
+        self.tags = {}
+    elif name == 'way':
+      if self.onWay:
+        self.element = 'way'
+        self.id = int(attrs['id'])
+        self.refs = []
+        self.tags = {}
+    elif name == 'relation':
+      self.element = None
+
+  def endElement(self, name):
+    if name == 'node':
+      if self.element == 'node':
+        if self.onNodeArrays:
+          self.batch.append((self.id, self.lat, self.lon))
+          if len(self.batch) >= self.batchSize:
+            self.flushNodes()
+          if self.onNode and self.tags:
+            self.onNode(self.id, self.lat, self.lon, self.tags)
+        else:
+          self.onNode(self.id, self.lat, self.lon, self.tags)
+        self.element = None
+    elif name == 'way':
+      if self.element == 'way':
+        self.onWay(self.id, self.refs, self.tags)
+        self.element = None
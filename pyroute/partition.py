@@ -0,0 +1,264 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Routing graph split into spatial cells, loaded on demand
+#
+#------------------------------------------------------
+# Usage:
+#   partition.py map.graph [cellSize]
+#     splits a compiled graph into cells (default 0.05 degrees
+#     square) and writes map.graph.cells
+#
+#   cells = PartitionedGraph('map.graph.cells', memoryLimit=64 << 20)
+#   router = CellRouter(cells)
+#   result, route = router.doRoute(node1, node2, 'car')
+#
+# For maps too big to hold in a worker's memory. The nodes are
+# grouped by grid cell and stored cell by cell, with their links
+# and link costs. Only a few small arrays over all nodes stay
+# open (ids, and each node's cell and place in the file); a
+# cell's positions, links and costs are read in when a search
+# first reaches it, and the least recently used cells are let go
+# once the loaded cells pass memoryLimit bytes. Searches fetch each
+# cell through that LRU every time they need it, so the limit holds
+# during a search too (a cell let go is read again if the search
+# comes back to it).
+#
+# Each cell records its boundary nodes, those with a link into
+# another cell: only their neighbours need looking up elsewhere.
+#
+# CellRouter runs the same A* as Router.search, over the same
+# node numbering, costs and heuristic, so it finds the very same
+# routes as the whole graph would.
+#
+# This is a building block on its own: LoadOsm, Router, RouteAdder
+# and batch.py still load and search the whole graph, and there is
+# no one-to-many routing (routesFrom/routesTo) over cells yet.
+#------------------------------------------------------
+import sys
+import math
+import heapq
+from collections import OrderedDict
+import numpy as np
+from compiled import writeSections, readSections
+from osmChange import takeRows
+from stats import stats
+
+def savePartitioned(filename, graph, cellSize=0.05):
+  """Write a graph split into cellSize-degree cells"""
+  n = len(graph.ids)
+  minLat = float(graph.lat.min()) if n else 0.0
+  minLon = float(graph.lon.min()) if n else 0.0
+  rows = np.floor((graph.lat - minLat) / cellSize).astype(np.int64)
+  cols = np.floor((graph.lon - minLon) / cellSize).astype(np.int64)
+  width = int(cols.max()) + 1 if n else 1
+  # Nodes in cell order, and by index within a cell
+  order = np.argsort(rows * width + cols, kind='mergesort')
+  keys, cellStarts, cellOfPosition = np.unique((rows * width + cols)[order],
+    return_index=True, return_inverse=True)
+  cell = np.zeros(n, np.int32)
+  cell[order] = cellOfPosition
+  position = np.zeros(n, np.int32)
+  position[order] = np.arange(n)
+
+  sections = {'ids': graph.ids, 'cell': cell, 'position': position,
+              'cellStarts': np.r_[cellStarts, n].astype(np.int64),
+              'lat': graph.lat[order], 'lon': graph.lon[order]}
+  # The links are shared by every form of transport, each with its
+  # own costs (infinite where it has no access)
+  newOffsets, targets = takeRows(graph.offsets, graph.targets, order)
+  rows = takeRows(graph.offsets, np.arange(len(graph.targets)), order)[1]
+  sources = np.repeat(cellOfPosition, np.diff(newOffsets))
+  leaves = np.flatnonzero(cell[targets] != sources)
+  boundary = np.zeros(n, bool)
+  boundary[np.searchsorted(newOffsets, leaves, 'right') - 1] = True
+  sections['offsets'] = newOffsets
+  sections['targets'] = targets
+  sections['access'] = graph.access[rows]
+  for routeType in graph.transports:
+    sections['costs/' + str(routeType)] = graph.costs(routeType)[rows]
+  sections['boundary'] = boundary
+  writeSections(filename, sections, {
+    'cellSize': cellSize, 'minLat': minLat, 'minLon': minLon,
+    'cells': len(keys), 'routeTypes': sorted(graph.transports),
+    'transports': list(graph.transports),
+    'costScale': dict([(t, graph.costScale(t)) for t in graph.transports]),
+    'graph': graph.fingerprint()})
+
+class Cell:
+  """One cell's nodes, in memory: positions and CSR links (local
+  offsets, global target indices, access bits), with each form of
+  transport's costs of them"""
+  def __init__(self, number, sections, routeTypes):
+    first = sections['cellStarts'].item(number)
+    last = sections['cellStarts'].item(number + 1)
+    offsets = sections['offsets']
+    start = offsets.item(first)
+    end = offsets.item(last)
+    self.number = number
+    self.first = first
+    self.lat = np.array(sections['lat'][first:last])
+    self.lon = np.array(sections['lon'][first:last])
+    self.boundary = np.array(sections['boundary'][first:last])
+    self.offsets = np.array(offsets[first:last + 1]) - start
+    self.targets = np.array(sections['targets'][start:end])
+    self.access = np.array(sections['access'][start:end])
+    size = sum([a.nbytes for a in (self.lat, self.lon, self.boundary,
+                                   self.offsets, self.targets, self.access)])
+    self.links = {}
+    for routeType in routeTypes:
+      costs = np.array(sections['costs/' + routeType][start:end])
+      self.links[routeType] = (self.offsets, self.targets, costs)
+      size = size + costs.nbytes
+    self.size = size
+
+class PartitionedGraph:
+  """A graph written by savePartitioned, with an LRU of loaded cells"""
+  memoryLimit = 64 << 20  # bytes of loaded cells
+
+  def __init__(self, filename, memoryLimit=None):
+    self.sections, self.meta = readSections(filename)
+    if memoryLimit is not None:
+      self.memoryLimit = memoryLimit
+    self.ids = self.sections['ids']
+    self.cellOf = self.sections['cell']
+    self.position = self.sections['position']
+    self.routeTypes = self.meta['routeTypes']
+    self.cells = OrderedDict()
+    self.memorySize = 0
+    self.loads = 0
+    self.evictions = 0
+
+  def __len__(self):
+    return(len(self.ids))
+
+  def fingerprint(self):
+    """The fingerprint of the graph the cells were cut from"""
+    return(self.meta['graph'])
+
+  def costScale(self, routeType):
+    return(self.meta['costScale'][routeType])
+
+  def index(self, id):
+    """Dense index of an OSM node id, or -1 (as RoutingGraph.index)"""
+    i = int(np.searchsorted(self.ids, id))
+    if i < len(self.ids) and self.ids[i] == id:
+      return(i)
+    return(-1)
+
+  def cell(self, number):
+    """A cell, loading it (and evicting others) if need be"""
+    cell = self.cells.pop(number, None)
+    if cell is None:
+      cell = Cell(number, self.sections, self.routeTypes)
+      self.loads = self.loads + 1
+      stats.count('cells.loads')
+      self.memorySize = self.memorySize + cell.size
+      while self.memorySize > self.memoryLimit and self.cells:
+        oldNumber, old = self.cells.popitem(last=False)
+        self.memorySize = self.memorySize - old.size
+        self.evictions = self.evictions + 1
+        stats.count('cells.evictions')
+    self.cells[number] = cell
+    return(cell)
+
+  def locate(self, i):
+    """(cell, place within it) of a dense node index"""
+    cell = self.cell(self.cellOf.item(i))
+    return((cell, self.position.item(i) - cell.first))
+
+class CellRouter:
+  """Router.doRoute's A* over a PartitionedGraph"""
+  def __init__(self, cells):
+    self.cells = cells
+
+  def doRoute(self, start, end, transport, limit=None, mode=None):
+    """Route between OSM node ids: (result, [node ids]) as Router.doRoute.
+    Only A* is offered (mode is accepted for compatibility)."""
+    cells = self.cells
+    if not transport in cells.routeTypes:
+      return('no_such_node',[])
+    s = cells.index(start)
+    e = cells.index(end)
+    if s < 0 or e < 0:
+      return('no_such_node',[])
+    cell, i = cells.locate(s)
+    bit = 1 << cells.meta['transports'].index(transport)
+    if not (cell.access[cell.offsets.item(i):cell.offsets.item(i + 1)] & bit).any():
+      return('no_such_node',[])
+    if s == e:
+      return('success',[start])
+    result, route = self.search(s, e, transport, limit)
+    if result == 'success':
+      route = cells.ids[route].tolist()
+    return(result, route)
+
+  def search(self, start, end, transport, limit=None):
+    """Router.search, fetching links and positions cell by cell.
+    Queue entries carry each node's cell and place in it after the
+    fields Router.search orders by, so the order is unchanged. Cells
+    are looked up in the LRU each time, never held on to."""
+    cells = self.cells
+    cellOf = cells.cellOf.item
+    position = cells.position.item
+    cell = cells.cell
+    endCell = cell(cellOf(end))
+    j = position(end) - endCell.first
+    endLat = endCell.lat.item(j)
+    endLon = endCell.lon.item(j)
+    scale = cells.costScale(transport)
+    sqrt = math.sqrt
+    heappush = heapq.heappush
+    heappop = heapq.heappop
+
+    startCell = cellOf(start)
+    best = {start: 0.0}
+    parent = {start: -1}
+    closed = set()
+    queue = [(0.0, 0.0, start, startCell, position(start) - cell(startCell).first)]
+    count = 0
+    while queue:
+      estimate, distance, x, number, k = heappop(queue)
+      if x in closed:
+        continue
+      if x == end:
+        routeNodes = []
+        while x != -1:
+          routeNodes.append(x)
+          x = parent[x]
+        routeNodes.reverse()
+        return('success', routeNodes)
+      closed.add(x)
+      count = count + 1
+      if limit and count >= limit:
+        return('gave_up',[])
+      here = cell(number)
+      offsets, targets, costs = here.links[transport]
+      first = offsets.item(k)
+      last = offsets.item(k + 1)
+      if first == last:
+        continue
+      # Links from inside a cell stay there, unless it's a boundary node
+      leaves = here.boundary.item(k)
+      for i, cost in zip(targets[first:last].tolist(), costs[first:last].tolist()):
+        if i in closed:
+          continue
+        newDistance = distance + cost
+        if newDistance < best.get(i, newDistance + 1):
+          best[i] = newDistance
+          parent[i] = x
+          other = here
+          if leaves:
+            other = cell(cellOf(i))
+          m = position(i) - other.first
+          dlat = endLat - other.lat.item(m)
+          dlon = endLon - other.lon.item(m)
+          heappush(queue, (newDistance + scale * sqrt(dlat * dlat + dlon * dlon), newDistance, i, other.number, m))
+    return('no_route',[])
+
+if __name__ == "__main__":
+  from loadOsm import LoadOsm
+  data = LoadOsm(sys.argv[1])
+  cellSize = float(sys.argv[2]) if len(sys.argv) > 2 else 0.05
+  print "Partitioning into %g degree cells..." % cellSize
+  savePartitioned(sys.argv[1] + '.cells', data.graph, cellSize)
+  print "Done"
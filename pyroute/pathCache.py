@@ -0,0 +1,343 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Persistent cache of routes between pairs of nodes
+#
+#------------------------------------------------------
+# Usage:
+#   cache = PathCache('cached/paths.sqlite', data.graph)
+#   result, route = cache.route(router, start, end, 'car')
+#   print cache.stats()
+#
+# Routes live in one SQLite file, keyed by the fingerprint of the
+# graph they were found on, the form of transport and the (start,
+# end) pair, so a changed map never serves old routes. Node lists
+# are stored delta + varint coded, as in PBF files. A small LRU of
+# recently used entries, bounded by size, sits in front of the
+# file. Hits and misses are also counted in stats.py's figures.
+# The fingerprint is read from the graph at every lookup, so routes
+# found before a profile changed its weights (registerProfile)
+# aren't served after it, from either the file or memory.
+#
+# When the graph is changed in place (LoadOsm.applyChange), update()
+# carries the routes over, dropping only those the change may have
+# made wrong. Several processes can share the file: SQLite's write-ahead
+# log lets readers carry on while one process writes.
+#------------------------------------------------------
+import os
+import sqlite3
+from collections import OrderedDict
+import numpy as np
+from pbf import encodeVarint, encodeZigzag, deltas
+from stats import stats
+
+# Results which will come out the same next time, and so are worth
+# keeping (unlike 'gave_up', which depends on the search limit)
+cacheable = ('success', 'no_route', 'no_such_node')
+
+def encodePath(path):
+  """Node ids -> delta-coded zigzag varints"""
+  last = 0
+  coded = []
+  for node in path:
+    coded.append(encodeVarint(encodeZigzag(node - last)))
+    last = node
+  return(''.join(coded))
+
+def decodePath(data):
+  return(deltas(data).tolist())
+
+def routeCosts(graph, routeType, routes):
+  """Cost of each route (a list of OSM ids) over a graph's links;
+  infinity for routes which use a link the graph doesn't have"""
+  lengths = np.array([len(route) for route in routes], np.int64)
+  costs = np.zeros(len(routes))
+  if not lengths.sum():
+    return(costs)
+  nodes = graph.indices(np.concatenate([np.asarray(r, np.int64) for r in routes])).astype(np.int64)
+  # Consecutive nodes of the same route are a link; links are stored
+  # sorted by (source, target), so each is found by one binary search
+  # (links routeType has no access to cost infinity)
+  routeOf = np.repeat(np.arange(len(routes)), lengths)
+  link = routeOf[1:] == routeOf[:-1]
+  n = len(graph.ids)
+  linkKeys = graph.sources().astype(np.int64) * n + graph.targets
+  keys = nodes[:-1][link] * n + nodes[1:][link]
+  found = np.searchsorted(linkKeys, keys)
+  found[found >= len(linkKeys)] = 0
+  linkCosts = graph.costs(routeType)[found]
+  missing = (linkKeys[found] != keys) | (nodes[:-1][link] < 0) | (nodes[1:][link] < 0)
+  linkCosts[missing] = np.inf
+  costs += np.bincount(routeOf[1:][link], linkCosts, len(routes))
+  return(costs)
+
+class PathCache:
+  """Routes by (graph, transport, start, end), on disk and in memory"""
+  memoryLimit = 16 << 20  # bytes of encoded routes kept in memory
+  entryOverhead = 100     # rough bytes per in-memory entry besides the route
+
+  def __init__(self, filename, graph, memoryLimit=None):
+    self.filename = filename
+    self.graph = graph
+    if memoryLimit is not None:
+      self.memoryLimit = memoryLimit
+    self.memory = OrderedDict()
+    self.memorySize = 0
+    self.connection = None
+    self.inherited = []
+    self.pid = None
+    self.hits = 0
+    self.memoryHits = 0
+    self.misses = 0
+    self.db()
+
+  def db(self):
+    """This process's connection (a forked worker opens its own)"""
+    if self.pid != os.getpid():
+      # Never close a connection inherited across fork(); just leave it be
+      if self.connection is not None:
+        self.inherited.append(self.connection)
+      self.connection = sqlite3.connect(self.filename, timeout=60,
+                                        isolation_level=None)
+      self.connection.text_factory = str
+      self.connection.execute("PRAGMA journal_mode=WAL")
+      self.connection.execute("PRAGMA synchronous=NORMAL")
+      self.connection.execute(
+        "CREATE TABLE IF NOT EXISTS paths ("
+        " graph TEXT, transport TEXT, start INTEGER, end INTEGER,"
+        " result TEXT, path BLOB,"
+        " PRIMARY KEY (graph, transport, start, end))")
+      self.pid = os.getpid()
+    return(self.connection)
+
+  def remember(self, key, value):
+    if key in self.memory:
+      self.memorySize = self.memorySize - self.entrySize(self.memory.pop(key))
+    self.memory[key] = value
+    self.memorySize = self.memorySize + self.entrySize(value)
+    while self.memorySize > self.memoryLimit and self.memory:
+      oldKey, old = self.memory.popitem(last=False)
+      self.memorySize = self.memorySize - self.entrySize(old)
+
+  def entrySize(self, value):
+    return(len(value[1]) + self.entryOverhead)
+
+  def get(self, start, end, transport):
+    """Cached (result, route), or None"""
+    fingerprint = self.graph.fingerprint()
+    key = (fingerprint, transport, start, end)
+    value = self.memory.pop(key, None)
+    if value is not None:
+      self.memory[key] = value
+      self.hits = self.hits + 1
+      self.memoryHits = self.memoryHits + 1
+      stats.count('pathCache.memoryHits')
+      return((value[0], decodePath(value[1])))
+    row = self.db().execute(
+      "SELECT result, path FROM paths"
+      " WHERE graph=? AND transport=? AND start=? AND end=?",
+      (fingerprint, transport, start, end)).fetchone()
+    if row is None:
+      self.misses = self.misses + 1
+      stats.count('pathCache.misses')
+      return(None)
+    value = (row[0], str(row[1]))
+    self.remember(key, value)
+    self.hits = self.hits + 1
+    stats.count('pathCache.diskHits')
+    return((value[0], decodePath(value[1])))
+
+  def put(self, start, end, transport, result, route):
+    if result not in cacheable:
+      return
+    fingerprint = self.graph.fingerprint()
+    value = (result, encodePath(route))
+    self.remember((fingerprint, transport, start, end), value)
+    self.db().execute(
+      "INSERT OR REPLACE INTO paths VALUES (?, ?, ?, ?, ?, ?)",
+      (fingerprint, transport, start, end, value[0], sqlite3.Binary(value[1])))
+
+  def route(self, router, start, end, transport):
+    """router.doRoute(start, end, transport), through the cache"""
+    cached = self.get(start, end, transport)
+    if cached is not None:
+      return(cached)
+    result, route = router.doRoute(start, end, transport)
+    self.put(start, end, transport, result, route)
+    return((result, route))
+
+  def update(self, change, graph):
+    """Carry the routes found on the graph before a change (a
+    GraphChange from LoadOsm.applyChange) over to graph, the graph
+    after it. Dropped are:
+      routes using a node on a link which went away or got dearer
+      routes which one of the new or cheaper links shortens: the route
+        to the link, along it and on from it costs less. A straight-line
+        bound, then one through the nearest of the links, rule out most
+        routes; the rest are checked by searches from each link's ends,
+        bounded by the routes' costs (or just dropped, where that would
+        take more searches than finding them again)
+      failed searches, where any link is new or cheaper, and lookups of
+        nodes the change touched
+    Returns (kept, dropped)."""
+    db = self.db()
+    self.graph = graph
+    cursor = db.execute(
+      "SELECT transport, start, end, result, path FROM paths WHERE graph=?",
+      (change.before,))
+    total = 0
+    stale = []
+    while True:
+      rows = cursor.fetchmany(10000)
+      if not rows:
+        break
+      total = total + len(rows)
+      stale.extend(self.staleRows(change, graph, rows))
+    db.execute("BEGIN")
+    try:
+      db.executemany(
+        "DELETE FROM paths WHERE graph=? AND transport=? AND start=? AND end=?",
+        [(change.before,) + key for key in stale])
+      db.execute("UPDATE OR IGNORE paths SET graph=? WHERE graph=?",
+                 (change.after, change.before))
+      db.execute("COMMIT")
+    except:
+      db.execute("ROLLBACK")
+      raise
+    # Move the in-memory entries over too, less the stale ones
+    stale = set(stale)
+    memory = OrderedDict()
+    for key, value in self.memory.items():
+      if key[0] == change.before:
+        if key[1:] in stale:
+          self.memorySize = self.memorySize - self.entrySize(value)
+          continue
+        key = (change.after,) + key[1:]
+      memory[key] = value
+    self.memory = memory
+    stats.count('pathCache.updateKept', total - len(stale))
+    stats.count('pathCache.updateDropped', len(stale))
+    return((total - len(stale), len(stale)))
+
+  def staleRows(self, change, graph, rows):
+    """Keys (transport, start, end) of the rows a change may have made
+    wrong (see update)"""
+    stale = []
+    touched = set(change.nodes.tolist())
+    byTransport = {}
+    for transport, start, end, result, path in rows:
+      key = (str(transport), start, end)
+      if not transport in change.worse:
+        continue  # a form of transport the graph doesn't have
+      better = change.better[transport]
+      if result == 'no_such_node':
+        if start in touched or end in touched:
+          stale.append(key)
+      elif result != 'success':
+        if len(better[0]):
+          stale.append(key)
+      else:
+        byTransport.setdefault(transport, []).append((key, decodePath(str(path))))
+
+    for transport, found in byTransport.items():
+      keys = [key for key, route in found]
+      routes = [route for key, route in found]
+      worse = change.worse[transport]
+      lengths = np.array([len(route) for route in routes], np.int64)
+      nodes = np.concatenate([np.asarray(route, np.int64) for route in routes])
+      routeOf = np.repeat(np.arange(len(routes)), lengths)
+      isStale = np.zeros(len(routes), bool)
+      isStale[routeOf[np.in1d(nodes, worse)]] = True
+
+      fr, to, cost = change.better[transport]
+      if len(fr):
+        # The cheapest route through link (u, v) costs at least
+        # scale * |s - u| + cost(u, v) + scale * |v - e|, which rules
+        # some links out for some routes without searching
+        costs = routeCosts(graph, transport, routes)
+        scale = graph.costScale(transport)
+        def position(ids):
+          i = graph.indices(ids)
+          return(graph.lat[i], graph.lon[i])
+        starts = graph.indices([route[0] for route in routes])
+        ends = graph.indices([route[-1] for route in routes])
+        sLat, sLon = graph.lat[starts], graph.lon[starts]
+        eLat, eLon = graph.lat[ends], graph.lon[ends]
+        uLat, uLon = position(fr)
+        vLat, vLon = position(to)
+        u = graph.indices(fr).tolist()
+        v = graph.indices(to).tolist()
+        isStale |= ~np.isfinite(costs)
+        step = max(1, 4000000 // len(routes))
+        def maybe(part):
+          toLink = np.hypot(sLat[:, None] - uLat[None, part], sLon[:, None] - uLon[None, part])
+          fromLink = np.hypot(vLat[None, part] - eLat[:, None], vLon[None, part] - eLon[:, None])
+          bound = scale * (toLink + fromLink) + cost[None, part]
+          return((bound < costs[:, None] * (1 - 1e-9)) & ~isStale[:, None])
+        parts = [slice(first, first + step) for first in xrange(0, len(fr), step)]
+        which = np.zeros(len(routes), bool)
+        for part in parts:
+          which |= maybe(part).any(axis=1)
+        which = np.flatnonzero(which)
+        if len(which):
+          # Then by the cheapest way onto any of the links and off any:
+          # one search back from all their starts, one on from their ends
+          limit = costs[which].max()
+          start = {}
+          for x, c in zip(u, cost.tolist()):
+            start[x] = min(c, start.get(x, np.inf))
+          toAny = graph.dijkstra(start, transport, set(starts[which].tolist()),
+                                 True, limit)[0]
+          fromAny = graph.dijkstra(dict.fromkeys(v, 0.0), transport,
+                                   set(ends[which].tolist()), False, limit)[0]
+          through = np.array([toAny.get(x, np.inf) for x in starts[which].tolist()]) + \
+            np.array([fromAny.get(x, np.inf) for x in ends[which].tolist()])
+          which = which[through < costs[which] * (1 - 1e-9)]
+        candidate = np.zeros(len(routes), bool)
+        candidate[which] = True
+        links = sum([int((maybe(part) & candidate[:, None]).any(axis=0).sum())
+                     for part in parts]) if len(which) else 0
+        if 2 * links > len(which):
+          # Searching from each link would cost more than finding the
+          # routes again
+          isStale |= candidate
+          links = 0
+        for part in parts if links else ():
+          near = maybe(part) & candidate[:, None]
+          # The rest by the real cost: d(s, u) + cost(u, v) + d(v, e),
+          # searching back from u and on from v only as far as the
+          # dearest of the routes the link might shorten
+          for link in np.flatnonzero(near.any(axis=0)).tolist():
+            which = np.flatnonzero(near[:, link] & ~isStale)
+            if not len(which):
+              continue
+            link = part.start + link
+            limit = costs[which].max() - cost[link]
+            toU = graph.dijkstra(u[link], transport, set(starts[which].tolist()),
+                                 True, limit)[0]
+            fromV = graph.dijkstra(v[link], transport, set(ends[which].tolist()),
+                                   False, limit)[0]
+            through = np.array([toU.get(x, np.inf) for x in starts[which].tolist()]) + \
+              cost[link] + np.array([fromV.get(x, np.inf) for x in ends[which].tolist()])
+            isStale[which[through < costs[which] * (1 - 1e-9)]] = True
+      stale.extend([key for key, s in zip(keys, isStale.tolist()) if s])
+    return(stale)
+
+  def prune(self):
+    """Drop routes found on any other graph"""
+    self.db().execute("DELETE FROM paths WHERE graph != ?",
+                      (self.graph.fingerprint(),))
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return({'hits': self.hits,
+      'memoryHits': self.memoryHits,
+      'misses': self.misses,
+      'hitRate': float(self.hits) / lookups if lookups else 0.0,
+      'memoryEntries': len(self.memory),
+      'memoryBytes': self.memorySize})
+
+  def close(self):
+    if self.connection is not None and self.pid == os.getpid():
+      self.connection.close()
+    self.connection = None
+    self.pid = None
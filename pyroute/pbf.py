@@ -0,0 +1,436 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Reader (and small writer) for the OSM PBF format
+#
+#------------------------------------------------------
+# Usage:
+#   reader = PbfReader(onWay=storeWay, wayKeys=('highway',))
+#   reader.read('data/map.osm.pbf')
+#
+#   writePbf('fixture.osm.pbf', nodes, ways)
+#
+# Self-contained: the handful of protobuf messages used by
+# OSM (fileformat.proto, osmformat.proto) are decoded by hand,
+# with packed arrays decoded by numpy. Data blocks are
+# decompressed and decoded in parallel by a process pool, and
+# handed to the callbacks in file order.
+#------------------------------------------------------
+import struct
+import zlib
+import multiprocessing
+import numpy as np
+
+supportedFeatures = ('OsmSchema-V0.6', 'DenseNodes')
+
+#------------------------------------------------------
+# Protobuf wire format
+#------------------------------------------------------
+def varint(buf, pos):
+  """Decode one varint from buf at pos; returns (value, next pos)"""
+  result = 0
+  shift = 0
+  while 1:
+    b = ord(buf[pos])
+    pos = pos + 1
+    result = result | ((b & 0x7f) << shift)
+    if b < 0x80:
+      return(result, pos)
+    shift = shift + 7
+
+def signed(n):
+  """Reinterpret a decoded (non-zigzag) varint as a signed 64-bit int"""
+  if n >= 1 << 63:
+    return(n - (1 << 64))
+  return(n)
+
+def fields(buf):
+  """Yield (field number, value) for each field of a message.
+  Length-delimited fields come back as strings, fixed-size ones raw."""
+  pos = 0
+  end = len(buf)
+  while pos < end:
+    key, pos = varint(buf, pos)
+    wire = key & 7
+    if wire == 0:
+      value, pos = varint(buf, pos)
+    elif wire == 2:
+      size, pos = varint(buf, pos)
+      value = buf[pos:pos + size]
+      pos = pos + size
+    elif wire == 1:
+      value = buf[pos:pos + 8]
+      pos = pos + 8
+    elif wire == 5:
+      value = buf[pos:pos + 4]
+      pos = pos + 4
+    else:
+      raise ValueError("Unsupported protobuf wire type %d" % wire)
+    yield(key >> 3, value)
+
+def packed(buf):
+  """Decode a packed field of varints into a uint64 array"""
+  b = np.frombuffer(buf, np.uint8)
+  if not len(b):
+    return(np.zeros(0, np.uint64))
+  ends = np.flatnonzero(b < 0x80)
+  b = b[:ends[-1] + 1]
+  starts = np.zeros(len(ends), np.int64)
+  starts[1:] = ends[:-1] + 1
+  shift = (np.arange(len(b)) - np.repeat(starts, ends - starts + 1)) * 7
+  values = (b & 0x7f).astype(np.uint64) << shift.astype(np.uint64)
+  return(np.bitwise_or.reduceat(values, starts))
+
+def unzigzag(n):
+  """Decode one zigzag-encoded (sint64) value"""
+  return((n >> 1) ^ -(n & 1))
+
+def zigzag(values):
+  """Decode zigzag-encoded (sint64) values"""
+  values = values.astype(np.uint64)
+  return((values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64))
+
+def deltas(buf):
+  """Decode a packed, delta-coded sint64 field"""
+  return(np.cumsum(zigzag(packed(buf))))
+
+#------------------------------------------------------
+# Decoding of blobs (runs in the worker processes)
+#------------------------------------------------------
+def blobData(blob):
+  """Uncompressed contents of a Blob message"""
+  for number, value in fields(blob):
+    if number == 1:
+      return(value)
+    if number == 3:
+      return(zlib.decompress(value))
+    if number in (4, 5, 6, 7):
+      raise ValueError("Unsupported PBF blob compression")
+  return('')
+
+def wanted(keys, key):
+  return(keys is None or key in keys)
+
+def decodeTags(keys, vals, strings, wantedKeys, internStrings):
+  tags = {}
+  for k, v in zip(keys, vals):
+    k = strings[k]
+    if wanted(wantedKeys, k):
+      if internStrings:
+        tags[intern(k)] = intern(strings[v])
+      else:
+        tags[k] = strings[v]
+  return(tags)
+
+def decodeBlock(job):
+  """Decode one OSMData blob.
+
+  Returns (hasNodes, hasWays, nodes, tagged, ways) where nodes is an
+  (ids, lats, lons) tuple of arrays, tagged is a list of
+  (id, lat, lon, tags) for nodes carrying any of nodeKeys and ways is
+  a list of (id, refs, tags)."""
+  blob, wantNodes, wantWays, nodeKeys, wayKeys = job
+  data = blobData(blob)
+  strings = []
+  groups = []
+  granularity = 100
+  latOffset = 0
+  lonOffset = 0
+  for number, value in fields(data):
+    if number == 1:
+      strings = [s for n, s in fields(value) if n == 1]
+    elif number == 2:
+      groups.append(value)
+    elif number == 17:
+      granularity = value
+    elif number == 19:
+      latOffset = signed(value)
+    elif number == 20:
+      lonOffset = signed(value)
+
+  hasNodes = False
+  hasWays = False
+  ids = []
+  lats = []
+  lons = []
+  tagged = []
+  ways = []
+  if nodeKeys is None:
+    keyIndices = None
+  else:
+    keyIndices = [i for i, s in enumerate(strings) if s in nodeKeys]
+
+  for group in groups:
+    for number, value in fields(group):
+      if number == 1:
+        hasNodes = True
+        if not wantNodes:
+          continue
+        id = 0
+        lat = lon = 0
+        keys = vals = []
+        for n, v in fields(value):
+          if n == 1:
+            id = unzigzag(v)
+          elif n == 2:
+            keys = packed(v).tolist()
+          elif n == 3:
+            vals = packed(v).tolist()
+          elif n == 8:
+            lat = unzigzag(v)
+          elif n == 9:
+            lon = unzigzag(v)
+        lat = 1e-9 * (latOffset + granularity * lat)
+        lon = 1e-9 * (lonOffset + granularity * lon)
+        ids.append(np.array([id], np.int64))
+        lats.append(np.array([lat]))
+        lons.append(np.array([lon]))
+        if keys and (keyIndices is None or set(keys) & set(keyIndices)):
+          tags = decodeTags(keys, vals, strings, nodeKeys, False)
+          tagged.append((id, lat, lon, tags))
+      elif number == 2:
+        hasNodes = True
+        if not wantNodes:
+          continue
+        denseIds = denseLat = denseLon = None
+        keysVals = None
+        for n, v in fields(value):
+          if n == 1:
+            denseIds = deltas(v)
+          elif n == 8:
+            denseLat = deltas(v)
+          elif n == 9:
+            denseLon = deltas(v)
+          elif n == 10:
+            keysVals = packed(v).astype(np.int64)
+        if denseIds is None:
+          continue
+        denseLat = 1e-9 * (latOffset + granularity * denseLat)
+        denseLon = 1e-9 * (lonOffset + granularity * denseLon)
+        ids.append(denseIds)
+        lats.append(denseLat)
+        lons.append(denseLon)
+        if keysVals is None or not len(keysVals):
+          continue
+        if keyIndices is not None and not np.in1d(keysVals, keyIndices).any():
+          continue
+        # keys_vals holds k,v,k,v,...,0 for each node in turn
+        keysVals = keysVals.tolist()
+        pos = 0
+        for j in xrange(len(denseIds)):
+          keys = []
+          vals = []
+          while pos < len(keysVals) and keysVals[pos] != 0:
+            keys.append(keysVals[pos])
+            vals.append(keysVals[pos + 1])
+            pos = pos + 2
+          pos = pos + 1
+          if keys and (keyIndices is None or set(keys) & set(keyIndices)):
+            tags = decodeTags(keys, vals, strings, nodeKeys, False)
+            tagged.append((denseIds.item(j), denseLat.item(j), denseLon.item(j), tags))
+      elif number == 3:
+        hasWays = True
+        if not wantWays:
+          continue
+        id = 0
+        keys = vals = []
+        refs = []
+        for n, v in fields(value):
+          if n == 1:
+            id = signed(v)
+          elif n == 2:
+            keys = packed(v).tolist()
+          elif n == 3:
+            vals = packed(v).tolist()
+          elif n == 8:
+            refs = deltas(v).tolist()
+        ways.append((id, refs, decodeTags(keys, vals, strings, wayKeys, True)))
+
+  if ids:
+    nodes = (np.concatenate(ids), np.concatenate(lats), np.concatenate(lons))
+  else:
+    nodes = (np.zeros(0, np.int64), np.zeros(0), np.zeros(0))
+  return(hasNodes, hasWays, nodes, tagged, ways)
+
+#------------------------------------------------------
+# Reader
+#------------------------------------------------------
+class PbfReader:
+  """Calls the same callbacks as OsmReader while reading a .osm.pbf file.
+
+  onNodeArrays(ids, lats, lons) -- if set, receives every node in
+    batches, and onNode is then only called for nodes carrying one
+    of nodeKeys
+  processes -- size of the decoding pool (default: one per CPU;
+    1 decodes in this process)
+
+  A reader remembers which blocks held nodes and which held ways, so
+  a second read() of the same file (e.g. nodes after ways) skips the
+  blocks that can't contain anything wanted."""
+  def __init__(self, onNode=None, onWay=None, nodeKeys=(), wayKeys=(),
+               onNodeArrays=None, processes=None):
+    self.onNode = onNode
+    self.onWay = onWay
+    self.onNodeArrays = onNodeArrays
+    self.nodeKeys = nodeKeys
+    self.wayKeys = wayKeys
+    self.processes = processes
+    self.kinds = {}  # (filename, offset) -> (hasNodes, hasWays)
+
+  def read(self, filename):
+    wantNodes = bool(self.onNode or self.onNodeArrays)
+    wantWays = bool(self.onWay)
+    processes = self.processes or multiprocessing.cpu_count()
+    f = open(filename, 'rb')
+    self.pool = None
+    try:
+      batch = []
+      for offset, blob in self.blobs(f, filename, wantNodes, wantWays):
+        batch.append((offset, (blob, wantNodes, wantWays, self.nodeKeys, self.wayKeys)))
+        # Only a few blocks per worker are in flight, bounding memory
+        if len(batch) >= 4 * processes:
+          self.deliver(filename, batch, processes)
+          batch = []
+      self.deliver(filename, batch, processes)
+    finally:
+      f.close()
+      if self.pool:
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+  def blobs(self, f, filename, wantNodes, wantWays):
+    """Yield (offset, blob) for each OSMData blob worth decoding"""
+    while 1:
+      offset = f.tell()
+      size = f.read(4)
+      if len(size) < 4:
+        return
+      header = dict(fields(f.read(struct.unpack('>I', size)[0])))
+      kind = header.get(1)
+      dataSize = header.get(3, 0)
+      if kind == 'OSMHeader':
+        self.checkHeader(blobData(f.read(dataSize)))
+        continue
+      known = self.kinds.get((filename, offset))
+      if kind != 'OSMData' or (known and not ((wantNodes and known[0]) or (wantWays and known[1]))):
+        f.seek(dataSize, 1)
+        continue
+      yield(offset, f.read(dataSize))
+
+  def checkHeader(self, data):
+    for number, value in fields(data):
+      if number == 4 and value not in supportedFeatures:
+        raise ValueError("Unsupported PBF feature %s" % value)
+
+  def deliver(self, filename, batch, processes):
+    if not batch:
+      return
+    jobs = [job for offset, job in batch]
+    if processes > 1 and len(jobs) > 1 and not self.pool:
+      self.pool = multiprocessing.Pool(processes)
+    if self.pool:
+      results = self.pool.map(decodeBlock, jobs)
+    else:
+      results = map(decodeBlock, jobs)
+    for (offset, job), result in zip(batch, results):
+      hasNodes, hasWays, nodes, tagged, ways = result
+      self.kinds[(filename, offset)] = (hasNodes, hasWays)
+      if self.onNodeArrays:
+        if len(nodes[0]):
+          self.onNodeArrays(*nodes)
+        if self.onNode:
+          for node in tagged:
+            self.onNode(*node)
+      elif self.onNode:
+        taggedIds = dict([(node[0], node[3]) for node in tagged])
+        for id, lat, lon in zip(*[column.tolist() for column in nodes]):
+          self.onNode(id, lat, lon, taggedIds.get(id, {}))
+      if self.onWay:
+        for way in ways:
+          self.onWay(*way)
+
+#------------------------------------------------------
+# Writer (for fixtures and converting small extracts)
+#------------------------------------------------------
+def encodeVarint(n):
+  out = []
+  while 1:
+    b = n & 0x7f
+    n = n >> 7
+    if n:
+      out.append(chr(b | 0x80))
+    else:
+      out.append(chr(b))
+      return(''.join(out))
+
+def encodeZigzag(n):
+  return((n << 1) ^ (n >> 63))
+
+def field(number, value):
+  """Encode one field: ints as varints, strings as length-delimited"""
+  if isinstance(value, str):
+    return(encodeVarint((number << 3) | 2) + encodeVarint(len(value)) + value)
+  return(encodeVarint(number << 3) + encodeVarint(value))
+
+def packedField(number, values):
+  return(field(number, ''.join([encodeVarint(v) for v in values])))
+
+def deltaField(number, values):
+  last = 0
+  coded = []
+  for v in values:
+    coded.append(encodeZigzag(v - last))
+    last = v
+  return(packedField(number, coded))
+
+def blobField(kind, data, compress):
+  if compress:
+    blob = field(2, len(data)) + field(3, zlib.compress(data))
+  else:
+    blob = field(1, data)
+  header = field(1, kind) + field(3, len(blob))
+  return(struct.pack('>I', len(header)) + header + blob)
+
+def writePbf(filename, nodes, ways, blockSize=8000, compress=True):
+  """Write a small .osm.pbf file.
+
+  nodes -- [(id, lat, lon, tags)], written as DenseNodes
+  ways -- [(id, refs, tags)]"""
+  f = open(filename, 'wb')
+  header = ''.join([field(4, feature) for feature in supportedFeatures])
+  f.write(blobField('OSMHeader', header, compress))
+  for kind, items in (('nodes', nodes), ('ways', ways)):
+    for first in range(0, len(items), blockSize):
+      strings = ['']
+      index = {}
+      def string(s):
+        if isinstance(s, unicode):
+          s = s.encode('utf-8')
+        if not s in index:
+          index[s] = len(strings)
+          strings.append(s)
+        return(index[s])
+      block = items[first:first + blockSize]
+      if kind == 'nodes':
+        keysVals = []
+        for id, lat, lon, tags in block:
+          for k, v in sorted(tags.items()):
+            keysVals.extend((string(k), string(v)))
+          keysVals.append(0)
+        group = deltaField(1, [n[0] for n in block])
+        group = group + deltaField(8, [int(round(n[1] * 1e7)) for n in block])
+        group = group + deltaField(9, [int(round(n[2] * 1e7)) for n in block])
+        group = field(2, group + packedField(10, keysVals))
+      else:
+        group = ''
+        for id, refs, tags in block:
+          tags = sorted(tags.items())
+          way = field(1, id)
+          way = way + packedField(2, [string(k) for k, v in tags])
+          way = way + packedField(3, [string(v) for k, v in tags])
+          way = way + deltaField(8, refs)
+          group = group + field(3, way)
+      table = ''.join([field(1, s) for s in strings])
+      data = field(1, table) + field(2, group)
+      f.write(blobField('OSMData', data, compress))
+  f.close()
@@ -6,6 +6,8 @@
 # Usage as library: 
 #   router = Router(LoadOsmObject)
 #   result, route = router.doRoute(node1, node2, transport)
+#   routes = router.routesFrom(node1, [node2, node3], transport)
+#   cost, parent = router.searchWithin(node1, transport, budget)
 #
 # Usage from command-line:
 #   route.py filename.osm node1 node2 transport
@@ -33,7 +35,10 @@
 #------------------------------------------------------
 import sys
 import math 
+import heapq
+import time
 from loadOsm import *
+from stats import stats
 
 class Router:
   def __init__(self, data):
@@ -58,75 +63,314 @@ class Router:
       lat,lon = self.data.nodes[node]
       pos.append((lat,lon))
     return(result,pos)
-  def doRoute(self,start,end,transport):
-    """Do the routing"""
-    self.searchEnd = end
-    closed = [start]
-    self.queue = []
-    
-    # Start by queueing all outbound links from the start node
-    blankQueueItem = {'end':-1,'distance':0,'nodes':str(start)}
-    try:
-      for i, weight in self.data.routing[transport][start].items():
-        self.addToQueue(start,i, blankQueueItem, weight)
-    except KeyError:
+  def heuristicScale(self,transport):
+    """Smallest cost per unit of distance for a form of transport.
+    Edges cost distance/weight, so dividing by the largest weight gives
+    a lower bound on the remaining cost (keeps A* admissible)"""
+    return(self.data.graph.costScale(transport))
+  def searched(self,kind,started,result,settled,stale,queued):
+    """Record a finished search, if stats are enabled (started is then
+    its start time). Every push is popped or still queued, and every
+    pop settles a node or finds it settled already (stale), so the
+    heap traffic follows without counting it node by node."""
+    if started:
+      pops = settled + stale
+      stats.search(kind, time.time() - started, result, settled, pops, pops + queued)
+  def doRoute(self,start,end,transport,limit=None,mode=None):
+    """Do the routing
+
+    limit -- optional maximum number of nodes to settle before giving up
+    mode -- 'astar' (A* search over a binary heap), 'bidirectional'
+      (A* from both ends at once) or 'ch' (query the transport's
+      contraction hierarchy). By default the hierarchy is used when
+      one is loaded, and A* otherwise. Either A* runs over the graph
+      with its chains collapsed if data.chains is set (see chains.py)"""
+    graph = self.data.graph
+    if not transport in graph.weights:
       return('no_such_node',[])
-    
-    # Limit for how long it will search
-    count = 0
-    while count < 10000:
-      count = count + 1
-      try:
-        nextItem = self.queue.pop(0)
-      except IndexError:
-        # Queue is empty: failed
+    s = graph.index(start)
+    e = graph.index(end)
+    if s < 0 or e < 0 or not graph.degree(s, transport):
+      return('no_such_node',[])
+    if s == e:
+      return('success',[start])
+    if graph.components(transport).unreachable(s, e):
+      # Rather than searching everything reachable to find that out
+      stats.count('route.unreachable')
+      return('no_route',[])
+    hierarchy = self.data.hierarchies.get(transport)
+    if mode == 'ch' or (mode is None and hierarchy):
+      if not hierarchy:
+        return('no_hierarchy',[])
+      cost, route = hierarchy.query(s, e)
+      if cost is None:
         return('no_route',[])
-      x = nextItem['end']
+      return('success', graph.ids[route].tolist())
+    chains = self.data.chains
+    if chains is not None:
+      extra = chains.extraLinks(s, e, transport)
+      search = (chains.graph, extra)
+    else:
+      search = (None, ({}, {}))
+    if mode == 'bidirectional':
+      result, route = self.searchBoth(s, e, transport, limit, *search)
+    else:
+      result, route = self.search(s, e, transport, limit, search[0], search[1][0])
+    if result == 'success':
+      if chains is not None:
+        route = chains.expand(route)
+      route = graph.ids[route].tolist()
+    return(result, route)
+
+  def search(self,start,end,transport,limit=None,graph=None,extra={}):
+    """A* between two dense node indices; returns (result, [indices])
+
+    graph -- the RoutingGraph to search, if not data.graph
+    extra -- {index: [(index, cost)]} of links to follow besides the graph's"""
+    if graph is None:
+      graph = self.data.graph
+    offsets = graph.offsets
+    targets = graph.targets
+    costs = graph.costs(transport)
+    lat = graph.lat.item
+    lon = graph.lon.item
+    offset = offsets.item
+    endLat = lat(end)
+    endLon = lon(end)
+    scale = self.heuristicScale(transport)
+    sqrt = math.sqrt
+    heappush = heapq.heappush
+    heappop = heapq.heappop
+
+    started = stats.enabled and time.time()
+    best = {start: 0.0}
+    parent = {start: -1}
+    closed = set()
+    queue = [(0.0, 0.0, start)]
+    count = 0
+    stale = 0
+    while queue:
+      estimate, distance, x = heappop(queue)
       if x in closed:
+        stale = stale + 1
         continue
       if x == end:
-        # Found the end node - success
-        routeNodes = [int(i) for i in nextItem['nodes'].split(",")]
+        # Found the end node - follow the parent pointers back
+        routeNodes = []
+        while x != -1:
+          routeNodes.append(x)
+          x = parent[x]
+        routeNodes.reverse()
+        self.searched('astar', started, 'success', count + 1, stale, len(queue))
         return('success', routeNodes)
-      closed.append(x)
-      try:
-        for i, weight in self.data.routing[transport][x].items():
-          if not i in closed:
-            self.addToQueue(x,i,nextItem, weight)
-      except KeyError:
-        pass
-    else:
-      return('gave_up',[])
-  
-  def addToQueue(self,start,end, queueSoFar, weight = 1):
-    """Add another potential route to the queue"""
-    
-    # If already in queue
-    for test in self.queue:
-      if test['end'] == end:
-        return
-    distance = self.distance(start, end)
-    if(weight == 0):
-      return
-    distance = distance / weight
-    
-    # Create a hash for all the route's attributes
-    distanceSoFar = queueSoFar['distance']
-    queueItem = { \
-      'distance': distanceSoFar + distance,
-      'maxdistance': distanceSoFar + self.distance(end, self.searchEnd),
-      'nodes': queueSoFar['nodes'] + "," + str(end),
-      'end': end}
-    
-    # Try to insert, keeping the queue ordered by decreasing worst-case distance
+      closed.add(x)
+      count = count + 1
+      if limit and count >= limit:
+        self.searched('astar', started, 'gave_up', count, stale, len(queue))
+        return('gave_up',[])
+      first = offset(x)
+      last = offset(x + 1)
+      links = zip(targets[first:last].tolist(), costs[first:last].tolist())
+      if x in extra:
+        links.extend(extra[x])
+      for i, cost in links:
+        if i in closed:
+          continue
+        # Unusable links cost infinity, so never pass this test
+        newDistance = distance + cost
+        if newDistance < best.get(i, newDistance + 1):
+          best[i] = newDistance
+          parent[i] = x
+          dlat = endLat - lat(i)
+          dlon = endLon - lon(i)
+          heappush(queue, (newDistance + scale * sqrt(dlat * dlat + dlon * dlon), newDistance, i))
+    # Queue is empty: failed
+    self.searched('astar', started, 'no_route', count, stale, 0)
+    return('no_route',[])
+
+  def searchBoth(self,start,end,transport,limit=None,graph=None,extra=({}, {})):
+    """Bidirectional A* between two dense node indices: forwards from
+    start and backwards (over the reversed links, so one-way streets
+    are followed the right way) from end. Returns (result, [indices]).
+    graph and extra are as for search, extra being a pair of
+    {index: [(index, cost)]}: links forwards, and links backwards.
+
+    Both directions share one consistent potential, half the difference
+    of the straight-line estimates to end and from start (negated
+    backwards). Keys are distances reduced by it, counted from 0 at
+    each search's source, so a route through the best meeting point is
+    shortest once the two queues' smallest keys add up to at least its
+    reduced cost: its cost plus potential(end) - potential(start)."""
+    if graph is None:
+      graph = self.data.graph
+    reverseOffsets, sources, reverseCosts = graph.reverse(transport)
+    links = ((graph.offsets.item, graph.targets, graph.costs(transport)),
+             (reverseOffsets.item, sources, reverseCosts))
+    lat = graph.lat.item
+    lon = graph.lon.item
+    startLat, startLon = lat(start), lon(start)
+    endLat, endLon = lat(end), lon(end)
+    half = 0.5 * self.heuristicScale(transport)
+    sqrt = math.sqrt
+    heappush = heapq.heappush
+    heappop = heapq.heappop
+    def potential(x):
+      xLat = lat(x)
+      xLon = lon(x)
+      toEnd = sqrt((endLat - xLat) ** 2 + (endLon - xLon) ** 2)
+      fromStart = sqrt((startLat - xLat) ** 2 + (startLon - xLon) ** 2)
+      return(half * (toEnd - fromStart))
+
+    started = stats.enabled and time.time()
+    best = ({start: 0.0}, {end: 0.0})
+    parent = ({start: -1}, {end: -1})
+    settled = (set(), set())
+    shift = (potential(start), -potential(end))
+    reduction = potential(end) - potential(start)
+    queues = ([(0.0, 0.0, start)], [(0.0, 0.0, end)])
+    shortest = float('inf')
+    meet = -1
     count = 0
-    for test in self.queue:
-      if test['maxdistance'] > queueItem['maxdistance']:
-        self.queue.insert(count,queueItem)
+    stale = 0
+    while True:
+      # Entries for settled nodes would hold the smallest keys down
+      for side in (0, 1):
+        queue = queues[side]
+        while queue and queue[0][2] in settled[side]:
+          heappop(queue)
+          stale = stale + 1
+      if not (queues[0] and queues[1]):
         break
+      if queues[0][0][0] + queues[1][0][0] >= shortest + reduction:
+        break
+      side = int(queues[1][0][0] < queues[0][0][0])
+      key, distance, x = heappop(queues[side])
+      settled[side].add(x)
       count = count + 1
+      if limit and count >= limit:
+        self.searched('bidirectional', started, 'gave_up', count, stale,
+                      len(queues[0]) + len(queues[1]))
+        return('gave_up',[])
+      offset, neighbours, costs = links[side]
+      first = offset(x)
+      last = offset(x + 1)
+      following = zip(neighbours[first:last].tolist(), costs[first:last].tolist())
+      if x in extra[side]:
+        following.extend(extra[side][x])
+      mine = best[side]
+      other = best[1 - side]
+      sign = 1 - 2 * side  # the backward search uses -potential
+      base = shift[side]
+      for i, cost in following:
+        newDistance = distance + cost
+        if newDistance < mine.get(i, newDistance + 1):
+          mine[i] = newDistance
+          parent[side][i] = x
+          heappush(queues[side], (newDistance + sign * potential(i) - base, newDistance, i))
+          if i in other and newDistance + other[i] < shortest:
+            shortest = newDistance + other[i]
+            meet = i
+    result = 'success' if meet >= 0 else 'no_route'
+    self.searched('bidirectional', started, result, count, stale,
+                  len(queues[0]) + len(queues[1]))
+    if meet < 0:
+      return('no_route',[])
+    route = self.pathFrom(parent[0], meet)
+    route.reverse()
+    route.extend(self.pathFrom(parent[1], parent[1][meet]))
+    return('success', route)
+
+  def dijkstra(self,source,transport,targets=(),reverse=False,budget=None):
+    """Dijkstra from a dense node index, following links backwards if
+    reverse is set. Stops as soon as every index in targets is settled
+    (or explores everything reachable if targets is empty), and never
+    settles nodes costing more than budget to reach.
+    Returns (cost, parent) dicts of the settled nodes."""
+    started = stats.enabled and time.time()
+    settled, parent, stale, queued = self.data.graph.dijkstra(
+      source, transport, targets, reverse, budget)
+    self.searched('dijkstra', started, 'done', len(settled), stale, queued)
+    return(settled, parent)
+
+  def pathFrom(self,parent,x):
+    """Follow parent pointers from x until the search's source"""
+    path = []
+    while x != -1:
+      path.append(x)
+      x = parent[x]
+    return(path)
+
+  def searchWithin(self,source,transport,budget,reverse=False):
+    """Dijkstra from an OSM node id over everything within budget cost
+    of it, following links backwards (routes into it) if reverse is
+    set. Returns (cost, parent): {node id: cost} of the nodes reached,
+    and their predecessor tree, {node id: the node before it on its
+    route, or -1 for the source} (pathFrom follows it)"""
+    graph = self.data.graph
+    if not transport in graph.weights:
+      return({}, {})
+    s = graph.index(source)
+    if s < 0:
+      return({}, {})
+    cost, parent = self.dijkstra(s, transport, (), reverse, budget)
+    indices = cost.keys()
+    ids = graph.ids[indices].tolist()
+    idOf = dict(zip(indices, ids))
+    idOf[-1] = -1
+    return(dict(zip(ids, [cost[i] for i in indices])),
+           dict(zip(ids, [idOf[parent[i]] for i in indices])))
+
+  def routesFrom(self,start,ends,transport):
+    """One-to-many routing with a single search from start.
+    Returns {end: (cost, route)} for the ends which can be reached"""
+    return(self.routesOneMany(start, ends, transport, False))
+
+  def routesTo(self,starts,end,transport):
+    """Many-to-one routing with a single search backwards from end.
+    Returns {start: (cost, route)} for the starts which can reach it"""
+    return(self.routesOneMany(end, starts, transport, True))
+
+  def routeMatrix(self,starts,ends,transport):
+    """Many-to-many routing: {(start, end): (cost, route)} for every
+    reachable pair, searching from whichever side has fewer nodes"""
+    routes = {}
+    if len(set(starts)) <= len(set(ends)):
+      for start in set(starts):
+        for end, route in self.routesFrom(start, ends, transport).items():
+          routes[(start, end)] = route
+    else:
+      for end in set(ends):
+        for start, route in self.routesTo(starts, end, transport).items():
+          routes[(start, end)] = route
+    return(routes)
+
+  def routesOneMany(self,source,others,transport,reverse):
+    graph = self.data.graph
+    if not transport in graph.weights:
+      return({})
+    s = graph.index(source)
+    if s < 0:
+      return({})
+    others = [o for o in set(others) if o is not None]
+    indices = graph.indices(others).tolist()
+    components = graph.components(transport)
+    if reverse:
+      targets = [i for i in indices if i >= 0 and not components.unreachable(i, s)]
     else:
-      self.queue.append(queueItem)
+      targets = [i for i in indices if i >= 0 and not components.unreachable(s, i)]
+    if not targets:
+      # A search for none of them would explore everything reachable
+      return({})
+    cost, parent = self.dijkstra(s, transport, targets, reverse)
+    routes = {}
+    ids = graph.ids
+    for other, i in zip(others, indices):
+      if i in cost:
+        route = self.pathFrom(parent, i)
+        if not reverse:
+          route.reverse()
+        routes[other] = (cost[i], ids[route].tolist())
+    return(routes)
 
 if __name__ == "__main__":
   data = LoadOsm(sys.argv[1])
@@ -0,0 +1,37 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Spatial index for snapping points onto the routing graph
+#
+#------------------------------------------------------
+# Usage:
+#   index = NodeIndex(graph.lat, graph.lon, graph.routeable('car'))
+#   nodes = index.nearest(lats, lons)
+#
+# Distances are measured in degrees, the same (unprojected)
+# metric that LoadOsm.findNode has always used.
+#------------------------------------------------------
+import numpy as np
+from scipy.spatial import cKDTree
+
+class NodeIndex:
+  """KD-tree over a subset of a graph's nodes"""
+  def __init__(self, lat, lon, nodes):
+    self.nodes = np.asarray(nodes, np.int32)  # dense graph indices
+    if len(self.nodes):
+      self.tree = cKDTree(np.column_stack((lat[self.nodes], lon[self.nodes])))
+    else:
+      self.tree = None
+
+  def nearest(self, lats, lons, maxDist=np.inf):
+    """Dense index of the nearest node to each point, or -1 if there
+    is no node within maxDist (degrees)"""
+    lats = np.atleast_1d(np.asarray(lats, np.float64))
+    lons = np.atleast_1d(np.asarray(lons, np.float64))
+    found = np.zeros(len(lats), np.int32) - 1
+    if self.tree is None or not len(lats):
+      return(found)
+    dist, i = self.tree.query(np.column_stack((lats, lons)),
+                              distance_upper_bound=maxDist)
+    ok = np.isfinite(dist)
+    found[ok] = self.nodes[i[ok]]
+    return(found)
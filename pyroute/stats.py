@@ -0,0 +1,216 @@
+#!/usr/bin/python
+#----------------------------------------------------------------
+# Opt-in counters and latency histograms
+#
+#------------------------------------------------------
+# Usage:
+#   from pyroute.stats import stats
+#   stats.enable()
+#   stats.dumpEvery('cached/stats.json', 60)   # optional
+#   ... route, reroute, draw ...
+#   print stats.snapshot()
+#
+# Instrumented code asks stats.enabled before doing any work for
+# it, and the searches count what they did from their own state
+# once they finish (never per node), so leaving stats off costs
+# next to nothing. Histograms keep counts in logarithmic buckets
+# about 5% wide: memory stays fixed however many values are
+# recorded, and percentiles come out within that precision.
+#
+# Each process keeps its own figures. Forked workers start with a
+# copy of their parent's, so they should reset(), and can hand what
+# they record since to the parent with take(), for it to merge().
+#------------------------------------------------------
+import os
+import json
+import math
+import time
+import threading
+
+class Histogram:
+  """Count, total, extremes and log-bucketed counts of some values"""
+  growth = 1.05  # ratio between the bounds of neighbouring buckets
+
+  def __init__(self):
+    self.buckets = {}  # bucket -> count; None holds values <= 0
+    self.count = 0
+    self.total = 0.0
+    self.min = None
+    self.max = None
+    self.logGrowth = math.log(self.growth)
+
+  def record(self, value):
+    if value > 0:
+      bucket = int(math.floor(math.log(value) / self.logGrowth))
+    else:
+      bucket = None
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.count = self.count + 1
+    self.total = self.total + value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
+
+  def merge(self, other):
+    """Add another histogram's values to this one's"""
+    for bucket, count in other.buckets.items():
+      self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+    self.count = self.count + other.count
+    self.total = self.total + other.total
+    if other.min is not None and (self.min is None or other.min < self.min):
+      self.min = other.min
+    if other.max is not None and (self.max is None or other.max > self.max):
+      self.max = other.max
+
+  def percentile(self, p, buckets=None):
+    """The value p% of those recorded are at or below (the top of its
+    bucket, so within one bucket's width), or None if there are none"""
+    if not self.count:
+      return(None)
+    if buckets is None:
+      buckets = self.buckets
+    wanted = max(1, int(math.ceil(sum(buckets.values()) * p / 100.0)))
+    seen = buckets.get(None, 0)
+    if seen >= wanted:
+      return(min(0.0, self.max))
+    for bucket in sorted(b for b in buckets if b is not None):
+      seen = seen + buckets[bucket]
+      if seen >= wanted:
+        return(min(self.growth ** (bucket + 1), self.max))
+    return(self.max)
+
+  def summary(self):
+    if not self.count:
+      return({'count': 0})
+    # A copy, as another thread may be recording meanwhile
+    buckets = dict(self.buckets)
+    return({'count': self.count, 'total': self.total,
+      'min': self.min, 'max': self.max, 'mean': self.total / self.count,
+      'p50': self.percentile(50, buckets), 'p90': self.percentile(90, buckets),
+      'p99': self.percentile(99, buckets)})
+
+class Timer:
+  """Context manager recording its wall time (seconds) into a histogram"""
+  def __init__(self, stats, name):
+    self.stats = stats
+    self.name = name
+  def __enter__(self):
+    self.start = time.time()
+    return(self)
+  def __exit__(self, *exc):
+    self.stats.observe(self.name, time.time() - self.start)
+    return(False)
+
+class NoTimer:
+  def __enter__(self):
+    return(self)
+  def __exit__(self, *exc):
+    return(False)
+
+noTimer = NoTimer()
+
+class Stats:
+  """Named counters and histograms, recorded only while enabled"""
+  def __init__(self):
+    self.enabled = False
+    self.dumper = None
+    self.reset()
+
+  def enable(self, enabled=True):
+    self.enabled = enabled
+
+  def reset(self):
+    self.counters = {}
+    self.histograms = {}
+    self.since = time.time()
+
+  def count(self, name, n=1):
+    if self.enabled:
+      self.counters[name] = self.counters.get(name, 0) + n
+
+  def observe(self, name, value):
+    if self.enabled:
+      histogram = self.histograms.get(name)
+      if histogram is None:
+        histogram = self.histograms[name] = Histogram()
+      histogram.record(value)
+
+  def timer(self, name):
+    """with stats.timer('phase'): ... records the phase's seconds"""
+    if self.enabled:
+      return(Timer(self, name))
+    return(noTimer)
+
+  def search(self, kind, seconds, result, settled, pops, pushes):
+    """Record one routing search: kind is e.g. 'astar' or 'dijkstra'"""
+    if not self.enabled:
+      return
+    self.count('%s.queries' % kind)
+    self.count('%s.%s' % (kind, result))
+    self.count('%s.settled' % kind, settled)
+    self.count('%s.pops' % kind, pops)
+    self.count('%s.pushes' % kind, pushes)
+    self.observe('%s.seconds' % kind, seconds)
+    self.observe('%s.settledPerQuery' % kind, settled)
+
+  def take(self):
+    """(counters, histograms) recorded since the last reset or take,
+    starting afresh; for merge() into another process's figures"""
+    taken = (self.counters, self.histograms)
+    self.counters = {}
+    self.histograms = {}
+    return(taken)
+
+  def merge(self, (counters, histograms)):
+    """Add figures from take() (in another process, say) to these"""
+    for name, n in counters.items():
+      self.counters[name] = self.counters.get(name, 0) + n
+    for name, histogram in histograms.items():
+      mine = self.histograms.get(name)
+      if mine is None:
+        mine = self.histograms[name] = Histogram()
+      mine.merge(histogram)
+
+  def snapshot(self):
+    """Everything recorded so far, as plain (JSON-able) data"""
+    return({'pid': os.getpid(), 'time': time.time(), 'since': self.since,
+      'counters': dict(self.counters),
+      'histograms': dict([(name, h.summary())
+                          for name, h in self.histograms.items()])})
+
+  def dump(self, filename):
+    """Write snapshot() as JSON, replacing the file in one step"""
+    temp = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(temp, 'wb')
+    try:
+      json.dump(self.snapshot(), f, indent=1, sort_keys=True)
+    finally:
+      f.close()
+    os.rename(temp, filename)
+
+  def dumpEvery(self, filename, interval):
+    """Dump to filename every interval seconds from a background thread
+    (until stopDumping), and once more when stopped"""
+    self.stopDumping()
+    stop = threading.Event()
+    def run():
+      while not stop.wait(interval):
+        self.dump(filename)
+      self.dump(filename)
+    thread = threading.Thread(target=run, name='stats dump')
+    thread.daemon = True
+    thread.start()
+    self.dumper = (thread, stop, os.getpid())
+
+  def stopDumping(self):
+    if self.dumper is not None:
+      thread, stop, pid = self.dumper
+      # A forked child has the parent's record of the thread, not the thread
+      if pid == os.getpid():
+        stop.set()
+        thread.join()
+      self.dumper = None
+
+# The process's statistics, shared by everything instrumented
+stats = Stats()
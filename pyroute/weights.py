@@ -24,5 +24,8 @@ def getWeight(transport, wayType):
   except KeyError:
     # Default: if no weighting is defined, then assume it can't be routed
     return(0)
- 
- 
\ No newline at end of file
+
+def getProfile(transport):
+  """One form of transport's weightings, as {wayType: weight}"""
+  return(dict([(wayType, w[transport]) for wayType, w in Weightings.items()
+               if transport in w]))
@@ -0,0 +1,370 @@
+"""
+Precomputed reroute candidates for the sensitive places.
+
+    python rerouteTable.py data/westwood.graph [processes]
+
+builds the table for a map into cached/, using a pool of worker
+processes. For the road node of every sensitive place it holds the
+safe places RouteAdder.nearbyPlaces looks among there, and the cost
+of the car routes between the sensitive node and each of them:
+
+    sens, offsets    the sensitive nodes (sorted), and where each one's
+                     rows start
+    place, node      the places' ids, in nearbyPlaces' order, and their
+                     road nodes
+    costThere        of the route from the sensitive node to the place
+    costBack         of the route from the place back to it
+
+Costs are inf where there is no route, and only places with a route
+both ways are offered (candidates). Within a radius, the routes come
+from a search from the sensitive node and one into it, which stop
+once every place is reached; by route cost, the bounded searches
+which find the places give their costs too. Rerouting a trip then
+only searches from its origin and into its destination.
+
+The file is a compiled one (see pyroute/compiled.py) named after a key
+of everything in it: the graph's fingerprint, the places with their
+road nodes and categories, the sensitive categories, and the radius
+or route cost budget. RouteAdder checks the key before using its
+table, loading or building the right one when it has changed. After
+applyChange, updateTable recomputes only the rows the change may have
+made wrong (see staleNodes), and writes them with the rest under the
+new key. A table replaced so is deleted.
+"""
+import json
+import multiprocessing
+import os
+import sys
+import zlib
+
+import numpy as np
+
+from pyroute.compiled import CompiledGraphError, writeSections, readSections
+
+# The RouteAdder the workers search with; set before the pool is forked.
+adder = None
+columns = (('place', np.int64), ('node', np.int64),
+           ('costThere', np.float64), ('costBack', np.float64))
+
+
+class RerouteTable:
+    def __init__(self, filename):
+        sections, meta = readSections(filename)
+        self.filename = filename
+        self.key = meta['key']
+        self.sens = sections['sens']
+        self.offsets = sections['offsets']
+        self.place = sections['place']
+        self.node = sections['node']
+        self.costThere = sections['costThere']
+        self.costBack = sections['costBack']
+
+    def __len__(self):
+        return len(self.sens)
+
+    def rows(self, sensNode):
+        """ slice of a sensitive node's rows, or None if it isn't one """
+        i = int(np.searchsorted(self.sens, sensNode))
+        if i < len(self.sens) and self.sens[i] == sensNode:
+            return slice(self.offsets.item(i), self.offsets.item(i + 1))
+        return None
+
+    def candidates(self, sensNode):
+        """ The ids of the places which can be driven to from a
+        sensitive node and back, or None if it isn't one """
+        rows = self.rows(sensNode)
+        if rows is None:
+            return None
+        reachable = np.isfinite(self.costThere[rows]) & \
+            np.isfinite(self.costBack[rows])
+        return self.place[rows][reachable]
+
+    def blocks(self, sensNodes):
+        """ {sensitive node: its rows' columns} """
+        blocks = {}
+        for sensNode in sensNodes:
+            rows = self.rows(sensNode)
+            blocks[sensNode] = tuple([getattr(self, name)[rows]
+                                      for name, dtype in columns])
+        return blocks
+
+
+def tableKey(routeAdder):
+    """ Identifies everything a table for routeAdder depends on (as
+    it reads back from a table's file) """
+    return json.loads(json.dumps(
+        [routeAdder.roads.graph.fingerprint(),
+         routeAdder.placeIndex.checksum(),
+         sorted(routeAdder.sensitiveCats), routeAdder.rerouteRadius,
+         routeAdder.rerouteBudget]))
+
+
+def tableFile(directory, key):
+    return os.path.join(directory, 'reroute-%08x.table' %
+                        (zlib.crc32(repr(key)) & 0xffffffff))
+
+
+def sensitiveNodes(routeAdder):
+    return sorted(set([routeAdder.places[k].node
+                       for k in routeAdder.sensitivePlaces
+                       if routeAdder.places[k].node is not None]))
+
+
+def tableRows(sensNodes):
+    """ {sensitive node: its rows' columns} (run in a worker) """
+    index = adder.placeIndex
+    router = adder.router
+    if adder.rerouteBudget is None:
+        found = index.withinMany(sensNodes, adder.rerouteRadius,
+                                 exclude=adder.sensitiveCats)
+    blocks = {}
+    for k, sensNode in enumerate(sensNodes):
+        if adder.rerouteBudget is None:
+            rows = found[k]
+            nodes = index.nodes[rows].tolist()
+            there = router.routesFrom(sensNode, nodes, 'car')
+            back = router.routesTo(nodes, sensNode, 'car')
+            there = dict([(n, cost) for n, (cost, route) in there.items()])
+            back = dict([(n, cost) for n, (cost, route) in back.items()])
+        else:
+            # The bounded searches which find the places cost them too
+            there, back = adder.searchesAround(sensNode)
+            rows = adder.placeRowsReached(there, back)
+            nodes = index.nodes[rows].tolist()
+        blocks[sensNode] = (
+            index.ids[rows], index.nodes[rows],
+            np.array([there.get(n, np.inf) for n in nodes], np.float64),
+            np.array([back.get(n, np.inf) for n in nodes], np.float64))
+    return blocks
+
+
+def computeRows(routeAdder, sensNodes, processes=None):
+    """ tableRows for some sensitive nodes, in parallel """
+    global adder
+    adder = routeAdder
+    processes = processes or multiprocessing.cpu_count()
+    if processes == 1 or len(sensNodes) < 2:
+        return tableRows(sensNodes)
+    pool = multiprocessing.Pool(processes)
+    try:
+        jobs = [sensNodes[i::processes * 4] for i in range(processes * 4)]
+        parts = pool.map(tableRows, [job for job in jobs if job])
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    blocks = {}
+    for part in parts:
+        blocks.update(part)
+    return blocks
+
+
+def writeTable(filename, key, blocks):
+    """ Writes {sensitive node: its rows' columns} as a table """
+    sens = sorted(blocks)
+    counts = [len(blocks[s][0]) for s in sens]
+    sections = {'sens': np.array(sens, np.int64),
+                'offsets': np.r_[0, np.cumsum(counts)].astype(np.int64)}
+    for k, (name, dtype) in enumerate(columns):
+        sections[name] = np.concatenate(
+            [np.asarray(blocks[s][k], dtype) for s in sens] or
+            [np.zeros(0, dtype)])
+    temp = '%s.%d.tmp' % (filename, os.getpid())
+    writeSections(temp, sections, {'key': key})
+    os.rename(temp, filename)
+
+
+def openTable(filename, key):
+    """ The table in filename if it is the one for key, else None """
+    try:
+        table = RerouteTable(filename)
+    except (IOError, CompiledGraphError, KeyError):
+        return None
+    if table.key != key:
+        return None
+    return table
+
+
+def loadTable(routeAdder, directory='cached', processes=None):
+    """ The RerouteTable for routeAdder's graph, places and sensitive
+    categories, from directory, built and saved there if need be """
+    key = tableKey(routeAdder)
+    filename = tableFile(directory, key)
+    table = openTable(filename, key)
+    if table is None:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        writeTable(filename, key, computeRows(
+            routeAdder, sensitiveNodes(routeAdder), processes))
+        table = RerouteTable(filename)
+    return table
+
+
+def movedPlaces(oldIndex, newIndex):
+    """ Ids of the places which appeared, went, or changed category,
+    road node or position """
+    def describe(index):
+        return dict(zip(index.ids.tolist(),
+                        zip(index.nodes.tolist(), index.lat.tolist(),
+                            index.lon.tolist(),
+                            [index.catNames[c] for c in index.cats])))
+    old = describe(oldIndex)
+    new = describe(newIndex)
+    moved = [id for id in set(old) | set(new) if old.get(id) != new.get(id)]
+    return np.array(sorted(moved), np.int64)
+
+
+def costsAround(graph, nodes, reverse, limit, costs=None):
+    """ {dense index: cost} of the car routes within limit from any of
+    some nodes (dense indices), or into them if reverse is set, the
+    cheapest of them; costs, if given, is what reaching each node costs
+    to start with """
+    if costs is None:
+        costs = np.zeros(len(nodes))
+    start = {}
+    for x, cost in zip(nodes.tolist(), costs.tolist()):
+        if x >= 0 and cost < start.get(x, np.inf):
+            start[x] = cost
+    if not start:
+        return {}
+    return graph.dijkstra(start, 'car', (), reverse, limit)[0]
+
+
+def staleNodes(routeAdder, table, change, oldGraph, moved):
+    """ The sensitive nodes of a table whose rows a GraphChange, and the
+    places it moved (movedPlaces), may have changed: those which moved,
+    have a moved place among their rows or one within reach, and those
+    with a route which
+      could have passed a node on a link which went away or got dearer:
+        the route to the nearest such node and on from the nearest
+        costs no more than it did, on the old graph
+      could be cheaper through a link which appeared or got cheaper,
+        going by the cheapest way onto any of them and off any, on the
+        new graph (or could now be found, where there was none)
+    Within a budget, the same goes for anything within the budget, as
+    that is what the node's searches looked at. One search each way
+    from all the links' ends at once, no further than the table's
+    dearest route (or the budget), gives these costs. """
+    graph = routeAdder.roads.graph
+    if not 'car' in change.worse or not 'car' in oldGraph.weights:
+        return set(table.sens.tolist())
+    budget = routeAdder.rerouteBudget
+    margin = 1 + 1e-9
+    if budget is None:
+        finite = np.r_[table.costThere, table.costBack]
+        finite = finite[np.isfinite(finite)]
+        limit = (finite.max() if len(finite) else 0.0) * margin
+    else:
+        limit = budget * margin
+
+    worse = oldGraph.indices(change.worse['car'])
+    toWorse = costsAround(oldGraph, worse, True, limit)
+    fromWorse = costsAround(oldGraph, worse, False, limit)
+    fr, to, cost = change.better['car']
+    # onto a link and along it, and on from its end
+    toLink = costsAround(graph, graph.indices(fr), True, limit, cost)
+    fromLink = costsAround(graph, graph.indices(to), False, limit)
+    along = cost.min() if len(cost) else np.inf
+
+    # Sensitive nodes which went from either graph, or moved
+    i = graph.indices(table.sens)
+    j = oldGraph.indices(table.sens)
+    touched = (i < 0) | (j < 0) | (graph.lat[i] != oldGraph.lat[j]) | \
+        (graph.lon[i] != oldGraph.lon[j])
+    # Where the moved places are now
+    nodes = [routeAdder.places[id].node for id in moved.tolist()
+             if id in routeAdder.places]
+    k = graph.indices([n for n in nodes if n is not None])
+    k = k[k >= 0]
+    mLat, mLon = graph.lat[k], graph.lon[k]
+    if budget is not None:
+        # A node new to the graph is only reached through new links
+        k = oldGraph.indices(graph.ids[k])
+        toMoved = costsAround(oldGraph, k, True, limit)
+        fromMoved = costsAround(oldGraph, k, False, limit)
+    components = graph.components('car')
+
+    def lookup(costs, nodes):
+        return np.array([costs.get(x, np.inf) for x in nodes.tolist()])
+
+    stale = set()
+    for n, sensNode in enumerate(table.sens.tolist()):
+        rows = slice(table.offsets.item(n), table.offsets.item(n + 1))
+        old = oldGraph.indices(table.node[rows])
+        new = graph.indices(table.node[rows])
+        if touched[n] or np.in1d(table.place[rows], moved).any() or \
+                (old < 0).any() or (new < 0).any():
+            stale.add(sensNode)
+            continue
+        s, t = i[n], j[n]
+        if budget is not None:
+            # Anything the searches reached, or could reach now
+            if toWorse.get(t, np.inf) <= limit or \
+                    fromWorse.get(t, np.inf) <= limit or \
+                    toLink.get(s, np.inf) <= limit or \
+                    along + fromLink.get(s, np.inf) <= limit or \
+                    (toMoved.get(t, np.inf) <= limit and
+                     fromMoved.get(t, np.inf) <= limit):
+                stale.add(sensNode)
+            continue
+        if (np.hypot(mLat - graph.lat[s], mLon - graph.lon[s]) <=
+                routeAdder.rerouteRadius * margin).any():
+            stale.add(sensNode)
+            continue
+        there = table.costThere[rows]
+        back = table.costBack[rows]
+        # Where there was no route, only a new link can make one; the
+        # rest are left out of the comparisons below
+        if len(fr) and (
+                [e for e in new[~np.isfinite(there)].tolist()
+                 if not components.unreachable(s, e)] or
+                [e for e in new[~np.isfinite(back)].tolist()
+                 if not components.unreachable(e, s)]):
+            stale.add(sensNode)
+            continue
+        viaWorse = (toWorse.get(t, np.inf) + lookup(fromWorse, old),
+                    lookup(toWorse, old) + fromWorse.get(t, np.inf))
+        viaLink = (toLink.get(s, np.inf) + lookup(fromLink, new),
+                   lookup(toLink, new) + fromLink.get(s, np.inf))
+        there = np.where(np.isfinite(there), there, -1)
+        back = np.where(np.isfinite(back), back, -1)
+        if (viaWorse[0] <= there * margin).any() or \
+                (viaWorse[1] <= back * margin).any() or \
+                (viaLink[0] < there).any() or (viaLink[1] < back).any():
+            stale.add(sensNode)
+    return stale
+
+
+def updateTable(routeAdder, table, change, oldGraph, oldIndex,
+                directory='cached', processes=None):
+    """ The table for routeAdder after applyChange: table (the one from
+    before) with the rows the change may have made wrong recomputed,
+    saved under the new key. Returns the new RerouteTable. """
+    key = tableKey(routeAdder)
+    filename = tableFile(directory, key)
+    updated = openTable(filename, key)
+    if updated is not None:
+        return updated
+    if table.key[2:] != key[2:]:
+        # Not the same sort of table; nothing carries over
+        return loadTable(routeAdder, directory, processes)
+    moved = movedPlaces(oldIndex, routeAdder.placeIndex)
+    stale = staleNodes(routeAdder, table, change, oldGraph, moved)
+    sens = sensitiveNodes(routeAdder)
+    kept = set(table.sens.tolist()) - stale
+    blocks = table.blocks([s for s in sens if s in kept])
+    blocks.update(computeRows(routeAdder, [s for s in sens if not s in kept],
+                              processes))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    writeTable(filename, key, blocks)
+    return RerouteTable(filename)
+
+
+if __name__ == '__main__':
+    from routeAdder import RouteAdder
+    routeAdder = RouteAdder()
+    routeAdder.init(sys.argv[1])
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    table = routeAdder.rerouteTable(processes=processes)
+    print '%d sensitive nodes, %d candidates' % (len(table), len(table.place))
@@ -1,106 +1,289 @@
-import collections
 import math
-import pickle
+import os
 
 import numpy as np
-import scipy.stats
 
 from pyroute import route
+from pyroute.pathCache import PathCache
+from pyroute.stats import stats
 from places import *
-from draw import *
 
 
 class RouteAdder:
+    verbose = True  # print each candidate's score
+    rerouteRadius = 0.03  # degrees from the sensitive node to look for places
+    rerouteBudget = None  # if set, look for places by car route cost instead
+    similarityScale = 0.01  # std. dev. (degrees) of the route length score
+    choice = 'argmax'  # or 'sample': draw a place in proportion to its score
+
     def __init__(self):
         pass
 
-    def init(self, fileName='data/westwood.osm'):
-        print 'Loading roads...'
-        self.roads = route.LoadOsm(fileName)
-        print 'Loading places...'
-        self.places = PlacesLoader(self.roads).init(fileName)
+    def init(self, fileName='data/westwood.osm',
+             cacheFile='cached/paths.sqlite'):
+        print 'Loading roads and places...'
+        self.roads = route.LoadOsm(fileName, storeMap=1, storePlaces=1)
+        self.places = PlacesLoader(self.roads).fromRoads()
+        self.placeIndex = PlaceIndex(self.places, self.roads.graph)
         print 'Initializing router...'
         self.router = route.Router(self.roads)
+        self.paths = PathCache(cacheFile, self.roads.graph)
         print 'Done.'
         self.setSensitive()
 
+    def applyChange(self, fileName):
+        """ Applies an OSM change file (.osc) to the roads and places.
+        Cached routes the change can't have affected are kept. Returns
+        the GraphChange (see pyroute/osmChange.py). """
+        oldGraph = self.roads.graph
+        oldIndex = self.placeIndex
+        change = self.roads.applyChange(fileName)
+        self.places = PlacesLoader(self.roads).fromRoads()
+        self.placeIndex = PlaceIndex(self.places, self.roads.graph)
+        # Only the table's rows the change may have affected are redone
+        table = self.__dict__.pop('_rerouteTable', None)
+        self.setSensitive(self.sensitiveCats)
+        if table is not None:
+            from rerouteTable import updateTable
+            self.useRerouteTable(updateTable(self, table, change, oldGraph,
+                                             oldIndex, *self._rerouteTableArgs),
+                                 table)
+        self.__dict__.pop('_wayLines', None)
+        self.paths.update(change, self.roads.graph)
+        return change
+
     def setSensitive(self, cats=['hospital', 'place_of_worship']):
         self.sensitiveCats = cats
         self.sensitivePlaces = \
             set([k for (k, p) in self.places.items() if p.cat in cats])
-        self.attr = collections.defaultdict(collections.Counter)
-        for place in self.places.values():
-            self.attr[place.node].update((place.cat,))
+        table = self.__dict__.get('_rerouteTable')
+        if table is not None:
+            self.rerouteTable(*self._rerouteTableArgs)
+
+    def rerouteTable(self, directory='cached', processes=None):
+        """ The RerouteTable of the sensitive places (see rerouteTable.py),
+        loaded from directory, or built in parallel and saved there if
+        there is none for the current graph and places. From then on
+        nearbyPlaces looks sensitive nodes up in it, and keeps it up to
+        date (applyChange only recomputes the rows a change affects). """
+        from rerouteTable import loadTable
+        table = self.__dict__.get('_rerouteTable')
+        self._rerouteTableArgs = (directory, processes)
+        return self.useRerouteTable(loadTable(self, directory, processes),
+                                    table)
+
+    def useRerouteTable(self, table, previous=None):
+        """ Makes table the RerouteTable, deleting the previous one's
+        file: it is out of date. """
+        self._rerouteTable = table
+        if previous is not None and previous.filename != table.filename \
+                and os.path.exists(previous.filename):
+            os.remove(previous.filename)
+        return table
 
     def drawSensitivePlaces(self, s):
-        for node in self.attr.keys():
-            num_sen = sum([x for (k, x) in self.attr[node].items()
-                           if k in self.sensitiveCats])
-            num_places = sum([x for (k, x) in self.attr[node].items()])
-
-            if num_places == 0:
-                ratio = 0
-            else:
-                ratio = float(num_sen) / num_places
-
+        nodes, num_places, num_sen = self.placeIndex.nodeCounts(self.sensitiveCats)
+        ratios = num_sen / num_places.astype(float)
+        i = self.roads.graph.indices(nodes)
+        lats = self.roads.graph.lat[i]
+        lons = self.roads.graph.lon[i]
+        # One batch of points per colour
+        for ratio in np.unique(ratios).tolist():
+            same = ratios == ratio
             drawProp = (ratio, 1.0 - ratio, 0.0, 1.0, 3.0)
-            s.markNode(self.roads.nodes[node], drawProp)
+            s.markPoints(lats[same], lons[same], drawProp)
+
+    def drawRoads(self, s):
+        drawProp = (0.0, 0.0, 1.0, 0.3, 2.0)
+        graph = self.roads.graph
+        if self.roads.ways:
+            nodes, offsets = self.wayLines()
+            s.markLines(graph.lat[nodes], graph.lon[nodes], offsets, drawProp)
+        else:
+            s.markPoints(graph.lat, graph.lon, drawProp)
+
+    def wayLines(self):
+        """ The roads' ways as columns: graph indices of their nodes, and
+        the offset at which each way starts. Nodes missing from the graph
+        split their way. """
+        try:
+            return self._wayLines
+        except AttributeError:
+            ways = [way['n'] for way in self.roads.ways]
+            nodes, offsets = self.pathIndices(ways)
+            known = nodes >= 0
+            wayOf = np.repeat(np.arange(len(ways)), np.diff(offsets))
+            # A line starts with each way, and after each unknown node
+            newLine = np.ones(len(nodes), bool)
+            newLine[1:] = (wayOf[1:] != wayOf[:-1]) | ~known[:-1]
+            lineOf = np.cumsum(newLine)[known]
+            starts = np.flatnonzero(np.r_[True, lineOf[1:] != lineOf[:-1]])
+            self._wayLines = (nodes[known], np.r_[starts, len(lineOf)])
+            return self._wayLines
 
     def analyze(self, (origNode, sensNode, destNode)):
         print 'Performing analysis (%d, %d, %d)' % (origNode, sensNode, destNode)
-        # Get a list of nearby safe places.
-        nearbyPlaces = \
-            [p for p in self.places.values()
-             if self.distanceBetween(sensNode, p.node) < 0.03
-             and p.id not in self.sensitivePlaces]
-
-        # Compute a distribution over safe places.
-        safePlaceProb = \
-            [self.getToPlaceWeight(origNode, sensNode, destNode, p.node)
-             for p in nearbyPlaces]
-
-        # Sample a place from distribution.
-        cdf = np.cumsum(safePlaceProb)
-        cdf = cdf / cdf[-1]
-        rand = np.random.uniform()
-        reroutePlace = (p for (p, pr) in zip(nearbyPlaces, cdf)
-                        if pr > rand).next()
-
-        ind = np.argmax(safePlaceProb)
-        reroutePlace = nearbyPlaces[ind]
-
-
+        with stats.timer('analyze.reroute'):
+            reroutePlace, paths = self.reroute((origNode, sensNode, destNode))
 
         print 'Found alternate node:'
         print reroutePlace
 
-        # Draw analysis
         print 'Drawing out to png...'
-        s = MapSurface()
-        loc = self.roads.nodes[sensNode]
-        s.setup(loc, scale=2000, pixels=1000)
+        with stats.timer('analyze.render'):
+            s = self.drawAnalysis(sensNode, reroutePlace, paths)
+        return reroutePlace, s
 
-        # Draw roads.
-        drawProp = (0.0, 0.0, 1.0, 0.3, 2.0)
-        s.markNodes(self.roads.nodes.values(), drawProp)
+    def nearbyPlaces(self, sensNodes):
+        """ The safe places near each of a batch of sensitive nodes, of
+        those which can be driven to from it and back: within
+        rerouteRadius as the crow flies, or if rerouteBudget is set,
+        within that route cost by road (see placesWithin). """
+        nearby = [None] * len(sensNodes)
+        table = self.__dict__.get('_rerouteTable')
+        if table is not None:
+            from rerouteTable import tableKey
+            if table.key != tableKey(self):
+                # The graph, places or settings changed since
+                table = self.rerouteTable(*self._rerouteTableArgs)
+            for i, node in enumerate(sensNodes):
+                ids = table.candidates(node)
+                if ids is not None:
+                    nearby[i] = [self.places[id] for id in ids.tolist()]
+        missing = [i for i, places in enumerate(nearby) if places is None]
+        if missing and self.rerouteBudget is not None:
+            # One pair of searches per node, however often it comes up
+            found = {}
+            for i in missing:
+                if not sensNodes[i] in found:
+                    found[sensNodes[i]] = self.placesWithin(sensNodes[i])
+                nearby[i] = found[sensNodes[i]]
+        elif missing:
+            # Only places which can be driven to and back, as in the table
+            index = self.placeIndex
+            graph = self.roads.graph
+            strong = graph.components('car').strong
+            found = index.withinMany([sensNodes[i] for i in missing],
+                                     self.rerouteRadius,
+                                     exclude=self.sensitiveCats)
+            for i, rows in zip(missing, found):
+                s = graph.index(sensNodes[i])
+                same = strong[graph.indices(index.nodes[rows])] == strong[s]
+                nearby[i] = [index.places[r] for r in rows[same]] \
+                    if s >= 0 else []
+        return nearby
+
+    def placesWithin(self, sensNode, budget=None):
+        """ The safe places whose road nodes can be driven to from
+        sensNode, and back to it, at a route cost of at most budget
+        (default: rerouteBudget) each way. Unlike a radius, this leaves
+        out places which are close but far by road (across a river or
+        a freeway, say). """
+        return [self.placeIndex.places[i] for i in
+                self.placeRowsReached(*self.searchesAround(sensNode, budget))]
+
+    def searchesAround(self, sensNode, budget=None):
+        """ ({node: cost}, {node: cost}) of the road nodes which can be
+        driven to from sensNode, and back to it, at a route cost of at
+        most budget (default: rerouteBudget): one bounded search each
+        way (see Router.searchWithin). """
+        if budget is None:
+            budget = self.rerouteBudget
+        there = self.router.searchWithin(sensNode, 'car', budget)[0]
+        back = self.router.searchWithin(sensNode, 'car', budget, True)[0]
+        return there, back
+
+    def placeRowsReached(self, there, back):
+        """ PlaceIndex rows of the safe places whose road nodes both of
+        searchesAround's searches reached """
+        index = self.placeIndex
+        reached = [n for n in there if n in back]
+        return np.flatnonzero(index.catMask(exclude=self.sensitiveCats) &
+                              np.in1d(index.nodes, reached))
+
+    def reroute(self, (origNode, sensNode, destNode), nearbyPlaces=None,
+                choice=None):
+        """ Picks a safe place near sensNode to end the trip at instead.
+        Returns (place, (orig_sens, sens_dest, orig_altr, altr_dest)).
+
+        nearbyPlaces -- the safe places near sensNode, if already known
+        choice -- 'argmax' or 'sample' (default: self.choice) """
+        if nearbyPlaces is None:
+            with stats.timer('reroute.candidates'):
+                nearbyPlaces = self.nearbyPlaces([sensNode])[0]
+        if not nearbyPlaces:
+            stats.count('reroute.noCandidates')
+            raise ValueError('No safe place near node %d' % sensNode)
+        stats.observe('reroute.candidatesPerTrip', len(nearbyPlaces))
+
+        # Route from the origin to, and into the destination from, the
+        # sensitive node and every candidate: one search each way.
+        candidates = [sensNode] + [p.node for p in nearbyPlaces]
+        with stats.timer('reroute.routing'):
+            fromOrig = self.router.routesFrom(origNode, candidates, 'car')
+            toDest = self.router.routesTo(candidates, destNode, 'car')
+        path = self.routePath
+
+        # Compute a distribution over safe places. Places sharing a road
+        # node share its routes, so score each node once.
+        with stats.timer('reroute.scoring'):
+            orig_sens = path(fromOrig, sensNode)
+            sens_dest = path(toDest, sensNode)
+            nodes = list(set([p.node for p in nearbyPlaces]))
+            weights = self.scoreCandidates(
+                orig_sens, sens_dest, [path(fromOrig, n) for n in nodes],
+                [path(toDest, n) for n in nodes])
+            byNode = dict(zip(nodes, weights.tolist()))
+            safePlaceProb = np.array([byNode[p.node] for p in nearbyPlaces])
+
+            reroutePlace = nearbyPlaces[self.choose(safePlaceProb, choice)]
+
+        orig_altr = path(fromOrig, reroutePlace.node)
+        altr_dest = path(toDest, reroutePlace.node)
+        return reroutePlace, (orig_sens, sens_dest, orig_altr, altr_dest)
+
+    def drawBaseMap(self, s):
+        self.drawRoads(s)
         self.drawSensitivePlaces(s)
 
+    def baseMapKey(self):
+        """ Identifies what drawBaseMap draws, for caching it """
+        return (self.roads.graph.fingerprint(), tuple(self.sensitiveCats))
+
+    def tileCache(self, directory='cached/tiles', maxBytes=None):
+        """ A TileCache of the base map (see tiles.py) """
+        from tiles import TileCache
+        return TileCache(directory, self.baseMapKey(), self.drawBaseMap,
+                         maxBytes)
+
+    def drawAnalysis(self, sensNode, reroutePlace, paths, tiles=None,
+                     zoom=13):
+        """ Draws the trip's routes over the map. With a TileCache the
+        map comes from its tiles, at the given zoom level. """
+        from draw import MapSurface  # cairo is only needed for drawing
+        orig_sens, sens_dest, orig_altr, altr_dest = paths
+        loc = self.roads.nodes[sensNode]
+        if tiles is not None:
+            s = tiles.surface(loc, zoom, pixels=1000)
+        else:
+            # Draw roads and places, or reuse them if this view has
+            # been drawn.
+            s = MapSurface()
+            s.setup(loc, scale=2000, pixels=1000)
+            s.drawBase(self.baseMapKey(), self.drawBaseMap)
+
         # Draw paths.
-        path = self.getPath(origNode, sensNode)
         drawProp = (0.0, 1.0, 0.0, 0.5, 5.0)
-        s.markPath([self.roads.nodes[x] for x in path], drawProp)
+        s.markPath([self.roads.nodes[x] for x in orig_sens], drawProp)
 
-        path = self.getPath(sensNode, destNode)
         drawProp = (0.0, 1.0, 0.0, 0.5, 5.0)
-        s.markPath([self.roads.nodes[x] for x in path], drawProp)
+        s.markPath([self.roads.nodes[x] for x in sens_dest], drawProp)
 
-        path = self.getPath(origNode, reroutePlace.node)
         drawProp = (1.0, 0.0, 1.0, 0.5, 5.0)
-        s.markPath([self.roads.nodes[x] for x in path], drawProp)
+        s.markPath([self.roads.nodes[x] for x in orig_altr], drawProp)
 
-        path = self.getPath(reroutePlace.node, destNode)
         drawProp = (1.0, 0.0, 1.0, 0.5, 5.0)
-        s.markPath([self.roads.nodes[x] for x in path], drawProp)
+        s.markPath([self.roads.nodes[x] for x in altr_dest], drawProp)
 
         # Draw nodes.
         drawProp = (0.0, 1.0, 0.0, 1.0, 5.0)
@@ -109,53 +292,113 @@ class RouteAdder:
         drawProp = (1.0, 0.0, 0.0, 1.0, 5.0)
         s.markNode(self.roads.nodes[sensNode], drawProp)
 
-        return reroutePlace, s
+        return s
 
     def distanceBetween(self, n1, n2):
         return self.router.distance(n1, n2)
 
     def getPath(self, n1, n2):
-        key = (n1, n2)
-        cacheFile = 'cached/%s' % str(key)
-        status, path = None, None
-        try:
-            f = open(cacheFile, 'rb')
-            status, path = pickle.load(f)
-            f.close()
-        except IOError:
-            pass
-        if not status:
-            print 'Cache miss %s' % str(key)
-        status, path = self.router.doRoute(n1, n2, 'car')
-        f = open(cacheFile, 'wb')
-        pickle.dump((status, path), f)
-        f.close()
+        status, path = self.paths.route(self.router, n1, n2, 'car')
         return path
 
+    def routePath(self, routes, node):
+        """Node list of a route found by routesFrom/routesTo ([] if none)"""
+        return routes.get(node, (None, []))[1]
+
     def getPathDistance(self, path):
-        pairs = zip(path[:-1], path[1:])
-        return sum([self.distanceBetween(x, y) for x, y in pairs])
+        return self.getPathDistances([path])[0]
 
     def getToPlaceWeight(self, orig, sens, dest, altr):
         orig_sens = self.getPath(orig, sens)
         sens_dest = self.getPath(sens, dest)
         orig_altr = self.getPath(orig, altr)
         altr_dest = self.getPath(altr, dest)
-
+        return self.getPathsWeight(orig_sens, sens_dest, orig_altr, altr_dest)
+
+    def getPathsWeight(self, orig_sens, sens_dest, orig_altr, altr_dest):
+        return self.scoreCandidates(orig_sens, sens_dest,
+                                    [orig_altr], [altr_dest])[0]
+
+    def scoreCandidates(self, orig_sens, sens_dest, orig_altrs, altr_dests):
+        """ Scores every alternative at once, from its routes from the
+        origin and to the destination: a Gaussian of how much the trip's
+        length changes, plus how much of each original route it shares. """
+        n = len(orig_altrs)
+        lengths = self.getPathDistances(
+            [orig_sens, sens_dest] + list(orig_altrs) + list(altr_dests))
         # How similar is the path?
-        sim = \
-            (self.getPathDistance(orig_sens) + \
-             self.getPathDistance(sens_dest)) - \
-            (self.getPathDistance(orig_altr) + \
-             self.getPathDistance(altr_dest))
-        rv = scipy.stats.norm(loc=0.0, scale=0.01)
-
-        funcOverlap = lambda A,B: 2.0 * len(A.intersection(B)) / (len(A) + len(B))
-        from_orig_overlap = funcOverlap(set(orig_sens), set(orig_altr))
-        to_dest_overlap = funcOverlap(set(sens_dest), set(altr_dest))
-        print rv.pdf(sim) / 100.0, from_orig_overlap, to_dest_overlap
-
-        return rv.pdf(sim) / 100.0 + from_orig_overlap + to_dest_overlap
+        sim = (lengths[0] + lengths[1]) - (lengths[2:n + 2] + lengths[n + 2:])
+        scale = self.similarityScale
+        pdf = np.exp(-0.5 * (sim / scale) ** 2) / (scale * math.sqrt(2 * math.pi))
+
+        from_orig_overlap = self.getOverlaps(orig_sens, orig_altrs)
+        to_dest_overlap = self.getOverlaps(sens_dest, altr_dests)
+        if self.verbose:
+            for row in zip(pdf / 100.0, from_orig_overlap, to_dest_overlap):
+                print '%r %r %r' % row
+
+        return pdf / 100.0 + from_orig_overlap + to_dest_overlap
+
+    def choose(self, weights, choice=None):
+        """ Index of the place picked from a vector of weights: the best,
+        or (choice 'sample') one drawn in proportion to its weight. """
+        if not len(weights) or not weights.max() > 0:
+            raise ValueError('No alternative place can be reached')
+        if (choice or self.choice) == 'sample':
+            cdf = np.cumsum(weights)
+            return int(np.searchsorted(cdf / cdf[-1], np.random.uniform(),
+                                       side='right'))
+        return int(np.argmax(weights))
+
+    def pathIndices(self, paths):
+        """ Dense graph indices of the nodes of paths, end to end, and the
+        offsets at which each path starts (plus the end). """
+        offsets = np.zeros(len(paths) + 1, np.int64)
+        np.cumsum([len(p) for p in paths], out=offsets[1:])
+        nodes = np.zeros(offsets[-1], np.int64)
+        for path, start in zip(paths, offsets.tolist()):
+            nodes[start:start + len(path)] = path
+        return self.roads.graph.indices(nodes), offsets
+
+    def getPathDistances(self, paths):
+        """ Length of each of a list of paths, from one cumulative sum of
+        link lengths over all of them. """
+        graph = self.roads.graph
+        nodes, offsets = self.pathIndices(paths)
+        # Distance along the joined-up paths to each node (one spare
+        # entry, for empty paths at the end)
+        cumulative = np.zeros(len(nodes) + 1)
+        if len(nodes) > 1:
+            dlat = np.diff(graph.lat[nodes])
+            dlon = np.diff(graph.lon[nodes])
+            links = np.sqrt(dlat * dlat + dlon * dlon)
+            # The step from one path's last node to the next's first
+            joins = offsets[1:-1]
+            links[joins[(joins > 0) & (joins < len(nodes))] - 1] = 0
+            np.cumsum(links, out=cumulative[1:len(nodes)])
+        ends = np.maximum(offsets[1:] - 1, offsets[:-1])
+        return cumulative[ends] - cumulative[offsets[:-1]]
+
+    def getOverlaps(self, path, others):
+        """ 2 |A & B| / (|A| + |B|) between the nodes of path (A) and those
+        of each of others (B), using sorted arrays of node indices. """
+        graph = self.roads.graph
+        mine = np.unique(graph.indices(np.asarray(path, np.int64)))
+        nodes, offsets = self.pathIndices(others)
+        which = np.repeat(np.arange(len(others)), np.diff(offsets))
+        # Unique (path, node) pairs, as one sorted array of keys
+        keys = np.unique(which * len(graph) + nodes)
+        which = keys // max(len(graph), 1)
+        nodes = keys % max(len(graph), 1)
+        shared = np.zeros(len(nodes), bool)
+        if len(mine):
+            i = np.minimum(np.searchsorted(mine, nodes), len(mine) - 1)
+            shared = mine[i] == nodes
+        common = np.bincount(which, shared, minlength=len(others))
+        sizes = np.bincount(which, minlength=len(others)) + len(mine)
+        overlap = np.zeros(len(others))
+        np.divide(2.0 * common, sizes, out=overlap, where=sizes > 0)
+        return overlap
 
 if __name__ == '__main__':
     startPlace = 358793909L  # seeds school
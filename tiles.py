@@ -0,0 +1,205 @@
+"""
+Pre-rendered base map tiles, cached on disk.
+
+    python tiles.py data/westwood.graph 12 13 14
+
+renders every tile covering the map at the given zoom levels into
+cached/tiles, using a pool of worker processes. Review images are then
+composited from tiles and only the route overlays are drawn:
+
+    tiles = routeAdder.tileCache()
+    s = tiles.surface(loc, zoom=13, pixels=1000)
+    s.markPath(...)
+
+Tiles use MapSurface's projection. At zoom z the whole 360 degrees of
+longitude are 256 * 2**z pixels wide (180 degrees of latitude take up
+the same number of pixels), and tile (x, y) holds pixels x*256 to
+x*256+255 across, counting from longitude -180 and latitude 90.
+Tiles are PNG files under one directory per base map (a hash of its
+key). The directory is held to a size limit by deleting the least
+recently used tiles.
+"""
+import multiprocessing
+import os
+import sys
+import zlib
+
+import cairo
+
+from draw import MapSurface
+
+# The TileCache the workers render into; set before the pool is forked.
+cache = None
+
+
+class TileCache:
+    tileSize = 256
+    maxBytes = 256 << 20  # of tiles on disk, over all base maps
+
+    def __init__(self, directory, key, draw, maxBytes=None):
+        """
+        directory -- where the tiles are kept
+        key -- identifies the base map (e.g. the graph fingerprint);
+            tiles drawn for other keys are kept apart
+        draw -- draw(surface) renders the base map onto a MapSurface
+        """
+        self.directory = directory
+        self.key = key
+        self.draw = draw
+        if maxBytes is not None:
+            self.maxBytes = maxBytes
+        self.mapDirectory = os.path.join(
+            directory, '%08x' % (zlib.crc32(repr(key)) & 0xffffffff))
+        self.size = None  # bytes on disk, counted on first write
+
+    def pixelsPerDegree(self, zoom):
+        """ (per degree of latitude, per degree of longitude) """
+        pixels = self.tileSize * 2.0 ** zoom
+        return pixels / 180.0, pixels / 360.0
+
+    def pixel(self, zoom, (lat, lon)):
+        """ Global pixel coordinates of a point at a zoom level """
+        perLat, perLon = self.pixelsPerDegree(zoom)
+        return (lon + 180.0) * perLon, (90.0 - lat) * perLat
+
+    def tilesCovering(self, zoom, (minLat, minLon, maxLat, maxLon)):
+        """ (x, y) of every tile a bounding box touches """
+        x0, y0 = self.pixel(zoom, (maxLat, minLon))
+        x1, y1 = self.pixel(zoom, (minLat, maxLon))
+        size = self.tileSize
+        return [(x, y)
+                for x in xrange(int(x0 // size), int(x1 // size) + 1)
+                for y in xrange(int(y0 // size), int(y1 // size) + 1)]
+
+    def tilePath(self, zoom, x, y):
+        return os.path.join(self.mapDirectory, str(zoom), str(x),
+                            '%d.png' % y)
+
+    def renderTile(self, zoom, x, y):
+        """ Draws one tile and stores it (even if it is already stored) """
+        size = self.tileSize
+        perLat, perLon = self.pixelsPerDegree(zoom)
+        s = MapSurface()
+        s.setup((90.0 - (y + 0.5) * size / perLat,
+                 (x + 0.5) * size / perLon - 180.0),
+                scale=2.0 ** zoom, pixels=size)
+        self.draw(s)
+        path = self.tilePath(zoom, x, y)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # made by another process meanwhile
+        # Write under a temporary name, so readers never see half a tile
+        temp = '%s.%d.tmp' % (path, os.getpid())
+        s.writePng(temp)
+        os.rename(temp, path)
+        return s.surface, os.path.getsize(path)
+
+    def tile(self, zoom, x, y):
+        """ The tile as a cairo surface, rendering it if it's not stored """
+        path = self.tilePath(zoom, x, y)
+        try:
+            surface = cairo.ImageSurface.create_from_png(path)
+            os.utime(path, None)  # recently used
+            return surface
+        except (IOError, OSError, cairo.Error):
+            pass
+        surface, size = self.renderTile(zoom, x, y)
+        self.added(size)
+        return surface
+
+    def surface(self, loc, zoom, pixels):
+        """
+        A MapSurface centred on loc, at a zoom level, with the base map
+        painted from tiles; draw overlays on it as usual.
+        """
+        s = MapSurface()
+        s.setup(loc, scale=self.tileSize * 2.0 ** zoom / pixels,
+                pixels=pixels)
+        left, top = self.pixel(zoom, loc)
+        left = left - pixels / 2.0
+        top = top - pixels / 2.0
+        size = self.tileSize
+        for x in xrange(int(left // size), int((left + pixels) // size) + 1):
+            for y in xrange(int(top // size), int((top + pixels) // size) + 1):
+                s.paintLayer(self.tile(zoom, x, y),
+                             x * size - left, y * size - top)
+        return s
+
+    def prerender(self, zooms, bbox, processes=None):
+        """ Renders every tile covering bbox (minLat, minLon, maxLat,
+        maxLon) at each zoom level, in parallel. Returns the number of
+        tiles rendered. """
+        global cache
+        cache = self
+        jobs = [(zoom, x, y) for zoom in zooms
+                for (x, y) in self.tilesCovering(zoom, bbox)]
+        processes = processes or multiprocessing.cpu_count()
+        if processes == 1 or len(jobs) < 2:
+            renderTiles(jobs)
+        else:
+            pool = multiprocessing.Pool(processes)
+            try:
+                chunks = [jobs[i::processes * 4] for i in range(processes * 4)]
+                pool.map(renderTiles, chunks)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        self.size = None  # recount, then evict if need be
+        self.added(0)
+        return len(jobs)
+
+    def added(self, size):
+        """ Keeps track of the bytes on disk, evicting when over the limit """
+        if self.size is None:
+            self.size = sum([tile[1] for tile in self.stored()])
+        self.size = self.size + size
+        if self.size > self.maxBytes:
+            self.evict()
+
+    def stored(self):
+        """ (path, bytes, last used) of every stored tile """
+        tiles = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.png'):
+                    path = os.path.join(root, name)
+                    try:
+                        info = os.stat(path)
+                    except OSError:
+                        continue
+                    tiles.append((path, info.st_size, info.st_mtime))
+        return tiles
+
+    def evict(self, target=0.8):
+        """ Deletes least recently used tiles until their total size is
+        target * maxBytes. """
+        tiles = sorted(self.stored(), key=lambda t: t[2])
+        size = sum([t[1] for t in tiles])
+        for path, bytes, used in tiles:
+            if size <= target * self.maxBytes:
+                break
+            try:
+                os.remove(path)
+                size = size - bytes
+            except OSError:
+                pass
+        self.size = size
+
+
+def renderTiles(jobs):
+    return [cache.renderTile(zoom, x, y)[1] for zoom, x, y in jobs]
+
+
+if __name__ == '__main__':
+    from routeAdder import RouteAdder
+    ra = RouteAdder()
+    ra.init(sys.argv[1])
+    tiles = ra.tileCache()
+    graph = ra.roads.graph
+    bbox = (graph.lat.min(), graph.lon.min(), graph.lat.max(), graph.lon.max())
+    zooms = [int(z) for z in sys.argv[2:]] or [13]
+    print 'Rendering tiles...'
+    print '%d tiles' % tiles.prerender(zooms, bbox)